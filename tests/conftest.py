@@ -0,0 +1,39 @@
+from typing import List  # noqa: F401
+
+import cv2
+import fakeredis
+import numpy as np
+from numpy.typing import NDArray
+import pytest
+
+
+@pytest.fixture
+def redis_client() -> fakeredis.FakeRedis:
+    """A fresh in-memory Redis (with Lua scripting) for each test"""
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def clip() -> List[NDArray]:
+    """A BGR clip of a textured scene with a block moving across it, holding still for a few frames midway"""
+    h, w = 120, 160
+    rng = np.random.default_rng(0)
+    scene = cv2.GaussianBlur(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), (9, 9), 0)
+    frames = []
+    x = 5
+    for i in range(12):
+        if not 4 <= i < 7:
+            x += 9
+        frame = scene.copy()
+        cv2.rectangle(frame, (x, 40), (x + 25, 75), (30, 220, 250), -1)
+        frames.append(frame)
+    return frames
+
+
+@pytest.fixture
+def noise_clip() -> List[NDArray]:
+    """A BGR clip of random frames, with one repeated so a frame has nothing moving"""
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(0, 256, (120, 160, 3), dtype=np.uint8) for _ in range(6)]
+    frames.insert(3, frames[2].copy())
+    return frames
@@ -0,0 +1,22 @@
+import cv2
+import numpy as np
+
+from vidya.core.background import BackgroundModel
+
+
+def test_checking_frames_leaves_the_model_alone(clip):
+    model = BackgroundModel(width=160, learn_fps=1e6)
+    for _ in range(20):
+        model.learn(clip[0])
+    background = model._subtractor.getBackgroundImage().copy()
+
+    # The block moving across the scene is found, however many times it's checked, and not learned
+    n_moving = [cv2.countNonZero(model.apply(clip[-1])) for _ in range(50)]
+    assert n_moving[0] > 0
+    assert len(set(n_moving)) == 1
+    np.testing.assert_array_equal(model._subtractor.getBackgroundImage(), background)
+
+    # Frames fed in as they come off the stream are still learned
+    for _ in range(50):
+        model.learn(clip[-1])
+    assert cv2.countNonZero(model.apply(clip[-1])) < n_moving[0]
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import vidya.capture_service as capture_service
+from vidya.core.stream_limit import StreamLimiter
+
+
+class FakeCaptureWorker:
+    def __init__(self, slot, **kwargs):
+        self.slot = slot
+        self.is_started = False
+
+    def start(self):
+        self.is_started = True
+
+
+@pytest.fixture
+def cam(monkeypatch, redis_client) -> SimpleNamespace:
+    monkeypatch.setattr(capture_service, 'CaptureWorker', FakeCaptureWorker)
+    monkeypatch.setattr(capture_service, 'SLOT_RETRY_DELAY', 0.05)
+    return SimpleNamespace(cam_id=2, cam_name='yard', rtsp_url='rtsp://cam/main', frame_ring_name='ring',
+                           background=None, stream_limiter=StreamLimiter(redis_client, max_streams=1))
+
+
+def test_capture_waits_for_a_slot(cam):
+    held = cam.stream_limiter.acquire(cam.cam_id)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start = executor.submit(capture_service.start_capture, cam, ring=None, stop_event=threading.Event())
+        time.sleep(0.2)
+        assert not start.done()
+        held.release()
+        worker = start.result(timeout=1)
+    assert worker.is_started
+    assert cam.stream_limiter.acquire(cam.cam_id) is None
+    worker.slot.release()
+
+
+def test_waiting_for_a_slot_stops_promptly(cam):
+    cam.stream_limiter.acquire(cam.cam_id)
+    stop_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start = executor.submit(capture_service.start_capture, cam, ring=None, stop_event=stop_event)
+        time.sleep(0.1)
+        stop_event.set()
+        assert start.result(timeout=1) is None
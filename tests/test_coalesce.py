@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import redis
+
+from vidya.core.coalesce import (
+    TriggerCoalescer,
+    TriggerMode,
+)
+
+
+@pytest.fixture
+def coalescer(redis_client) -> TriggerCoalescer:
+    return TriggerCoalescer(redis_client, window=10, max_extend_seconds=10)
+
+
+def claim_key(cam_id: int, mode: str) -> str:
+    return f'{TriggerCoalescer.KEY_PREFIX}:{mode}:{cam_id}'
+
+
+def test_repeat_triggers_coalesce(coalescer):
+    token = coalescer.claim(1, TriggerMode.GIF)
+    assert token is not None
+    assert coalescer.claim(1, TriggerMode.GIF) is None
+    # Other cameras and modes claim separately
+    assert coalescer.claim(2, TriggerMode.GIF) is not None
+    assert coalescer.claim(1, TriggerMode.SNAP) is not None
+
+    coalescer.release(1, TriggerMode.GIF, token)
+    assert coalescer.claim(1, TriggerMode.GIF) is not None
+
+
+def test_concurrent_triggers_make_one_claim(coalescer):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        tokens = list(pool.map(lambda _: coalescer.claim(1, TriggerMode.SNAP), range(32)))
+    assert len([x for x in tokens if x is not None]) == 1
+
+
+def test_lapsed_claim_cannot_release_newer_one(coalescer, redis_client):
+    old_token = coalescer.claim(1, TriggerMode.GIF)
+    # The claim lapses while its task is still running, and a new trigger claims the camera
+    redis_client.delete(claim_key(1, TriggerMode.GIF))
+    new_token = coalescer.claim(1, TriggerMode.GIF)
+    assert new_token is not None
+    coalescer.request_extension(1, TriggerMode.GIF, 3)
+
+    coalescer.release(1, TriggerMode.GIF, old_token)
+    assert coalescer.claim(1, TriggerMode.GIF) is None
+    assert coalescer.pop_extension(1, TriggerMode.GIF) == 3
+
+
+def test_lapsed_claim_cannot_renew_newer_one(coalescer, redis_client):
+    old_token = coalescer.claim(1, TriggerMode.GIF)
+    redis_client.delete(claim_key(1, TriggerMode.GIF))
+    new_token = coalescer.claim(1, TriggerMode.GIF)
+
+    assert not coalescer.renew(1, TriggerMode.GIF, old_token, seconds=60)
+    assert redis_client.pttl(claim_key(1, TriggerMode.GIF)) <= 10_000
+    assert coalescer.renew(1, TriggerMode.GIF, new_token, seconds=60)
+    assert redis_client.pttl(claim_key(1, TriggerMode.GIF)) > 10_000
+
+
+def test_release_clears_extensions(coalescer, redis_client):
+    token = coalescer.claim(1, TriggerMode.GIF)
+    coalescer.request_extension(1, TriggerMode.GIF, 5)
+    coalescer.release(1, TriggerMode.GIF, token)
+    assert not redis_client.exists(claim_key(1, TriggerMode.GIF))
+    assert coalescer.pop_extension(1, TriggerMode.GIF) == 0
+
+
+def test_extensions_are_capped_and_hold_the_claim(coalescer, redis_client):
+    coalescer.claim(1, TriggerMode.GIF)
+    assert coalescer.request_extension(1, TriggerMode.GIF, 4) == 4
+    assert coalescer.request_extension(1, TriggerMode.GIF, 4) == 8
+    assert coalescer.request_extension(1, TriggerMode.GIF, 4) == 10
+    # The claim's held for as long as the extended capture could run
+    assert redis_client.pttl(claim_key(1, TriggerMode.GIF)) > 10_000
+    assert coalescer.pop_extension(1, TriggerMode.GIF) == 12
+    assert coalescer.pop_extension(1, TriggerMode.GIF) == 0
+
+
+def test_extension_never_shortens_a_renewed_claim(coalescer, redis_client):
+    token = coalescer.claim(1, TriggerMode.GIF)
+    coalescer.renew(1, TriggerMode.GIF, token, seconds=120)
+    coalescer.request_extension(1, TriggerMode.GIF, 4)
+    assert redis_client.pttl(claim_key(1, TriggerMode.GIF)) > 100_000
+
+
+def test_disabled_window_never_coalesces(redis_client):
+    coalescer = TriggerCoalescer(redis_client, window=0)
+    assert coalescer.claim(1, TriggerMode.SNAP) is not None
+    assert coalescer.claim(1, TriggerMode.SNAP) is not None
+    assert redis_client.keys() == []
+
+
+def test_unreachable_redis_never_blocks_a_trigger():
+    coalescer = TriggerCoalescer(redis.Redis(port=1, socket_connect_timeout=0.1))
+    assert coalescer.claim(1, TriggerMode.GIF) is not None
+    assert coalescer.claim(1, TriggerMode.GIF) is not None
+    assert not coalescer.renew(1, TriggerMode.GIF, 'token', seconds=10)
+    coalescer.release(1, TriggerMode.GIF, 'token')
+    assert coalescer.request_extension(1, TriggerMode.GIF, 5) == 0
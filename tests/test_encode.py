@@ -0,0 +1,166 @@
+import io
+
+from PIL import (
+    Image,
+    ImageSequence,
+)
+import imageio_ffmpeg
+import numpy as np
+
+from vidya.core.encode import (
+    GIFStreamWriter,
+    MP4StreamWriter,
+    WebPStreamWriter,
+)
+from vidya.core.motion_detect import MotionDetector
+
+GREY = (128, 128, 128)
+SIZE = (64, 48)
+
+
+def rgb_frame(color, size=SIZE) -> Image.Image:
+    return Image.new('RGB', size, color)
+
+
+def rgba_patch(box, color) -> Image.Image:
+    """A frame that's transparent apart from `box`, like the optimized motion frames"""
+    arr = np.zeros((SIZE[1], SIZE[0], 4), dtype=np.uint8)
+    left, top, right, bottom = box
+    arr[top:bottom, left:right] = (*color, 255)
+    return Image.fromarray(arr, mode='RGBA')
+
+
+def encode(frames, **kwargs) -> Image.Image:
+    buf = io.BytesIO()
+    with GIFStreamWriter(buf, **kwargs) as writer:
+        for frame in frames:
+            writer.write(frame)
+    assert writer.n_frames == len(frames)
+    buf.seek(0)
+    return Image.open(buf)
+
+
+def test_rgb_frames_round_trip():
+    colors = [GREY, (200, 30, 30), (30, 30, 200)]
+    gif = encode([rgb_frame(x) for x in colors], fps=5)
+    assert gif.format == 'GIF'
+    assert gif.n_frames == 3
+    assert gif.info['loop'] == 0
+    for frame, color in zip(ImageSequence.Iterator(gif), colors):
+        assert frame.size == SIZE
+        assert frame.info['duration'] == 200
+        # Colors outside the first frame are mapped onto its palette, so only the first is exact
+        if color == GREY:
+            assert frame.convert('RGB').getpixel((0, 0)) == GREY
+
+
+def test_optimized_frames_keep_the_previous_picture():
+    green = MotionDetector.GREEN
+    frames = [
+        rgb_frame(GREY).convert('RGBA'),
+        rgba_patch((10, 10, 20, 20), green),
+        # No motion at all
+        rgba_patch((0, 0, 0, 0), green),
+        rgba_patch((40, 30, 50, 40), green),
+    ]
+    gif = encode(frames, fps=10)
+    assert gif.n_frames == 4
+
+    expected = np.full((SIZE[1], SIZE[0], 3), GREY, dtype=np.uint8)
+    for i, frame in enumerate(ImageSequence.Iterator(gif)):
+        if i > 0:
+            opaque = np.asarray(frames[i])[..., 3] > 0
+            expected[opaque] = green
+        assert frame.info['duration'] == 100
+        np.testing.assert_array_equal(np.asarray(frame.convert('RGB')), expected)
+
+
+def test_reserved_colors_stay_exact():
+    red = MotionDetector.RED
+    # The first frame has no red in it, but the motion overlay color survives quantization
+    gif = encode([rgb_frame(GREY), rgba_patch((0, 0, 8, 8), red)])
+    gif.seek(1)
+    assert gif.convert('RGB').getpixel((2, 2)) == red
+
+
+def test_writes_to_path(tmp_path):
+    path = tmp_path.joinpath('clip.gif')
+    with GIFStreamWriter(path, fps=10) as writer:
+        for _ in range(3):
+            writer.write(rgb_frame(GREY))
+    with Image.open(path) as gif:
+        assert gif.n_frames == 3
+
+
+def test_no_frames_writes_nothing():
+    buf = io.BytesIO()
+    GIFStreamWriter(buf).close()
+    assert buf.getvalue() == b''
+
+
+def encode_video(writer_class, frames, **kwargs) -> bytes:
+    buf = io.BytesIO()
+    with writer_class(buf, **kwargs) as writer:
+        for frame in frames:
+            writer.write(frame)
+    assert writer.n_frames == len(frames)
+    assert not writer.path.exists()
+    return buf.getvalue()
+
+
+def optimized_frames():
+    green = (30, 200, 30)
+    return [rgb_frame(GREY).convert('RGBA'), rgba_patch((10, 10, 30, 30), green), rgba_patch((0, 0, 0, 0), green)]
+
+
+def noise_frames():
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (SIZE[1], SIZE[0], 3), dtype=np.uint8)) for _ in range(3)]
+
+
+def test_webp_round_trip():
+    webp = Image.open(io.BytesIO(encode_video(WebPStreamWriter, optimized_frames(), fps=5, quality=90)))
+    assert webp.format == 'WEBP'
+    assert webp.info['loop'] == 0
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(webp):
+        frames.append(np.asarray(frame.convert('RGB')).astype(int))
+        durations.append(frame.info['duration'])
+    # libwebp merges the last (unchanged) frame into the one before, lengthening it
+    assert sum(durations) == 600
+    # Transparent parts of a frame keep showing the picture before it
+    assert np.abs(frames[-1][20, 20] - (30, 200, 30)).max() < 20
+    assert np.abs(frames[-1][40, 50] - GREY).max() < 20
+
+
+def test_webp_honours_quality():
+    frames = noise_frames()
+    low, high = encode_video(WebPStreamWriter, frames, quality=10), encode_video(WebPStreamWriter, frames, quality=90)
+    assert len(low) < len(high)
+
+
+def test_mp4_is_h264(tmp_path):
+    path = tmp_path.joinpath('clip.mp4')
+    # Odd sizes are cropped to even ones
+    with MP4StreamWriter(path, fps=5) as writer:
+        for _ in range(4):
+            writer.write(rgb_frame(GREY, size=(65, 49)))
+    reader = imageio_ffmpeg.read_frames(str(path))
+    meta = next(reader)
+    assert meta['codec'] == 'h264'
+    assert meta['size'] == SIZE
+    assert meta['fps'] == 5
+    frames = list(reader)
+    assert len(frames) == 4
+    assert np.abs(np.frombuffer(frames[0], dtype=np.uint8).astype(int) - 128).max() < 5
+
+
+def test_mp4_honours_quality():
+    frames = noise_frames()
+    low, high = encode_video(MP4StreamWriter, frames, quality=10), encode_video(MP4StreamWriter, frames, quality=90)
+    assert len(low) < len(high)
+
+
+def test_no_video_frames_writes_nothing():
+    assert encode_video(MP4StreamWriter, []) == b''
+    assert encode_video(WebPStreamWriter, []) == b''
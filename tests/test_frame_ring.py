@@ -0,0 +1,140 @@
+import subprocess
+import sys
+import uuid
+
+import numpy as np
+import pytest
+
+from vidya.core.capture import RingCaptureWorker
+from vidya.core.frame_ring import SharedFrameRing
+
+SHAPE = (8, 12, 3)
+
+
+@pytest.fixture
+def writer():
+    ring = SharedFrameRing(name=f'vidya_test_{uuid.uuid4().hex[:8]}', n_slots=4)
+    yield ring
+    ring.close()
+
+
+@pytest.fixture
+def reader(writer):
+    writer.push(frame(0), ts=0.0)
+    ring = SharedFrameRing.attach(writer.name)
+    yield ring
+    ring.close()
+
+
+def frame(value: int) -> np.ndarray:
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+def test_reader_sees_pushed_frames(writer, reader):
+    assert reader.shape == SHAPE
+    for i in range(1, 4):
+        writer.push(frame(i), ts=float(i))
+    seq, arr, ts = reader.wait_for_frame(after_seq=0, timeout=1)
+    # The newest frame, not the next one
+    assert (seq, ts) == (4, 3.0)
+    np.testing.assert_array_equal(arr, frame(3))
+    got, ts = reader.get(2)
+    np.testing.assert_array_equal(got, frame(1))
+    assert ts == 1.0
+
+
+def test_overwritten_frames_are_detected(writer, reader):
+    seq, arr, _ = reader.wait_for_frame(after_seq=0, timeout=1)
+    assert reader.is_current(seq)
+    # Once the writer's gone all the way around the ring, the frame's slot holds a newer one
+    for i in range(writer.n_slots):
+        writer.push(frame(100 + i), ts=float(i))
+    assert not reader.is_current(seq)
+    assert reader.get(seq) is None
+    # ...which the view handed out earlier now shows
+    np.testing.assert_array_equal(arr, frame(103))
+
+
+def test_frame_mid_write_is_not_served(writer, reader):
+    seq = writer.write_seq + 1
+    # The writer has claimed the slot (odd sequence word) but not finished copying into it
+    writer._slots['seq'][seq % writer.n_slots] = 2 * seq - 1
+    writer._header['write_seq'] = seq
+    assert reader.get(seq) is None
+    with pytest.raises(TimeoutError):
+        reader.wait_for_frame(after_seq=seq - 1, timeout=0.05)
+
+
+def test_wait_times_out_without_new_frames(reader):
+    seq, _, _ = reader.wait_for_frame(after_seq=0, timeout=1)
+    with pytest.raises(TimeoutError):
+        reader.wait_for_frame(after_seq=seq, timeout=0.05)
+
+
+def test_closed_ring_ends_readers(writer, reader):
+    writer.close()
+    with pytest.raises(EOFError):
+        reader.wait_for_frame(after_seq=0, timeout=1)
+
+
+def test_shape_change_moves_to_a_new_block(writer, reader):
+    writer.push(np.zeros((4, 6, 3), dtype=np.uint8), ts=1.0)
+    with pytest.raises(EOFError):
+        reader.wait_for_frame(after_seq=0, timeout=1)
+    new_reader = SharedFrameRing.attach(writer.name)
+    try:
+        assert new_reader.shape == (4, 6, 3)
+    finally:
+        new_reader.close()
+
+
+def test_running_writers_ring_is_never_replaced(writer):
+    writer.push(frame(1), ts=1.0)
+    with pytest.raises(FileExistsError):
+        SharedFrameRing(name=writer.name, n_slots=4).push(frame(2), ts=2.0)
+    assert writer.is_current(1)
+
+
+def test_ring_left_by_a_dead_writer_is_replaced(writer):
+    # A writer that exits without cleaning up (its resource tracker would otherwise remove the block)
+    script = f'''
+import os
+from multiprocessing import resource_tracker
+import numpy as np
+from vidya.core.capture import RingCaptureWorker
+from vidya.core.frame_ring import SharedFrameRing
+ring = SharedFrameRing(name={writer.name!r}, n_slots=4)
+ring.push(np.zeros({SHAPE!r}, dtype=np.uint8), ts=1.0)
+resource_tracker.unregister(ring._shm._name, 'shared_memory')
+os._exit(0)
+'''
+    subprocess.run([sys.executable, '-c', script], check=True)
+    left_behind = SharedFrameRing.attach(writer.name)
+    assert not left_behind.is_closed
+    left_behind.close()
+
+    writer.push(frame(1), ts=1.0)
+    assert writer.write_seq == 1
+
+
+def test_ring_worker_cleans_up_when_it_fails(writer, monkeypatch):
+    writer.push(frame(0), ts=0.0)
+    worker = RingCaptureWorker(ring_name=writer.name, name='porch')
+    closed = []
+    close = SharedFrameRing.close
+
+    def record_close(ring):
+        closed.append(ring.name)
+        close(ring)
+    monkeypatch.setattr(SharedFrameRing, 'close', record_close)
+
+    def fail(*args):
+        raise RuntimeError('publishing failed')
+    monkeypatch.setattr(worker, '_publish', fail)
+
+    writer.push(frame(1), ts=1.0)
+    with pytest.raises(RuntimeError):
+        worker.run()
+    assert closed == [writer.name]
+    # Readers waiting on frames are let go
+    assert not worker.keep_alive()
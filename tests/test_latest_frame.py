@@ -0,0 +1,152 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from flask import Flask
+import pytest
+
+from vidya.app import create_app
+from vidya.config import DevelopmentConfig
+from vidya.core.camera_api import (
+    CameraAPI,
+    QuickCameraAPI,
+)
+from vidya.core.latest_frame import (
+    LatestFrame,
+    LatestFrameCache,
+)
+import vidya.routes.camera as camera_routes
+
+
+class FakeCamera:
+    """Stands in for a camera's snapshot API, returning a new image for each fetch"""
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.n_fetches = 0
+
+    def snap_jpeg(self) -> bytes:
+        time.sleep(self.delay)
+        self.n_fetches += 1
+        return f'jpeg-{self.n_fetches}'.encode()
+
+
+@pytest.fixture
+def app(monkeypatch, redis_client) -> Flask:
+    env = dict(VIDYA_WEBAPP_SECRET='secret', REDIS_URL='redis://localhost:6379/0', SLACK_BOT_TOKEN='xoxb-test',
+               CAMS='1')
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    monkeypatch.setattr(DevelopmentConfig, 'LOG_DIR', None)
+    app = create_app(config_class=DevelopmentConfig)
+    app.extensions['latest_frames'] = LatestFrameCache(redis_client, ttl=60, max_stale=120, lock_timeout=0.2)
+    return app
+
+
+@pytest.fixture
+def camera(monkeypatch) -> FakeCamera:
+    camera = FakeCamera()
+    monkeypatch.setattr(camera_routes, 'get_cam_api', lambda cam_id: camera)
+    return camera
+
+
+def test_latest_frame_is_cached(app, camera):
+    client = app.test_client()
+    first = client.get('/cam/1/latest.jpg')
+    assert first.status_code == 200
+    assert first.mimetype == 'image/jpeg'
+    assert first.data == b'jpeg-1'
+    assert first.headers['ETag'] == f'"{LatestFrame.new(b"jpeg-1").etag}"'
+
+    second = client.get('/cam/1/latest.jpg')
+    assert second.data == b'jpeg-1'
+    assert camera.n_fetches == 1
+
+
+def test_matching_etag_gets_304(app, camera):
+    client = app.test_client()
+    etag = client.get('/cam/1/latest.jpg').headers['ETag']
+    resp = client.get('/cam/1/latest.jpg', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+    resp = client.get('/cam/1/latest.jpg', headers={'If-None-Match': '"something-else"'})
+    assert resp.status_code == 200
+    assert resp.data == b'jpeg-1'
+
+
+def test_unknown_camera_is_404(app, camera):
+    assert app.test_client().get('/cam/9/latest.jpg').status_code == 404
+
+
+def test_failed_fetch_without_a_frame_is_503(app, monkeypatch):
+    def snap_jpeg():
+        raise ConnectionError('camera is down')
+    monkeypatch.setattr(camera_routes, 'get_cam_api', lambda cam_id: SimpleNamespace(snap_jpeg=snap_jpeg))
+    assert app.test_client().get('/cam/1/latest.jpg').status_code == 503
+
+
+def test_refresh_is_single_flight(redis_client):
+    camera = FakeCamera(delay=0.1)
+    # Two processes' caches sharing one Redis
+    caches = [LatestFrameCache(redis_client, ttl=60) for _ in range(2)]
+    frames = []
+    threads = [threading.Thread(target=lambda c=c: frames.append(c.get(1, fetch=camera.snap_jpeg)))
+               for c in caches for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [x.jpeg for x in frames] == [b'jpeg-1'] * 6
+    assert camera.n_fetches == 1
+
+
+def test_slow_refresh_serves_stale_frame_instead_of_fetching(redis_client):
+    camera = FakeCamera()
+    cache = LatestFrameCache(redis_client, ttl=1, max_stale=60, lock_timeout=0.1)
+    cache._write(1, LatestFrame(jpeg=b'old', etag='old', fetched_at=time.time() - 5))
+    # Another process is refreshing (and taking its time)
+    lock = redis_client.lock(f'{LatestFrameCache.KEY_PREFIX}:1:lock', timeout=10)
+    assert lock.acquire(blocking=False)
+
+    assert cache.get(1, fetch=camera.snap_jpeg).jpeg == b'old'
+    assert camera.n_fetches == 0
+
+
+def test_slow_refresh_without_a_frame_times_out(redis_client):
+    camera = FakeCamera()
+    cache = LatestFrameCache(redis_client, ttl=1, max_stale=60, lock_timeout=0.1)
+    lock = redis_client.lock(f'{LatestFrameCache.KEY_PREFIX}:1:lock', timeout=10)
+    assert lock.acquire(blocking=False)
+
+    with pytest.raises(TimeoutError):
+        cache.get(1, fetch=camera.snap_jpeg)
+    assert camera.n_fetches == 0
+
+
+def test_slow_refresh_is_503_for_route(app, camera, redis_client):
+    lock = redis_client.lock(f'{LatestFrameCache.KEY_PREFIX}:1:lock', timeout=10)
+    assert lock.acquire(blocking=False)
+    assert app.test_client().get('/cam/1/latest.jpg').status_code == 503
+    assert camera.n_fetches == 0
+
+
+def test_refresh_lock_outlasts_the_fetch(redis_client):
+    camera = FakeCamera(delay=0.3)
+    cache = LatestFrameCache(redis_client, ttl=60, lock_timeout=0.1, fetch_timeout=5)
+    thread = threading.Thread(target=cache.get, args=(1, camera.snap_jpeg))
+    thread.start()
+    time.sleep(0.1)
+    # Held for as long as a fetch can take, not just as long as others wait on it
+    assert redis_client.pttl(f'{LatestFrameCache.KEY_PREFIX}:1:lock') > 4000
+    thread.join()
+    assert camera.n_fetches == 1
+
+
+def test_web_tier_fails_fast(app):
+    # The app fixture swaps in a cache of its own, so build another
+    cache = create_app(config_class=DevelopmentConfig).extensions['latest_frames']
+    assert cache.lock_timeout <= 5
+    assert cache.fetch_timeout == QuickCameraAPI.max_snap_seconds()
+    assert QuickCameraAPI.HTTP_RETRIES == 0
+    assert QuickCameraAPI.max_snap_seconds() < CameraAPI.max_snap_seconds() / 3
+    assert app.extensions['cam_apis'].camera_class.endswith('.QuickCameraAPI')
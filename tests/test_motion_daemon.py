@@ -0,0 +1,214 @@
+from types import SimpleNamespace
+from typing import (  # noqa: F401
+    List,
+    Tuple,
+)
+import uuid
+
+import numpy as np
+import pytest
+
+from vidya.core.capture import CaptureSource
+from vidya.core.frame_ring import SharedFrameRing
+from vidya.core.stream_limit import (
+    StreamLimiter,
+    SubstreamLimiter,
+)
+import vidya.motion_daemon as motion_daemon
+from vidya.motion_daemon import CameraWatcher
+
+FRAME = np.zeros((4, 4, 3), dtype=np.uint8)
+
+
+class FakeTrigger:
+    def __init__(self):
+        self.fired = []  # type: List[Tuple[int, bool]]
+
+    def fire(self, cam_id: int, is_continuing: bool = False):
+        self.fired.append((cam_id, is_continuing))
+
+
+class ScriptedDetector:
+    """Hands out the next motion score for each frame checked"""
+    def __init__(self):
+        self.scores = []  # type: List[float]
+
+    def downscale(self, frame):
+        return frame
+
+    def batch_motion_detect_with_diff(self, frames):
+        return None, [self.scores.pop(0)]
+
+
+@pytest.fixture
+def trigger() -> FakeTrigger:
+    return FakeTrigger()
+
+
+def make_cam(**kwargs) -> SimpleNamespace:
+    return SimpleNamespace(**dict(dict(cam_id=3, cam_name='porch', roi=None, stream_name='main', substream_name='sub',
+                                       substream_url='rtsp://cam/sub', capture_source=CaptureSource.RTSP,
+                                       stream_limiter=None, frame_ring_name=None), **kwargs))
+
+
+def make_watcher(trigger: FakeTrigger, cam: SimpleNamespace = None, **kwargs) -> CameraWatcher:
+    kwargs = dict(dict(on_score=0.01, off_score=0.005, on_samples=2, off_samples=3, cooldown=3600), **kwargs)
+    watcher = CameraWatcher(make_cam() if cam is None else cam, trigger=trigger, **kwargs)
+    watcher.detector = ScriptedDetector()
+    return watcher
+
+
+def feed(watcher: CameraWatcher, scores: List[float]) -> List[bool]:
+    """Checks one frame per score, returning whether the watcher saw motion after each"""
+    watcher.detector.scores.extend(scores)
+    states = []
+    for _ in scores:
+        watcher._check(FRAME)
+        states.append(watcher.is_moving)
+    return states
+
+
+def test_motion_needs_consecutive_samples_to_start(trigger):
+    watcher = make_watcher(trigger)
+    # A lone spike (or one broken up by a quiet sample) doesn't count
+    assert feed(watcher, [0.02, 0.0, 0.02, 0.001]) == [False] * 4
+    assert trigger.fired == []
+    assert feed(watcher, [0.02, 0.02]) == [False, True]
+    assert trigger.fired == [(3, False)]
+
+
+def test_motion_needs_consecutive_quiet_samples_to_end(trigger):
+    watcher = make_watcher(trigger)
+    feed(watcher, [0.02, 0.02])
+    # Scores between the two thresholds neither start nor end motion
+    assert feed(watcher, [0.001, 0.001, 0.007, 0.001, 0.001]) == [True] * 5
+    assert feed(watcher, [0.001]) == [False]
+    assert trigger.fired == [(3, False)]
+
+
+def test_motion_between_thresholds_does_not_start(trigger):
+    watcher = make_watcher(trigger)
+    assert feed(watcher, [0.007] * 5) == [False] * 5
+    assert trigger.fired == []
+
+
+def test_continuing_motion_fires_again_after_cooldown(trigger):
+    watcher = make_watcher(trigger, cooldown=0)
+    feed(watcher, [0.02, 0.02, 0.02, 0.0])
+    assert trigger.fired == [(3, False), (3, True), (3, True)]
+
+
+def test_motion_starts_over_after_ending(trigger):
+    watcher = make_watcher(trigger)
+    feed(watcher, [0.02, 0.02, 0.0, 0.0, 0.0])
+    assert not watcher.is_moving
+    feed(watcher, [0.02, 0.02])
+    assert trigger.fired == [(3, False), (3, False)]
+
+
+class BusyCapture:
+    """A capture whose grabs cost CPU, like FFmpeg decoding every frame"""
+    def __init__(self, watcher: CameraWatcher, n_frames: int):
+        self.watcher = watcher
+        self.n_left = n_frames
+
+    def grab(self) -> bool:
+        self.n_left -= 1
+        if self.n_left <= 0:
+            self.watcher.stop()
+        sum(range(20000))
+        return True
+
+    def retrieve(self):
+        return True, FRAME
+
+
+def test_decoding_cost_is_reported_not_budgeted(trigger, monkeypatch):
+    watcher = make_watcher(trigger, sample_fps=100, cpu_budget=0.05)
+    watcher.DECODE_CHECK_INTERVAL = 0.1
+    decode_usages = []
+    monkeypatch.setattr(watcher, '_check_decode_cost', decode_usages.append)
+    watcher.detector.scores.extend([0.0] * 10_000)
+
+    watcher._watch(BusyCapture(watcher, n_frames=1000))
+    # Grabbing took nearly the whole thread, but sampling kept its rate
+    assert watcher.interval == watcher.min_interval
+    assert len(decode_usages) > 0
+    assert all(x > watcher.cpu_budget for x in decode_usages)
+
+
+class FakeVideoCapture:
+    """Stands in for cv2.VideoCapture, recording the streams opened"""
+    opened = []  # type: List[str]
+
+    def __init__(self, url: str):
+        self.opened.append(url)
+
+    def isOpened(self) -> bool:
+        return True
+
+    def release(self):
+        pass
+
+
+@pytest.fixture
+def video_capture(monkeypatch):
+    FakeVideoCapture.opened = []
+    monkeypatch.setattr(motion_daemon.cv2, 'VideoCapture', FakeVideoCapture)
+    return FakeVideoCapture
+
+
+def test_substream_holds_a_substream_slot(trigger, redis_client, video_capture):
+    limiter = SubstreamLimiter(redis_client, max_streams=1)
+    # The main stream's slots don't come into it
+    cam = make_cam(stream_limiter=StreamLimiter(redis_client, max_streams=0))
+    watcher = make_watcher(trigger, cam=cam, substream_limiter=limiter)
+    cap, slot = watcher._open()
+    assert video_capture.opened == ['rtsp://cam/sub']
+    # A second watcher on the camera (e.g., another daemon) has to wait
+    assert make_watcher(trigger, cam=cam, substream_limiter=limiter)._open() == (None, None)
+    assert len(video_capture.opened) == 1
+
+    slot.release()
+    assert make_watcher(trigger, cam=cam, substream_limiter=limiter)._open()[0] is not None
+
+
+def test_main_stream_only_opened_with_a_free_slot(trigger, redis_client, video_capture):
+    main_limiter = StreamLimiter(redis_client, max_streams=1)
+    cam = make_cam(substream_name='main', substream_url='rtsp://cam/main', stream_limiter=main_limiter)
+    # e.g., held by a capture worker
+    held = main_limiter.acquire(3)
+
+    watcher = make_watcher(trigger, cam=cam, substream_limiter=SubstreamLimiter(redis_client))
+    assert watcher._open() == (None, None)
+    assert video_capture.opened == []
+
+    held.release()
+    cap, slot = watcher._open()
+    assert video_capture.opened == ['rtsp://cam/main']
+    assert main_limiter.acquire(3) is None
+    slot.release()
+
+
+def test_main_stream_read_from_frame_ring(trigger, redis_client, video_capture):
+    ring = SharedFrameRing(name=f'vidya_test_{uuid.uuid4().hex[:8]}', n_slots=4)
+    try:
+        main_limiter = StreamLimiter(redis_client, max_streams=1)
+        cam = make_cam(substream_name='main', capture_source=CaptureSource.RING, frame_ring_name=ring.name,
+                       stream_limiter=main_limiter)
+        watcher = make_watcher(trigger, cam=cam)
+        ring.push(np.full((4, 4, 3), 1, dtype=np.uint8), ts=1.0)
+        cap, slot = watcher._open()
+        try:
+            ring.push(np.full((4, 4, 3), 2, dtype=np.uint8), ts=2.0)
+            assert cap.grab()
+            ok, frame = cap.retrieve()
+            assert ok and frame[0, 0, 0] == 2
+        finally:
+            cap.release()
+        # Neither a stream nor a slot was taken
+        assert slot is None
+        assert video_capture.opened == []
+        assert main_limiter.acquire(3) is not None
+    finally:
+        ring.close()
@@ -0,0 +1,114 @@
+from typing import (  # noqa: F401
+    List,
+    Optional,
+    Tuple,
+)
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+import pytest
+
+from vidya.core.motion_detect import MotionDetector
+from vidya.core.roi import RegionOfInterest
+
+ROIS = {
+    'no_roi': None,
+    'include': RegionOfInterest(include=[[[0.1, 0.2], [0.9, 0.2], [0.9, 0.9], [0.1, 0.9]]]),
+    'exclude': RegionOfInterest(exclude=[[[0, 0], [0.4, 0], [0.4, 0.5], [0, 0.5]]]),
+}
+
+
+def detect_per_frame(frames: List[NDArray], roi: Optional[RegionOfInterest]) -> Tuple[List[NDArray], List[float]]:
+    """Diff detection one frame at a time, the way `process_frame` does it"""
+    md = MotionDetector(roi=roi)
+    masks, scores = [], []
+    prev_blur = None
+    for frame in frames:
+        mask, prev_blur = md.motion_detect_with_diff_roi(cv2.cvtColor(frame, md.color_style), prev_blur)
+        masks.append(mask)
+        scores.append(cv2.countNonZero(mask) / mask.size)
+    return masks, scores
+
+
+@pytest.mark.parametrize('roi', ROIS.values(), ids=ROIS.keys())
+@pytest.mark.parametrize('clip_name', ['clip', 'noise_clip'])
+def test_batch_detection_matches_per_frame(roi, clip_name, request):
+    frames = request.getfixturevalue(clip_name)
+    expected_masks, expected_scores = detect_per_frame(frames, roi)
+
+    masks, scores = MotionDetector(roi=roi).batch_motion_detect_with_diff(np.stack(frames))
+    np.testing.assert_array_equal(masks, np.stack(expected_masks))
+    np.testing.assert_allclose(scores, expected_scores)
+    assert scores.max() > 0
+
+
+@pytest.mark.parametrize('roi', ROIS.values(), ids=ROIS.keys())
+def test_batch_detection_carries_on_across_chunks(roi, clip):
+    expected_masks, _ = detect_per_frame(clip, roi)
+
+    md = MotionDetector(roi=roi)
+    # Uneven chunks, reusing the detector's buffers between calls of the same size
+    masks = [md.batch_motion_detect_with_diff(np.stack(clip[start:stop]))[0]
+             for start, stop in ((0, 5), (5, 10), (10, 12))]
+    np.testing.assert_array_equal(np.concatenate(masks), np.stack(expected_masks))
+
+
+def test_batch_detection_of_nothing():
+    masks, scores = MotionDetector().batch_motion_detect_with_diff(np.zeros((0, 8, 8, 3), dtype=np.uint8))
+    assert masks.shape == (0, 8, 8)
+    assert scores.shape == (0, )
+
+
+def contour_clip(frames: List[NDArray]):
+    """Yields each frame of the clip as RGBA, with its foreground mask and contours"""
+    md = MotionDetector()
+    prev_blur = None
+    for frame in frames:
+        fg_mask, prev_blur = md.motion_detect_with_diff(frame, prev_blur)
+        yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA), fg_mask, md.extract_contours(fg_mask)
+
+
+@pytest.mark.parametrize('clip_name', ['clip', 'noise_clip'])
+def test_optimized_compositor_matches_pil(clip_name, request):
+    frames = request.getfixturevalue(clip_name)
+    md = MotionDetector()
+    expected_past = past = None
+    n_with_contours = n_quiet = 0
+    for i, (rgba, fg_mask, contours) in enumerate(contour_clip(frames)):
+        expected, expected_past = MotionDetector.contouring_optimized(i, rgba, fg_mask, expected_past, contours)
+        out, past = md.contouring_optimized_arr(i, rgba, fg_mask, past, contours)
+        np.testing.assert_array_equal(out, expected)
+        assert (past is None) == (expected_past is None)
+        if past is not None:
+            np.testing.assert_array_equal(past, expected_past)
+            n_with_contours += 1
+        n_quiet += int(i > 0 and not fg_mask.any())
+    if clip_name == 'clip':
+        assert n_with_contours > 0 and n_quiet > 0
+
+
+def test_optimized_compositor_with_a_past_mask_and_no_motion(clip):
+    md = MotionDetector()
+    rgba = cv2.cvtColor(clip[0], cv2.COLOR_BGR2RGBA)
+    fg_mask = np.zeros(rgba.shape[:2], dtype=np.uint8)
+    past_mask = np.zeros_like(fg_mask)
+    cv2.rectangle(past_mask, (20, 20), (60, 50), 255, 1)
+
+    expected, expected_past = MotionDetector.contouring_optimized(3, rgba, fg_mask, past_mask, [])
+    out, past = md.contouring_optimized_arr(3, rgba, fg_mask, past_mask, [])
+    np.testing.assert_array_equal(out, expected)
+    assert past is None and expected_past is None
+    # Only the past mask's outline shows through
+    assert np.count_nonzero(out[..., 3]) == np.count_nonzero(past_mask)
+
+
+def test_optimized_compositor_in_place_matches(clip):
+    md, md_in_place = MotionDetector(), MotionDetector()
+    past = past_in_place = None
+    for i, (rgba, fg_mask, contours) in enumerate(contour_clip(clip)):
+        expected, past = md.contouring_optimized_arr(i, rgba, fg_mask, past, contours)
+        out, past_in_place = md_in_place.contouring_optimized_arr(i, rgba, fg_mask, past_in_place, contours,
+                                                                  in_place=True)
+        assert out is rgba
+        np.testing.assert_array_equal(out, expected)
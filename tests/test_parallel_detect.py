@@ -0,0 +1,49 @@
+from typing import List  # noqa: F401
+
+import numpy as np
+from numpy.typing import NDArray
+import pytest
+
+from vidya.core.motion_detect import MotionDetector
+from vidya.core.parallel_detect import DetectionPool
+from vidya.core.roi import RegionOfInterest
+
+ROIS = {
+    'no_roi': None,
+    'include': RegionOfInterest(include=[[[0.1, 0.2], [0.9, 0.2], [0.9, 0.9], [0.1, 0.9]]]),
+}
+
+
+@pytest.fixture(scope='module')
+def pool() -> DetectionPool:
+    pool = DetectionPool(max_workers=2, chunk_size=3)
+    yield pool
+    pool.shutdown()
+
+
+def detect_in_process(frames: List[NDArray], **kwargs) -> NDArray:
+    md = MotionDetector(**kwargs)
+    return md.batch_motion_detect_with_diff(np.stack([md.downscale(x) for x in frames]))[0]
+
+
+@pytest.mark.parametrize('roi', ROIS.values(), ids=ROIS.keys())
+@pytest.mark.parametrize('detect_width', [None, 80])
+@pytest.mark.parametrize('clip_name', ['clip', 'noise_clip'])
+def test_pool_matches_in_process_detection(pool, roi, detect_width, clip_name, request):
+    frames = request.getfixturevalue(clip_name)
+    expected = detect_in_process(frames, roi=roi, detect_width=detect_width)
+
+    # Uneven chunks, so every chunk but the first relies on its one-frame lead-in
+    masks = pool.detect(MotionDetector(roi=roi, detect_width=detect_width), frames)
+    assert pool._executor is not None
+    np.testing.assert_array_equal(masks, expected)
+    assert expected.any()
+
+
+def test_pool_carries_on_across_calls(pool, clip):
+    expected = detect_in_process(clip)
+
+    md = MotionDetector()
+    # The first batch is small enough to stay in-process; the rest go to the pool
+    masks = [pool.detect(md, clip[start:stop]) for start, stop in ((0, 2), (2, 9), (9, 12))]
+    np.testing.assert_array_equal(np.concatenate(masks), expected)
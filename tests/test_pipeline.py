@@ -0,0 +1,81 @@
+from typing import List  # noqa: F401
+
+from PIL import Image
+import pytest
+
+from vidya.core.pipeline import MotionGate
+
+
+class ScriptedPipeline:
+    """Yields one frame per contour count, recording the counts the way `FramePipeline` does"""
+    def __init__(self, cntrs: List[int]):
+        self.cntrs = cntrs
+        self.cntrs_per_frame = []  # type: List[int]
+        self.n_pulled = 0
+
+    @property
+    def avg_cntrs_per_frame(self) -> float:
+        if len(self.cntrs_per_frame) == 0:
+            return 0
+        return sum(self.cntrs_per_frame) / len(self.cntrs_per_frame)
+
+    def __iter__(self):
+        for n_cntrs in self.cntrs:
+            self.n_pulled += 1
+            self.cntrs_per_frame.append(n_cntrs)
+            yield Image.new('RGB', (2, 2), (n_cntrs, 0, 0))
+
+
+def run_gate(cntrs: List[int], **kwargs):
+    pipeline = ScriptedPipeline(cntrs)
+    gate = MotionGate(pipeline, n_expected=len(cntrs), **kwargs)
+    return gate, pipeline, list(gate)
+
+
+def test_quiet_clip_writes_no_frames():
+    # 5s at 10fps with the default settings
+    gate, pipeline, frames = run_gate([0] * 50)
+    assert frames == []
+    assert gate.skip_reason is not None
+    # Dropped as soon as the buffer filled, rather than recording the rest
+    assert pipeline.n_pulled == MotionGate.MAX_BUFFERED
+
+
+def test_quiet_cutoff_ends_clip_early():
+    gate, pipeline, frames = run_gate([0] * 50, quiet_frames=10)
+    assert frames == []
+    assert gate.skip_reason is not None
+    assert pipeline.n_pulled == 10
+
+
+def test_clip_passes_through_once_threshold_met():
+    cntrs = [0] * 5 + [3] * 2 + [0] * 43
+    gate, pipeline, frames = run_gate(cntrs, min_avg_cntrs=0.1)
+    assert gate.skip_reason is None
+    assert [x.getpixel((0, 0))[0] for x in frames] == cntrs
+
+
+def test_sparse_motion_passes_on_when_buffer_fills_and_is_judged_at_the_end():
+    cntrs = [0] * 10 + [1] + [0] * 39
+    gate, pipeline, frames = run_gate(cntrs, min_avg_cntrs=0.1)
+    # Some motion, so the buffer had to be let through - but the clip still doesn't make the cut
+    assert len(frames) == 50
+    assert gate.skip_reason is not None
+
+
+@pytest.mark.parametrize('cntrs', [[0] * 3 + [1], [0, 0, 1, 0]])
+def test_short_clip_with_enough_motion_is_kept(cntrs):
+    pipeline = ScriptedPipeline(cntrs)
+    # More frames were expected than arrived, so the threshold's never met while buffering
+    gate = MotionGate(pipeline, n_expected=20, min_avg_cntrs=0.1)
+    frames = list(gate)
+    assert gate.skip_reason is None
+    assert len(frames) == len(cntrs)
+
+
+def test_larger_buffer_holds_a_quiet_lead_in():
+    # e.g., pre-roll from before the motion started
+    cntrs = [0] * 40 + [2] * 10
+    gate, pipeline, frames = run_gate(cntrs, max_buffered=MotionGate.MAX_BUFFERED + 20)
+    assert gate.skip_reason is None
+    assert len(frames) == 50
@@ -0,0 +1,31 @@
+import threading
+import time
+
+from vidya.core.registry import CameraRegistry
+
+
+class SlowCamera:
+    """A camera whose login hangs until released, like an unreachable one"""
+    def __init__(self, cam_id: int, release: threading.Event):
+        self.cam_id = cam_id
+        self.release = release
+        self.n_logins = 0
+
+    def ensure_token(self):
+        self.release.wait()
+        self.n_logins += 1
+
+
+def test_warm_up_runs_in_the_background(monkeypatch):
+    release = threading.Event()
+    cams = CameraRegistry([1, 2])
+    monkeypatch.setattr(cams, '_build', lambda cam_id: SlowCamera(cam_id, release))
+
+    start = time.monotonic()
+    thread = cams.start_warm_up()
+    assert time.monotonic() - start < 1
+    assert thread.daemon and thread.is_alive()
+
+    release.set()
+    thread.join(timeout=5)
+    assert [x.n_logins for x in cams.loaded()] == [1, 1]
@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+
+import pytest
+
+from vidya.core import token_cache
+from vidya.core.token_cache import (
+    TokenCache,
+    TokenLease,
+)
+
+
+class FakeLogin:
+    """Stands in for a camera's Login API, handing out numbered tokens"""
+    def __init__(self, lease_seconds: int = 3600, delay: float = 0):
+        self.lease_seconds = lease_seconds
+        self.delay = delay
+        self.n_calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self._lock:
+            self.n_calls += 1
+            return f'token-{self.n_calls}', self.lease_seconds
+
+
+@pytest.fixture
+def shared_redis(monkeypatch, redis_client):
+    monkeypatch.setattr(token_cache, 'get_redis', lambda url=None: redis_client)
+    return redis_client
+
+
+def test_file_lease_is_reused(tmp_path):
+    login = FakeLogin()
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    assert cache.get_token(login) == 'token-1'
+    assert cache.get_token(login) == 'token-1'
+    # Another process picks the lease up from the file rather than logging in again
+    other = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    assert other.get_token(login) == 'token-1'
+    assert login.n_calls == 1
+    assert json.loads(tmp_path.joinpath('cam1').read_text())['token'] == 'token-1'
+
+
+def test_plain_token_file_is_read(tmp_path):
+    tmp_path.joinpath('cam1').write_text('old-token\n')
+    login = FakeLogin()
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    assert cache.get_token(login) == 'old-token'
+    assert login.n_calls == 0
+
+
+def test_expired_lease_is_renewed(tmp_path):
+    login = FakeLogin()
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    cache._store(TokenLease(token='expired', expires_at=time.time() - 1))
+    assert cache.get_token(login) == 'token-1'
+    assert login.n_calls == 1
+
+
+def test_lease_near_its_end_renews_in_background(tmp_path):
+    login = FakeLogin(delay=0.2)
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    cache._store(TokenLease(token='ending', expires_at=time.time() + TokenCache.REFRESH_MARGIN / 2))
+    # The current token is handed out while the renewal runs
+    assert cache.get_token(login) == 'ending'
+    deadline = time.monotonic() + 5
+    while cache.get_token(login) == 'ending' and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert cache.get_token(login) == 'token-1'
+    assert login.n_calls == 1
+
+
+def test_invalidate_only_renews_once_per_rejected_token(tmp_path):
+    login = FakeLogin()
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    other = TokenCache('cam1', file_path=tmp_path.joinpath('cam1'))
+    assert cache.get_token(login) == 'token-1'
+    assert other.get_token(login) == 'token-1'
+
+    assert cache.invalidate('token-1', login) == 'token-2'
+    # The second to report the same token gets the replacement
+    assert other.invalidate('token-1', login) == 'token-2'
+    assert login.n_calls == 2
+
+
+def test_redis_lease_is_shared(tmp_path, shared_redis):
+    login = FakeLogin()
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('a'), redis_url='redis://fake')
+    other = TokenCache('cam1', file_path=tmp_path.joinpath('b'), redis_url='redis://fake')
+    assert cache.get_token(login) == 'token-1'
+    assert other.get_token(login) == 'token-1'
+    assert login.n_calls == 1
+    # Kept in Redis for as long as the lease lasts
+    assert 0 < shared_redis.ttl(f'{TokenCache.KEY_PREFIX}:cam1') <= login.lease_seconds
+
+
+def test_redis_renewal_is_single_flight(tmp_path, shared_redis):
+    login = FakeLogin(delay=0.1)
+    caches = [TokenCache('cam1', file_path=tmp_path.joinpath(str(i)), redis_url='redis://fake') for i in range(5)]
+    tokens = []
+    threads = [threading.Thread(target=lambda c=c: tokens.append(c.get_token(login))) for c in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ['token-1'] * 5
+    assert login.n_calls == 1
+
+
+def test_redis_invalidate(tmp_path, shared_redis):
+    login = FakeLogin()
+    cache = TokenCache('cam1', file_path=tmp_path.joinpath('a'), redis_url='redis://fake')
+    other = TokenCache('cam1', file_path=tmp_path.joinpath('b'), redis_url='redis://fake')
+    assert cache.get_token(login) == 'token-1'
+    assert cache.invalidate('token-1', login) == 'token-2'
+    assert other.invalidate('token-1', login) == 'token-2'
+    assert other.get_token(login) == 'token-2'
+    assert login.n_calls == 2
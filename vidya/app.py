@@ -9,12 +9,25 @@ from vidya.config import (
     DevelopmentConfig,
     ProductionConfig,
 )
-from vidya.core.camera import IPCamera
+from vidya.core.artifacts import ArtifactStore
+from vidya.core.camera_api import QuickCameraAPI
+from vidya.core.coalesce import TriggerCoalescer
+from vidya.core.latest_frame import LatestFrameCache
+from vidya.core.redis_store import get_redis
+from vidya.core.registry import CameraRegistry
 from vidya.log_init import (
     InterceptHandler,
     configure_log,
 )
-from vidya.routes.camera import bp_cam
+from vidya.routes.camera import (
+    TASK_NAME_GIF,
+    TASK_NAME_GROUP_GIF,
+    TASK_NAME_GROUP_SNAPSHOT,
+    TASK_NAME_SNAPSHOT,
+    TASK_NAME_UPLOAD,
+    bp_cam,
+    bp_cams,
+)
 from vidya.routes.helpers import (
     clear_trailing_slash,
     log_after,
@@ -24,7 +37,8 @@ from vidya.routes.main import bp_main
 
 ROUTES = [
     bp_main,
-    bp_cam
+    bp_cam,
+    bp_cams
 ]
 
 
@@ -59,12 +73,32 @@ def create_app(*args, **kwargs) -> Flask:
         app.register_blueprint(ruut)
 
     # Initialize Celery
+    #   Snapshots and gifs go to separate queues so sub-second snapshots never wait behind gifs.
+    #   Priorities (0 = highest) order the two when a worker consumes both queues.
+    snap_route = dict(queue=os.getenv('SNAP_QUEUE', 'snap'), priority=int(os.getenv('SNAP_PRIORITY', '0')))
+    gif_route = dict(queue=os.getenv('GIF_QUEUE', 'gif'), priority=int(os.getenv('GIF_PRIORITY', '6')))
+    #   Uploads get their own queue too, so a slow Slack API never holds up a capture
+    upload_route = dict(queue=os.getenv('UPLOAD_QUEUE', 'upload'), priority=int(os.getenv('UPLOAD_PRIORITY', '3')))
     app.config.from_mapping(
         CELERY=dict(
             broker_url=os.environ['REDIS_URL'],
             broker_connection_retry_on_startup=True,
+            broker_transport_options=dict(
+                priority_steps=list(range(10)),
+                sep=':',
+                queue_order_strategy='priority',
+            ),
             result_backend=os.environ['REDIS_URL'],
             task_ignore_result=True,
+            task_routes={
+                TASK_NAME_SNAPSHOT: snap_route,
+                TASK_NAME_GROUP_SNAPSHOT: snap_route,
+                TASK_NAME_GIF: gif_route,
+                TASK_NAME_GROUP_GIF: gif_route,
+                TASK_NAME_UPLOAD: upload_route,
+            },
+            # Don't let a worker sit on queued tasks while it's busy recording
+            worker_prefetch_multiplier=1,
             timezone='America/Chicago',
         )
     )
@@ -74,13 +108,35 @@ def create_app(*args, **kwargs) -> Flask:
     client = WebClient(token=os.environ['SLACK_BOT_TOKEN'])
     app.extensions.setdefault('slack', client)
 
-    # Load cameras
-    cams = {}
-    for cid in os.environ['CAMS'].split(','):
-        cid = int(cid)
-        cams[cid] = IPCamera(int(cid))
+    # Register cameras - each is only built (and logged in) when first used
+    cams = CameraRegistry([int(cid) for cid in os.environ['CAMS'].split(',')])
     app.extensions.setdefault('cams', cams)
 
+    # Merge repeat triggers for a camera while its capture is still pending / running
+    coalescer = TriggerCoalescer(
+        get_redis(),
+        window=float(os.getenv('TRIGGER_COALESCE_WINDOW', '10')),
+        max_extend_seconds=int(os.getenv('TRIGGER_MAX_EXTEND_SECONDS', '10'))
+    )
+    app.extensions.setdefault('coalescer', coalescer)
+
+    # Encoded captures wait here for the upload queue
+    artifacts = ArtifactStore(get_redis(), ttl=int(os.getenv('ARTIFACT_TTL', '3600')))
+    app.extensions.setdefault('artifacts', artifacts)
+
+    # Latest snapshots for dashboards, fetched straight from the cameras' APIs (no frame decoding here)
+    #   Requests wait on these, so they get short timeouts & no retries, and wait only briefly on another's fetch
+    cam_apis = CameraRegistry(cams.cam_ids, camera_class='vidya.core.camera_api.QuickCameraAPI')
+    app.extensions.setdefault('cam_apis', cam_apis)
+    latest_frames = LatestFrameCache(
+        get_redis(),
+        ttl=float(os.getenv('LATEST_FRAME_TTL', '2')),
+        max_stale=float(os.getenv('LATEST_FRAME_MAX_STALE', '60')),
+        lock_timeout=float(os.getenv('LATEST_FRAME_LOCK_TIMEOUT', '3')),
+        fetch_timeout=QuickCameraAPI.max_snap_seconds()
+    )
+    app.extensions.setdefault('latest_frames', latest_frames)
+
     app.before_request(log_before)
     app.before_request(clear_trailing_slash)
 
@@ -0,0 +1,90 @@
+"""Holds every camera's stream open in one process, writing decoded frames into per-camera shared memory rings
+
+Run this alongside workers started with CAPTURE_SOURCE=RING, and they'll read frames from the rings
+(see `RingCaptureWorker`) rather than each opening the cameras' streams themselves. Capture and processing
+then scale independently - one process decodes each stream however many processes work on its frames.
+
+    python -m vidya.capture_service
+"""
+from concurrent.futures import (  # noqa: F401
+    Future,
+    ThreadPoolExecutor,
+)
+import os
+import signal
+import threading
+from typing import (  # noqa: F401
+    List,
+    Optional,
+)
+
+from loguru import logger
+
+from vidya.app import create_app
+from vidya.core.camera import IPCamera
+from vidya.core.capture import CaptureWorker
+from vidya.core.frame_ring import SharedFrameRing
+from vidya.core.registry import CameraRegistry  # noqa: F401
+
+SLOT_RETRY_DELAY = float(os.getenv('CAPTURE_SLOT_RETRY_DELAY', '5'))
+
+
+def start_capture(cam: IPCamera, ring: SharedFrameRing, stop_event: threading.Event) -> Optional[CaptureWorker]:
+    """Waits for one of the camera's stream slots, then starts capturing it into its ring
+
+    A slot left by a previous run that didn't get to release it frees up once its lease runs out.
+    Returns None if `stop_event` was set before a slot came free.
+    """
+    is_waiting = False
+    while (slot := cam.stream_limiter.acquire(cam.cam_id)) is None:
+        if not is_waiting:
+            logger.warning(f'Camera {cam.cam_name} is at its stream limit - waiting for a slot to capture it.')
+            is_waiting = True
+        if stop_event.wait(SLOT_RETRY_DELAY):
+            return None
+    logger.info(f'Starting capture for camera {cam.cam_name} into frame ring {cam.frame_ring_name}')
+    worker = CaptureWorker(
+        rtsp_url=cam.rtsp_url,
+        name=cam.cam_name,
+        idle_timeout=0,
+        ring=ring,
+        background=cam.background,
+        slot=slot
+    )
+    worker.start()
+    return worker
+
+
+def main():
+    app = create_app()
+    cams = app.extensions['cams']  # type: CameraRegistry
+    n_slots = int(os.getenv('FRAME_RING_SLOTS', '16'))
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop_event.set())
+
+    starts = []  # type: List[Future]
+    # Each camera waits on its own slot, so one at its limit doesn't hold up the rest (or shutting down)
+    executor = ThreadPoolExecutor(max_workers=max(len(cams), 1), thread_name_prefix='start-capture')
+    for cam in cams.values():
+        ring = SharedFrameRing(name=cam.frame_ring_name, n_slots=n_slots)
+        try:
+            ring.check_unused()
+        except FileExistsError as exc:
+            logger.error(f'{exc} - not capturing camera {cam.cam_name}. Is another capture service running?')
+            continue
+        starts.append(executor.submit(start_capture, cam, ring, stop_event))
+
+    stop_event.wait()
+    logger.info('Stopping capture...')
+    executor.shutdown()
+    workers = [x.result() for x in starts if x.result() is not None]  # type: List[CaptureWorker]
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.join(timeout=CaptureWorker.RECONNECT_DELAY * 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,84 +1,348 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import StrEnum
+import io
 import os
-from typing import List  # noqa: F401
+import time
+from typing import (
+    Callable,
+    List,
+    Optional,
+    Tuple,
+)
 
-from celery import Celery  # noqa: F401
+from celery import (  # noqa: F401
+    Celery,
+    Task,
+)
+from celery.concurrency.prefork import TaskPool as PreforkPool
 from celery.result import AsyncResult  # noqa: F401
+from celery.signals import (
+    worker_process_init,
+    worker_ready,
+)
+from celery.worker.consumer import Consumer  # noqa: F401
 from celery.worker.request import Request  # noqa: F401
 from loguru import logger
+from slack_sdk.errors import SlackApiError
 
-from vidya import ROOT
 from vidya.app import create_app
+from vidya.core.artifacts import Artifact
+from vidya.core.camera import IPCamera
+from vidya.core.capture import CaptureSource
+from vidya.core.coalesce import TriggerMode
+from vidya.core.encode import get_stream_writer
+from vidya.core.formats import OutputFormat
 from vidya.core.notify import upload_to_slack
+from vidya.core.parallel_detect import DetectionPool
+from vidya.core.pipeline import MotionGate
+from vidya.core.registry import CameraRegistry  # noqa: F401
+from vidya.core.stream_limit import StreamLimitReached
 from vidya.routes.helpers import (
     build_motion_message,
+    get_artifact_store,
     get_cam,
+    get_coalescer,
     get_slack_client,
 )
 
-BASE_PATH = ROOT.joinpath('snaps')
+# When a camera's already at its stream limit, gif tasks retry this often, this many times
+STREAM_RETRY_DELAY = int(os.getenv('STREAM_RETRY_DELAY', '2'))
+STREAM_MAX_RETRIES = int(os.getenv('STREAM_MAX_RETRIES', '15'))
+# Clips averaging fewer contours per frame than this are dropped
+MIN_AVG_CNTRS = float(os.getenv('GIF_MIN_AVG_CONTOURS', '0.1'))
+# Stop recording a clip that's shown no motion for this long (0 to always record in full)
+QUIET_SECONDS = float(os.getenv('GIF_QUIET_SECONDS', '0'))
+# Failed uploads retry after this many seconds, doubling each time (unless Slack says how long to wait)
+UPLOAD_RETRY_DELAY = int(os.getenv('UPLOAD_RETRY_DELAY', '5'))
+UPLOAD_MAX_RETRIES = int(os.getenv('UPLOAD_MAX_RETRIES', '6'))
+# Spreads GIF motion detection over DETECT_PROCESSES processes (None: detect in the task's own thread)
+detection_pool = DetectionPool.from_env()  # type: Optional[DetectionPool]
 app = create_app()
 celery_app = app.extensions['celery']  # type: Celery
 
 
+@worker_process_init.connect
+def warm_up_cameras(**kwargs):
+    """Logs in to all cameras concurrently in each new worker process
+
+    This runs in the background: the pool kills a child that takes longer than `worker_proc_alive_timeout`
+    (4s by default) to start, and an unreachable camera takes longer than that to give up on.
+    """
+    cams = app.extensions['cams']  # type: CameraRegistry
+    cams.start_warm_up()
+
+
+@worker_ready.connect
+def start_background_capture(sender: Consumer, **kwargs):
+    """Opens streams up front for cameras with a pre-roll buffer or background model, so they're already
+    filled / learned when a trigger arrives
+
+    Only done by the worker started with CAPTURE_WARM_UP (the gif worker), so snapshot & upload workers never
+    open a stream. That worker has to run its tasks in this one process (`--pool threads` or `--pool solo`),
+    or every prefork child would keep its own stream and buffers. With CAPTURE_SOURCE=RING the capture
+    service is what holds the streams, and workers attach to its rings on their first capture.
+    """
+    if os.getenv('CAPTURE_WARM_UP', 'false').lower() not in ('1', 'true', 'yes'):
+        return
+    if isinstance(sender.pool, PreforkPool):
+        logger.warning('CAPTURE_WARM_UP needs a threads or solo pool - not starting background capture.')
+        return
+    cams = app.extensions['cams']  # type: CameraRegistry
+    cams.warm_up()
+    for cam in cams.loaded():
+        if cam.capture_source == CaptureSource.RING:
+            continue
+        if cam.pre_roll is not None or cam.background is not None:
+            logger.info(f'Starting background capture for camera {cam.cam_name}')
+            try:
+                cam.capture()
+            except StreamLimitReached as exc:
+                logger.warning(f'{exc} - not starting background capture.')
+
+
 class CaptureMode(StrEnum):
     SNAP_ONLY = 'SNAP_ONLY'
     GIF_ONLY = 'GIF_ONLY'
     SNAP_AND_GIF = 'SNAP_AND_GIF'
 
 
+def capture_snapshot(cam: IPCamera, quality: int = 35, is_optimize: bool = True) -> Tuple[Artifact, int]:
+    """Takes a motion-annotated snapshot and encodes it, returning it and its contour count"""
+    img, n_ctrs = cam.snap_with_motion(target_width=cam.output_width)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, optimize=is_optimize)
+    return Artifact.new(f'cam_{cam.cam_id}_snap', 'jpg', buf.getvalue()), n_ctrs
+
+
+def capture_gif(cam: IPCamera, take_seconds: int = 5, quality: int = 35, fps: int = 10,
+                extra_seconds: Optional[Callable[[], int]] = None, on_frame: Optional[Callable[[], None]] = None,
+                output_format: OutputFormat = OutputFormat.GIF) -> Tuple[Optional[Artifact], float]:
+    """Records a motion-annotated GIF (or WebP / MP4) and encodes it, returning it and its average
+    contours per frame
+
+    Clips without enough motion (see MotionGate) aren't encoded or kept - None is returned for those.
+
+    Args:
+        extra_seconds: if given, polled once the recording is due to end; recording carries on for
+            however many more seconds it returns
+        on_frame: if given, called for each frame the gate lets through (e.g., to renew a lease while recording)
+    """
+    output_format = OutputFormat(output_format)
+
+    n_frames = take_seconds * fps
+    logger.info(f'Generating {output_format} of {take_seconds}s ({n_frames} frames) for camera {cam.cam_name}')
+    extra_frames = None if extra_seconds is None else (lambda: extra_seconds() * fps)
+    pipeline = cam.stream_gif_with_motion(n_frames, target_width=cam.output_width, extra_frames=extra_frames,
+                                          detection_pool=detection_pool, fps=fps)
+
+    # Pre-roll comes before the motion that triggered the clip, so the gate holds it on top of its usual buffer
+    n_pre_roll = 0 if cam.pre_roll is None else int(cam.pre_roll.seconds * fps)
+    gate = MotionGate(pipeline, n_expected=n_frames, min_avg_cntrs=MIN_AVG_CNTRS,
+                      quiet_frames=int(QUIET_SECONDS * fps), max_buffered=MotionGate.MAX_BUFFERED + n_pre_roll)
+
+    # Frames are encoded as the gate lets them through, so only a few raw frames are ever in memory.
+    #   The writer's only opened once the first frame gets through, so quiet clips are never encoded.
+    buf = io.BytesIO()
+    writer = None
+    try:
+        for frame in gate:
+            if writer is None:
+                logger.debug(f'Encoding {output_format}...')
+                writer = get_stream_writer(output_format, buf, fps=fps, quality=quality)
+            writer.write(frame)
+            if on_frame is not None:
+                on_frame()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if gate.skip_reason is not None:
+        logger.info(f'Dropping {output_format} for camera {cam.cam_name}: {gate.skip_reason}')
+        return None, pipeline.avg_cntrs_per_frame
+    return Artifact.new(f'cam_{cam.cam_id}_motion', output_format, buf.getvalue()), pipeline.avg_cntrs_per_frame
+
+
+def capture_gif_limited(cam: IPCamera, **kwargs) -> Tuple[Optional[Artifact], float]:
+    """capture_gif, once the camera's stream is open here (waiting on a slot as long as a task would retry)"""
+    cam.capture(wait=STREAM_RETRY_DELAY * STREAM_MAX_RETRIES)
+    return capture_gif(cam, **kwargs)
+
+
+def capture_concurrently(cams: List[IPCamera], capture_func: Callable, **kwargs) -> List[Tuple[IPCamera, Tuple]]:
+    """Runs capture_func for every camera at once, so the group takes as long as its slowest camera
+
+    Cameras that fail are logged and left out of the results rather than failing the whole group.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=len(cams)) as executor:
+        futures = [(cam, executor.submit(capture_func, cam, **kwargs)) for cam in cams]
+        for cam, future in futures:
+            try:
+                results.append((cam, future.result()))
+            except Exception:
+                logger.exception(f'Capture failed for camera {cam.cam_name}')
+    return results
+
+
+def queue_upload(artifacts: List[Artifact], channel: str, text: str = ''):
+    """Hands artifacts over to the upload queue, freeing up this worker as soon as they're encoded"""
+    store = get_artifact_store()
+    event_ids = [store.put(x) for x in artifacts]
+    logger.debug(f'Queueing upload of {len(event_ids)} artifact(s): {", ".join(event_ids)}')
+    upload_artifacts.delay(event_ids=event_ids, channel=channel, text=text)
+
+
+@celery_app.task(bind=True, max_retries=UPLOAD_MAX_RETRIES)
+def upload_artifacts(self: Task, event_ids: List[str], channel: str, text: str = ''):
+    """Uploads stored artifacts to Slack as a single message, backing off when Slack is struggling"""
+    store = get_artifact_store()
+    artifacts = [x for x in (store.get(event_id) for event_id in event_ids) if x is not None]
+    if len(artifacts) < len(event_ids):
+        logger.warning(f'{len(event_ids) - len(artifacts)} artifact(s) expired before they could be uploaded.')
+    if len(artifacts) == 0:
+        return
+
+    backoff = UPLOAD_RETRY_DELAY * 2 ** self.request.retries
+    try:
+        upload_to_slack(artifacts, slack_client=get_slack_client(), channel=channel, text=text)
+    except SlackApiError as exc:
+        status = exc.response.status_code
+        if status == 429:
+            # Rate limited - Slack says how long to hold off for
+            headers = exc.response.headers
+            countdown = int(headers.get('Retry-After', headers.get('retry-after', backoff)))
+        elif status >= 500:
+            countdown = backoff
+        else:
+            logger.error(f'Slack rejected upload of {", ".join(event_ids)}: {exc.response.get("error")}')
+            store.delete(event_ids)
+            return
+        logger.warning(f'Upload failed with status {status}. Retrying in {countdown}s.')
+        raise self.retry(exc=exc, countdown=countdown)
+    except OSError as exc:
+        # Connection trouble
+        logger.warning(f'Upload failed ({exc}). Retrying in {backoff}s.')
+        raise self.retry(exc=exc, countdown=backoff)
+    store.delete(event_ids)
+
+
 @celery_app.task
 def take_snapshot(cam_id: id, detection_type: str, detection_time: str, quality: int = 35,
-                  is_optimize: bool = True):
+                  is_optimize: bool = True, claim_token: Optional[str] = None):
     cam = get_cam(cam_id)
     logger.debug(f'Handling SNAP for camera: {cam.cam_name}')
 
-    snap_img_path = BASE_PATH.joinpath(f'cam_{cam_id}_snap.jpg')
-
-    img, n_ctrs = cam.snap_with_motion()
+    coalescer = get_coalescer()
+    # However long this sat in the queue, keep coalescing triggers into it until it's done
+    coalescer.renew(cam_id, TriggerMode.SNAP, claim_token, seconds=coalescer.window)
+    try:
+        artifact, n_ctrs = capture_snapshot(cam, quality=quality, is_optimize=is_optimize)
+    finally:
+        # Triggers from here on get a fresh snapshot
+        coalescer.release(cam_id, TriggerMode.SNAP, claim_token)
 
-    img.save(snap_img_path, quality=quality, optimize=is_optimize)
-
-    logger.debug('Uploading to slack...')
-    upload_to_slack(
-        snap_img_path,
-        slack_client=get_slack_client(),
+    queue_upload(
+        [artifact],
         channel=cam.slack_channel,
         text=build_motion_message(detection_type, cam, detection_time, cnts=n_ctrs)
     )
 
 
-@celery_app.task
-def take_gif(cam_id: id, detection_type: str, detection_time: str, take_seconds: int = 5, quality: int = 35,
-             fps: int = 10):
+@celery_app.task(bind=True, max_retries=STREAM_MAX_RETRIES)
+def take_gif(self: Task, cam_id: id, detection_type: str, detection_time: str, take_seconds: int = 5,
+             quality: int = 35, fps: int = 10, output_format: str = OutputFormat.GIF,
+             claim_token: Optional[str] = None):
     cam = get_cam(cam_id)
     logger.debug(f'Handling GIF for camera: {cam.cam_name}')
 
-    gif_path = BASE_PATH.joinpath(f'cam_{cam_id}_motion.gif')
+    coalescer = get_coalescer()
+    # However long this sat in the queue, hold the claim for as long as the recording could run (extensions
+    #   included), so triggers during it are coalesced rather than queueing another. It's renewed as frames
+    #   come in, in case the capture runs longer than that (e.g., waiting on the stream).
+    claim_seconds = coalescer.window + take_seconds + coalescer.max_extend_seconds
+    coalescer.renew(cam_id, TriggerMode.GIF, claim_token, seconds=claim_seconds)
+    last_renewed = time.monotonic()
+    extended_seconds = 0
 
-    n_frames = take_seconds * fps
-    logger.info(f'Generating gif of {take_seconds}s ({n_frames} frames)')
-    completed_frames, avg_cnts_per_frame = cam.stream_gif_with_motion(n_frames)
-
-    logger.debug('Saving gif...')
-    # PIL method
-    completed_frames[0].save(
-        gif_path,
-        save_all=True,
-        append_images=completed_frames[1:],
-        optimize=True,
-        quality=quality,
-        duration=100,
-        loop=0
-    )
+    def keep_claim():
+        """Renews the claim once a third of the window has passed since it was last renewed"""
+        nonlocal last_renewed
+        if time.monotonic() - last_renewed >= coalescer.window / 3:
+            coalescer.renew(cam_id, TriggerMode.GIF, claim_token, seconds=claim_seconds)
+            last_renewed = time.monotonic()
+
+    def extra_seconds() -> int:
+        """Takes up extensions asked for by coalesced triggers, up to the coalescer's limit"""
+        nonlocal extended_seconds
+        keep_claim()
+        seconds = min(coalescer.pop_extension(cam_id, TriggerMode.GIF),
+                      coalescer.max_extend_seconds - extended_seconds)
+        extended_seconds += seconds
+        return seconds
+
+    try:
+        # Opens the stream here (holding one of the camera's slots), unless it's already open in this process
+        cam.capture()
+    except StreamLimitReached:
+        if self.request.retries < self.max_retries:
+            logger.info(f'Camera {cam.cam_name} is at its stream limit. Retrying in {STREAM_RETRY_DELAY}s.')
+            # The trigger claim stays put, so new triggers still coalesce into this retry
+            raise self.retry(countdown=STREAM_RETRY_DELAY)
+        logger.warning(f'Camera {cam.cam_name} stayed at its stream limit. Giving up on gif.')
+        coalescer.release(cam_id, TriggerMode.GIF, claim_token)
+        return
+    try:
+        artifact, avg_cnts_per_frame = capture_gif(cam, take_seconds=take_seconds, quality=quality, fps=fps,
+                                                   extra_seconds=extra_seconds, on_frame=keep_claim,
+                                                   output_format=output_format)
+    finally:
+        coalescer.release(cam_id, TriggerMode.GIF, claim_token)
 
-    if avg_cnts_per_frame < 0.1:
-        logger.info(f'Average contours per frame ({avg_cnts_per_frame}) was below threshold (0.1). Skipping upload.')
+    if artifact is None:
+        logger.info('Not enough motion in clip. Skipping upload.')
     else:
-        logger.info('Uploading gif to Slack...')
-        upload_to_slack(
-            gif_path,
-            slack_client=get_slack_client(),
+        queue_upload(
+            [artifact],
             channel=os.getenv('GIF_CHANNEL', cam.slack_channel),
             text=build_motion_message(detection_type, cam, detection_time, avg_cnts_per_frame=avg_cnts_per_frame)
         )
+
+
+@celery_app.task
+def take_group_snapshot(cam_ids: List[int], detection_type: str, detection_time: str, quality: int = 35,
+                        is_optimize: bool = True):
+    cams = [get_cam(cam_id) for cam_id in cam_ids]
+    logger.debug(f'Handling group SNAP for cameras: {", ".join(x.cam_name for x in cams)}')
+
+    results = capture_concurrently(cams, capture_snapshot, quality=quality, is_optimize=is_optimize)
+    if len(results) == 0:
+        logger.warning('No snapshots were captured. Skipping upload.')
+        return
+
+    queue_upload(
+        [artifact for _, (artifact, _) in results],
+        channel=os.getenv('GROUP_CHANNEL', cams[0].slack_channel),
+        text='\n'.join(build_motion_message(detection_type, cam, detection_time, cnts=n_ctrs)
+                       for cam, (_, n_ctrs) in results)
+    )
+
+
+@celery_app.task
+def take_group_gif(cam_ids: List[int], detection_type: str, detection_time: str, take_seconds: int = 5,
+                   quality: int = 35, fps: int = 10, output_format: str = OutputFormat.GIF):
+    cams = [get_cam(cam_id) for cam_id in cam_ids]
+    logger.debug(f'Handling group GIF for cameras: {", ".join(x.cam_name for x in cams)}')
+
+    results = capture_concurrently(cams, capture_gif_limited, take_seconds=take_seconds, quality=quality, fps=fps,
+                                   output_format=output_format)
+    results = [(cam, (artifact, avg)) for cam, (artifact, avg) in results if artifact is not None]
+    if len(results) == 0:
+        logger.info(f'No gifs had enough contours per frame ({MIN_AVG_CNTRS}). Skipping upload.')
+        return
+
+    queue_upload(
+        [artifact for _, (artifact, _) in results],
+        channel=os.getenv('GROUP_CHANNEL', os.getenv('GIF_CHANNEL', cams[0].slack_channel)),
+        text='\n'.join(build_motion_message(detection_type, cam, detection_time, avg_cnts_per_frame=avg)
+                       for cam, (_, avg) in results)
+    )
@@ -0,0 +1,57 @@
+from typing import (  # noqa: F401
+    List,
+    NamedTuple,
+    Optional,
+)
+import uuid
+
+import redis
+
+
+class Artifact(NamedTuple):
+    """An encoded capture, held in memory and identified by the event that produced it"""
+    event_id: str
+    filename: str
+    content: bytes
+
+    @classmethod
+    def new(cls, prefix: str, extension: str, content: bytes) -> 'Artifact':
+        """Wraps freshly-encoded content with a new event id, which also keeps its filename unique"""
+        event_id = uuid.uuid4().hex
+        return cls(event_id=event_id, filename=f'{prefix}_{event_id}.{extension}', content=content)
+
+
+class ArtifactStore:
+    """Holds artifacts in Redis between the capture task that made them and the task that uploads them
+
+    Only the event id travels through the task queue. Artifacts expire after `ttl` seconds, so ones
+    that never get uploaded don't pile up.
+    """
+    KEY_PREFIX = 'vidya:artifact'
+
+    def __init__(self, redis_client: redis.Redis, ttl: int = 3600):
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    def _key(self, event_id: str) -> str:
+        return f'{self.KEY_PREFIX}:{event_id}'
+
+    def put(self, artifact: Artifact) -> str:
+        """Stores the artifact, returning its event id"""
+        key = self._key(artifact.event_id)
+        with self.redis_client.pipeline() as pipe:
+            pipe.hset(key, mapping={'filename': artifact.filename, 'content': artifact.content})
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        return artifact.event_id
+
+    def get(self, event_id: str) -> Optional[Artifact]:
+        """Returns the artifact, or None if it's expired or was never stored"""
+        stored = self.redis_client.hgetall(self._key(event_id))
+        if len(stored) == 0:
+            return None
+        return Artifact(event_id=event_id, filename=stored[b'filename'].decode(), content=stored[b'content'])
+
+    def delete(self, event_ids: List[str]):
+        if len(event_ids) > 0:
+            self.redis_client.delete(*[self._key(x) for x in event_ids])
@@ -0,0 +1,154 @@
+import os
+from pathlib import Path
+import threading
+import time
+from typing import (  # noqa: F401
+    Optional,
+    Tuple,
+)
+
+import cv2
+from loguru import logger
+from numpy.typing import NDArray
+
+from vidya.core.motion_detect import MotionDetector
+
+
+class BackgroundModel:
+    """A camera's background subtraction (MOG2) model, kept warm for as long as the worker runs
+
+    A fresh subtractor needs many frames before it knows the scene, so rather than starting one per
+    capture, each camera keeps one that its capture worker feeds a few frames a second (see `learn`).
+    Snapshots and GIFs then detect against a model that already knows the scene, and slow changes
+    like lighting flicker are part of the background rather than motion.
+
+    The learned background image is saved to `state_path` every so often and used to seed the model
+    when the worker restarts. (OpenCV can't serialize the model itself, so the seeded model starts
+    from the background's appearance alone and relearns its variance from there.) Only the process
+    holding the camera's stream learns; models in other processes pick up its saves (see `refresh`).
+
+    Frames are greyed, blurred & scaled to `width` before going in, so frames of any size and either
+    color order can be checked, as long as they have the same aspect ratio as the learned ones.
+    """
+    HISTORY = 500           # Frames the model remembers
+    VAR_THRESHOLD = 16      # How far (squared) a pixel can stray from the model before it's foreground
+    SAVE_INTERVAL = 300     # Seconds between saves of the learned background
+    REFRESH_INTERVAL = 30   # Seconds between checks for a newer saved background
+
+    def __init__(self, width: int, learn_fps: float = 2.0, state_path: Optional[Path] = None):
+        self.width = width
+        self.learn_interval = 1 / learn_fps
+        self.state_path = state_path
+        self._subtractor = cv2.createBackgroundSubtractorMOG2(
+            history=self.HISTORY, varThreshold=self.VAR_THRESHOLD, detectShadows=False)
+        self._lock = threading.Lock()
+        self._shape = None  # type: Optional[Tuple[int, int]]
+        self._last_applied = 0.0
+        self._last_learned = float('-inf')
+        self._last_saved = time.monotonic()
+        self._last_checked = time.monotonic()
+        self._state_mtime = 0.0
+        self._restore()
+
+    @property
+    def is_ready(self) -> bool:
+        return self._shape is not None
+
+    def _prep(self, frame: NDArray, is_rgb: bool) -> NDArray:
+        h, w = frame.shape[:2]
+        if w != self.width:
+            frame = cv2.resize(frame, (self.width, round(h * self.width / w)), interpolation=cv2.INTER_AREA)
+        if frame.ndim == 3:
+            if frame.shape[2] == 4:
+                frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY if is_rgb else cv2.COLOR_BGRA2GRAY)
+            else:
+                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY if is_rgb else cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(src=frame, ksize=MotionDetector.DEFAULT_KERNEL_SIZE, sigmaX=0)
+
+    def _restore(self):
+        if self.state_path is None or not self.state_path.exists():
+            return
+        self._state_mtime = self.state_path.stat().st_mtime
+        background = cv2.imread(str(self.state_path), cv2.IMREAD_GRAYSCALE)
+        if background is None or background.shape[1] != self.width:
+            logger.warning(f'Ignoring unusable background at {self.state_path}')
+            return
+        with self._lock:
+            # A learning rate of 1 replaces the model with this frame
+            self._subtractor.apply(background, learningRate=1)
+            self._shape = background.shape
+        logger.debug(f'Restored background model from {self.state_path}')
+
+    def save(self):
+        """Writes the learned background out so a restarted worker (or another process) can pick up from it
+
+        It's written to a temporary file that then replaces the old one, so readers never see it half-written.
+        """
+        if self.state_path is None or not self.is_ready:
+            return
+        with self._lock:
+            background = self._subtractor.getBackgroundImage()
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        # Keeps the extension, as that's what tells OpenCV how to encode it
+        tmp_path = self.state_path.with_name(f'.{self.state_path.stem}.{os.getpid()}.tmp{self.state_path.suffix}')
+        if not cv2.imwrite(str(tmp_path), background):
+            logger.warning(f'Unable to save background model to {tmp_path}')
+            return
+        os.replace(tmp_path, self.state_path)
+        self._state_mtime = self.state_path.stat().st_mtime
+        self._last_saved = time.monotonic()
+
+    def refresh(self):
+        """Reloads the saved background if it's newer than what this model has, unless this model is learning
+
+        For processes that use the model without feeding it (see `learn`), so they follow the one that does.
+        Checks the file at most every `REFRESH_INTERVAL` seconds.
+        """
+        now = time.monotonic()
+        if (self.state_path is None or now - self._last_learned < self.SAVE_INTERVAL
+                or now - self._last_checked < self.REFRESH_INTERVAL):
+            return
+        self._last_checked = now
+        try:
+            mtime = self.state_path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if mtime > self._state_mtime:
+            self._restore()
+
+    def learn(self, frame: NDArray, is_rgb: bool = False):
+        """Feeds a frame from the live stream into the model, skipping it if the model has had one too recently
+
+        The stream is what defines the model's size - a frame that doesn't match it starts the model over.
+        Only the process that holds the camera's stream should call this, as it's the one that saves.
+        """
+        now = time.monotonic()
+        if now - self._last_applied < self.learn_interval:
+            return
+        prepped = self._prep(frame, is_rgb=is_rgb)
+        with self._lock:
+            if prepped.shape != self._shape:
+                logger.debug(f'Background model (re)starting at {prepped.shape[1]}x{prepped.shape[0]}')
+                self._shape = prepped.shape
+            self._subtractor.apply(prepped)
+            self._last_applied = now
+            self._last_learned = now
+        if self.state_path is not None and now - self._last_saved > self.SAVE_INTERVAL:
+            self.save()
+
+    def apply(self, frame: NDArray, is_rgb: bool = False) -> Optional[NDArray]:
+        """Returns the frame's foreground mask (at the frame's size), leaving the model as it is
+
+        The frames being checked come off the same stream `learn` is fed from, so learning from them here
+        too would count them twice. None if the model hasn't learned anything yet or the frame doesn't fit
+        it (different aspect ratio).
+        """
+        h, w = frame.shape[:2]
+        prepped = self._prep(frame, is_rgb=is_rgb)
+        with self._lock:
+            if prepped.shape != self._shape:
+                return None
+            fg_mask, _ = MotionDetector.motion_detect_with_bgsub(prepped, bg_sub=self._subtractor, learning_rate=0)
+        if fg_mask.shape != (h, w):
+            fg_mask = cv2.resize(fg_mask, (w, h), interpolation=cv2.INTER_NEAREST)
+        return fg_mask
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import os
-import random
-import string
+import threading
+import time
 from typing import (
+    Callable,
+    Iterator,
     List,
     Optional,
     Tuple,
@@ -12,136 +16,309 @@ import cv2
 import imutils
 from loguru import logger
 import numpy as np
-import requests
 
 from vidya import ROOT
+from vidya.core.background import BackgroundModel
+from vidya.core.camera_api import CameraAPI
+from vidya.core.capture import (
+    CaptureSource,
+    CaptureWorker,
+    FrameRingBuffer,
+    RingCaptureWorker,
+)
 from vidya.core.motion_detect import (
     GIFHandleMethod,
     MotionDetectionType,
     MotionDetector,
+    RegionExtractionType,
+)
+from vidya.core.parallel_detect import DetectionPool
+from vidya.core.pipeline import FramePipeline
+from vidya.core.redis_store import get_redis
+from vidya.core.roi import RegionOfInterest
+from vidya.core.stream_limit import (
+    StreamLimiter,
+    StreamLimitReached,
+)
+
+# JPEG start-of-frame markers (baseline, extended, progressive, lossless...) - these carry the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Scale factors libjpeg can decode at directly, largest first
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
 )
 
 
-class IPCamera:
+def jpeg_size(buf: memoryview) -> Optional[Tuple[int, int]]:
+    """Reads (width, height) from a JPEG's start-of-frame header without decoding it"""
+    if len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(buf):
+        if buf[i] != 0xFF:
+            return None
+        marker = buf[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        seg_len = (buf[i + 2] << 8) + buf[i + 3]
+        if marker in _JPEG_SOF_MARKERS:
+            height = (buf[i + 5] << 8) + buf[i + 6]
+            width = (buf[i + 7] << 8) + buf[i + 8]
+            return width, height
+        i += 2 + seg_len
+    return None
+
+
+def decode_jpeg(content: bytes, target_width: Optional[int] = None) -> Optional[np.typing.NDArray]:
+    """Decodes a JPEG to BGR, at no more than the resolution needed for target_width
+
+    When the image is at least twice as wide as needed, libjpeg is asked to decode at 1/2, 1/4 or 1/8 scale,
+    which skips most of the decode work; whatever scaling is left over is done with `cv2.resize`.
+    The buffer is read in place rather than copied.
+    """
+    buf = np.frombuffer(content, dtype=np.uint8)
+    flag = cv2.IMREAD_COLOR
+    if target_width is not None and (size := jpeg_size(memoryview(content))) is not None:
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            if size[0] // factor >= target_width:
+                flag = reduced_flag
+                break
+    img_arr = cv2.imdecode(buf, flag)
+    if img_arr is None or target_width is None or img_arr.shape[1] == target_width:
+        return img_arr
+    ratio = img_arr.shape[1] / target_width
+    return cv2.resize(img_arr, (int(img_arr.shape[1] / ratio), int(img_arr.shape[0] / ratio)),
+                      interpolation=cv2.INTER_AREA)
+
+
+class IPCamera(CameraAPI):
     DEFAULT_WIDTH = 640
 
     def __init__(self, cam_id: int):
-        self.ip_subnet = os.environ['IP_SUBNET']
-        self.cam_id = cam_id
-        self._usr = os.environ[f'CAM_{cam_id}_USR']
-        self._pwd = os.environ[f'CAM_{cam_id}_PWD']
-        self.cam_name = os.environ[f'CAM_{cam_id}_NAME']
-        self.cam_ip = f'192.168.{self.ip_subnet}.{self.cam_id}'
-        self.channel = int(os.environ[f'CAM_{cam_id}_CHANNEL'])
+        super().__init__(cam_id)
         self.stream_name = os.environ[f'CAM_{cam_id}_STREAM']
-        self.slack_channel = os.environ[f'CAM_{cam_id}_SLACK']
-        self._base_url = f'http://{self.cam_ip}/cgi-bin/api.cgi?'
-
-        self.token = None
-        self.token_file = ROOT.joinpath(f'.sessions/{self.cam_id}_{self.cam_name}')
-        if self.token_file.exists():
-            logger.info(f'Reading in existing token for camera {self.cam_name}.')
-            self.token = self.token_file.read_text()
-        else:
-            self.login()
-
-        self.rs = ''.join(random.choice(string.ascii_letters) for _ in range(24))
-
-    def login(self):
-        logger.info(f'Generating new token for camera {self.cam_name}.')
-        resp = requests.post(f'{self._base_url}cmd=Login', json=[{
-            'cmd': 'Login',
-            'param': {
-                'User': {
-                    'Version': '0',
-                    'userName': self._usr,
-                    'password': self._pwd
-                }
-            }
-        }])
-        self.token = resp.json()[0]['value']['Token']['name']
-        self.token_file.write_text(self.token)
-
-    def _snap_req(self) -> np.typing.NDArray:
-        # logger.debug('Taking snap...')
-        resp = requests.get(f'{self._base_url}cmd=Snap&channel=0&rs={self.rs}&token={self.token}')
-        img_arr = cv2.imdecode(np.asanyarray(bytearray(resp.content), dtype=np.uint8), -1)
-        # logger.debug('Completed snap...')
+        # Low-resolution stream for continuous watching (see vidya.motion_daemon), if the camera has one
+        self.substream_name = os.getenv(f'CAM_{cam_id}_SUBSTREAM', self.stream_name)
+        # Spacing between the snapshots compared in snap_with_motion
+        self.snap_interval = float(os.getenv('SNAP_BURST_INTERVAL', '0.2'))
+        self.region_type = RegionExtractionType(os.getenv('MOTION_REGION_TYPE', RegionExtractionType.CONTOURS))
+        # Where motion counts (None: anywhere)
+        self.roi = RegionOfInterest.from_env(cam_id)
+        # Snapshots & GIFs are delivered at output_width, but motion can be detected on a smaller copy
+        self.output_width = int(os.getenv(f'CAM_{cam_id}_OUTPUT_WIDTH', os.getenv('OUTPUT_WIDTH', self.DEFAULT_WIDTH)))
+        self.detect_width = int(os.getenv('MOTION_DETECT_WIDTH', '0')) or None  # type: Optional[int]
+        if self.detect_width is not None and self.detect_width >= self.output_width:
+            self.detect_width = None
+
+        self._capture = None  # type: Optional[CaptureWorker]
+        self._capture_lock = threading.Lock()
+        self.capture_idle_timeout = float(os.getenv('CAPTURE_IDLE_TIMEOUT', '300'))
+        # Where capture workers get frames from - the stream itself, or the capture service's shared memory ring
+        self.capture_source = CaptureSource(os.getenv('CAPTURE_SOURCE', CaptureSource.RTSP))
+        self.frame_ring_name = f'vidya_cam_{self.cam_id}'
+        # Every stream opened on the camera, by any process, holds one of its slots
+        self.stream_limiter = StreamLimiter.from_env(get_redis())
+
+        # Pre-roll: keep the last few seconds of frames around so GIFs can include the moments before a trigger
+        self.pre_roll = None  # type: Optional[FrameRingBuffer]
+        pre_roll_seconds = float(os.getenv(f'CAM_{cam_id}_PRE_ROLL_SECONDS', os.getenv('PRE_ROLL_SECONDS', '0')))
+        if pre_roll_seconds > 0:
+            self.pre_roll = FrameRingBuffer(
+                seconds=pre_roll_seconds,
+                fps=float(os.getenv('PRE_ROLL_FPS', '10')),
+                width=self.output_width,
+                max_bytes=int(os.getenv('PRE_ROLL_MAX_MB', '64')) * 1024 ** 2
+            )
+            # The buffer is only useful if the stream is already open when motion starts
+            self.capture_idle_timeout = 0
+
+        # Background subtraction: the model keeps learning the scene from the stream between captures
+        self.detection_type = MotionDetectionType(
+            os.getenv(f'CAM_{cam_id}_DETECTION_TYPE', os.getenv('MOTION_DETECTION_TYPE', MotionDetectionType.DIFF)))
+        self.background = None  # type: Optional[BackgroundModel]
+        if self.detection_type == MotionDetectionType.BGSUB:
+            self.background = BackgroundModel(
+                width=self.detect_width or self.output_width,
+                learn_fps=float(os.getenv('BGSUB_LEARN_FPS', '2')),
+                state_path=ROOT.joinpath(f'.background/{self.cam_id}_{self.cam_name}.png')
+            )
+            self.capture_idle_timeout = 0
+
+    def _snap_req(self, target_width: Optional[int] = None) -> np.typing.NDArray:
+        img_arr = decode_jpeg(self.snap_jpeg(), target_width=target_width)
         if img_arr is None:
-            resp_dict = resp.json()[0]
-            if err_dict := resp_dict.get('error'):
-                err_text = 'Unexpected error: {detail}: {rspCode}'.format(**err_dict)
-            else:
-                err_text = 'Unknown?'
-            if err_dict['rspCode'] == -6:
-                # Need to login again (expired token?)
-                logger.warning('Potential expired token - attempting to renew.')
-                self.login()
-                return self._snap_req()
-            else:
-                raise ValueError(err_text)
+            raise ValueError(f'Unable to decode snapshot from camera {self.cam_name}')
         return img_arr
 
-    def snap(self, n_snaps: int = 1, target_width: Optional[int] = DEFAULT_WIDTH) -> List[Image.Image]:
-        raw_img_arrs = []  # type: List[np.typing.NDArray]
-        for i in range(n_snaps):
-            raw_img_arrs.append(self._snap_req())
+    def snap_burst(self, n_snaps: int, interval: float,
+                   target_width: Optional[int] = None) -> List[np.typing.NDArray]:
+        """Fetches n_snaps snapshots, starting one every `interval` seconds without waiting on the previous one
+
+        Requests run concurrently over the pooled session, so the snapshots are spaced by `interval`
+        rather than by however long the camera takes to answer each one.
+        """
+        if n_snaps == 1:
+            return [self._snap_req(target_width=target_width)]
+        start = time.monotonic()
+
+        def _fetch_at(i: int) -> np.typing.NDArray:
+            delay = start + i * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            return self._snap_req(target_width=target_width)
+
+        with ThreadPoolExecutor(max_workers=min(n_snaps, self.MAX_BURST)) as executor:
+            return list(executor.map(_fetch_at, range(n_snaps)))
+
+    def snap(self, n_snaps: int = 1, target_width: Optional[int] = DEFAULT_WIDTH,
+             interval: Optional[float] = None) -> List[Image.Image]:
+        if interval is None:
+            interval = self.snap_interval
+        raw_img_arrs = self.snap_burst(n_snaps, interval=interval, target_width=target_width)
 
         imgs = []
         for img_arr in raw_img_arrs:
             # Color correction
             img_arr = cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB)
-            img = Image.fromarray(img_arr)
-            if target_width is not None:
-                ratio = img.width / target_width
-                img = img.resize((int(img.width / ratio), int(img.height / ratio)))
-            imgs.append(img)
+            imgs.append(Image.fromarray(img_arr))
         return imgs
 
     def snap_with_motion(self, target_width: Optional[int] = DEFAULT_WIDTH) -> Tuple[Image.Image, int]:
-        logger.debug('Taking snapshots...')
-        imgs = self.snap(n_snaps=2, target_width=target_width)
-        # TODO: Everything below here should be wrapped into a convenience method in motion detector
-        img_arr1, img_arr2 = [np.asarray(x, dtype=np.uint8) for x in imgs]
-
-        logger.debug('Comparing snapshots')
-        md = MotionDetector(detection_type=MotionDetectionType.DIFF)
-        mask, blur_arr = md.motion_detect_with_diff(
-            img_arr=img_arr2,
-            prev_img_blur_arr=md.grey_and_blur_img(img_arr1)
-        )
-        cntrs = md.extract_contours(fg_mask=mask)
-        img_arr = md.contouring_normal(img_arr2, contours=cntrs)
+        md = MotionDetector(detection_type=MotionDetectionType.DIFF, region_type=self.region_type, roi=self.roi,
+                            detect_width=self.detect_width)
+        mask = None
+        if self.background is not None:
+            # Snapshots don't feed the model, so follow the process that does
+            self.background.refresh()
+        if self.background is not None and self.background.is_ready:
+            # A single snapshot checked against the warm background model
+            logger.debug('Taking snapshot...')
+            img_arr2 = np.asarray(self.snap(n_snaps=1, target_width=target_width)[0], dtype=np.uint8)
+            mask = self.background.apply(md.downscale(img_arr2), is_rgb=True)
+            if mask is not None and self.roi is not None:
+                mask = self.roi.for_shape(mask.shape).restrict(mask)
+        if mask is None:
+            logger.debug('Taking snapshots...')
+            imgs = self.snap(n_snaps=2, target_width=target_width)
+            # TODO: Everything below here should be wrapped into a convenience method in motion detector
+            img_arr1, img_arr2 = [np.asarray(x, dtype=np.uint8) for x in imgs]
+
+            logger.debug('Comparing snapshots')
+            # Detection runs on downscaled copies, while the full-size snapshot is what gets drawn on
+            prev_arr, cur_arr = md.downscale(img_arr1), md.downscale(img_arr2)
+            if self.roi is not None:
+                prev_arr = self.roi.for_shape(prev_arr.shape).crop(prev_arr)
+            mask, blur_arr = md.motion_detect_with_diff_roi(
+                img_arr=cur_arr,
+                prev_img_blur_arr=md.grey_and_blur_img(prev_arr)
+            )
+        img_arr, n_cntrs = md.render_motion(img_arr2, fg_mask=mask)
 
         img = Image.fromarray(img_arr)
-        return img, len(cntrs)
+        return img, n_cntrs
+
+    @property
+    def rtsp_url(self) -> str:
+        return f'rtsp://{self._usr}:{self._pwd}@{self.cam_ip}:554/{self.stream_name}'
+
+    @property
+    def substream_url(self) -> str:
+        return f'rtsp://{self._usr}:{self._pwd}@{self.cam_ip}:554/{self.substream_name}'
 
     def stream(self) -> cv2.VideoCapture:
-        rtsp_url = f'rtsp://{self._usr}:{self._pwd}@{self.cam_ip}:554/{self.stream_name}'
-        return cv2.VideoCapture(rtsp_url)
+        return cv2.VideoCapture(self.rtsp_url)
 
-    def stream_gif_with_motion(self, n_frames: int, target_width: Optional[int] = DEFAULT_WIDTH, method: str = 'normal') -> Tuple[List[Image.Image], float]:
-        cap = self.stream()
-        if not cap.isOpened():
-            # Failed to open for some reason
-            ValueError('Stream was unable to be opened.')
+    def capture(self, wait: float = 0) -> CaptureWorker:
+        """Returns this camera's long-lived capture worker, (re)starting it if it isn't running
 
-        org_frames = []
+        A worker that opens the camera's stream holds one of its stream slots for as long as it runs,
+        so every task in this process shares that one stream.
+
+        Args:
+            wait: seconds to wait on a stream slot when a new worker's needed
+
+        Raises:
+            StreamLimitReached: if the camera's streams are all held elsewhere
+        """
+        with self._capture_lock:
+            # A worker that's stopping (e.g., idled out) won't publish another frame, so start a new one
+            if self._capture is None or not self._capture.is_alive() or not self._capture.keep_alive():
+                if self.capture_source == CaptureSource.RING:
+                    self._capture = RingCaptureWorker(
+                        ring_name=self.frame_ring_name,
+                        name=self.cam_name,
+                        idle_timeout=self.capture_idle_timeout,
+                        pre_roll=self.pre_roll,
+                        background=self.background
+                    )
+                else:
+                    slot = self.stream_limiter.acquire(self.cam_id, wait=wait)
+                    if slot is None:
+                        raise StreamLimitReached(f'Camera {self.cam_name} is at its stream limit')
+                    self._capture = CaptureWorker(
+                        rtsp_url=self.rtsp_url,
+                        name=self.cam_name,
+                        idle_timeout=self.capture_idle_timeout,
+                        pre_roll=self.pre_roll,
+                        background=self.background,
+                        slot=slot
+                    )
+                self._capture.start()
+            return self._capture
+
+    def iter_gif_frames(self, n_frames: int, target_width: Optional[int] = DEFAULT_WIDTH,
+                        use_pre_roll: bool = True, extra_frames: Optional[Callable[[], int]] = None,
+                        fps: float = 10) -> Iterator[np.typing.NDArray]:
+        """Lazily yields pre-roll frames (if any) followed by the next n_frames from the stream, resized
+
+        Both are sampled at `fps`, so the clip plays back in real time at that rate.
+
+        Args:
+            extra_frames: if given, called whenever the frames run out; the stream keeps going for as many
+                more frames as it returns (e.g., when later triggers extend the capture)
+        """
+        if use_pre_roll and self.pre_roll is not None:
+            pre_frames, _ = self.pre_roll.drain(fps=fps)
+            logger.debug(f'Splicing in {len(pre_frames)} pre-roll frames')
+            for frame in pre_frames:
+                if frame.shape[1] != target_width:
+                    frame = imutils.resize(frame, width=target_width)
+                yield frame
 
         logger.debug('Beginning frame collection')
-        for i in range(n_frames):
-            _, frame = cap.read()
-            if frame.shape[1] > target_width:
-                frame = imutils.resize(frame, width=target_width)
-            org_frames.append(frame)
-        cap.release()
+        live_frames = self.capture().sample_frames(fps)
+        while n_frames > 0:
+            for frame in itertools.islice(live_frames, n_frames):
+                if frame.shape[1] > target_width:
+                    frame = imutils.resize(frame, width=target_width)
+                yield frame
+            n_frames = 0 if extra_frames is None else extra_frames()
+            if n_frames > 0:
+                logger.debug(f'Extending frame collection by {n_frames} frames')
         logger.debug('Completed frame collection')
 
-        logger.debug('Correcting frames & processing for motion.')
-
-        md = MotionDetector(detection_type=MotionDetectionType.DIFF, gif_handle_method=GIFHandleMethod.OPTIMIZED)
-        processed_frames, avg_cntrs_per_frame = md.batch_process_motion_detect_with_diff(frames=org_frames)
+    def stream_gif_with_motion(self, n_frames: int, target_width: Optional[int] = DEFAULT_WIDTH, method: str = 'normal',
+                               use_pre_roll: bool = True,
+                               extra_frames: Optional[Callable[[], int]] = None,
+                               detection_pool: Optional[DetectionPool] = None, fps: float = 10) -> FramePipeline:
+        """Builds a pipeline that captures, motion-processes and yields GIF frames concurrently
 
-        completed_frames = [Image.fromarray(x) for x in processed_frames]
+        Iterate over the result to receive frames as they're ready;
+        `avg_cntrs_per_frame` is populated once iteration completes.
 
-        return completed_frames, avg_cntrs_per_frame
+        Args:
+            detection_pool: if given, motion detection is spread over its processes
+        """
+        md = MotionDetector(detection_type=self.detection_type, gif_handle_method=GIFHandleMethod.OPTIMIZED,
+                            region_type=self.region_type, background=self.background, roi=self.roi,
+                            detect_width=self.detect_width)
+        return FramePipeline(
+            frames=self.iter_gif_frames(n_frames, target_width=target_width, use_pre_roll=use_pre_roll,
+                                        extra_frames=extra_frames, fps=fps),
+            detector=md,
+            pool=detection_pool
+        )
@@ -0,0 +1,126 @@
+import os
+import random
+import string
+from typing import Tuple
+
+from loguru import logger
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from vidya import ROOT
+from vidya.core.token_cache import TokenCache
+
+# Every JPEG starts with a start-of-image marker
+JPEG_SOI = b'\xff\xd8'
+
+
+class CameraAPI:
+    """A camera's HTTP API - logging in and fetching snapshots as JPEG bytes
+
+    Kept free of OpenCV, PIL & NumPy so the web tier can fetch images without decoding them.
+    `IPCamera` builds on this with everything that works on frames.
+    """
+    HTTP_TIMEOUT = (3.05, 10)       # Connect, read timeouts (seconds) for camera API calls
+    HTTP_RETRIES = 2                # Retries on connection errors / 5xx before giving up
+    MAX_BURST = 4                   # Most snapshots fetched concurrently (& pooled connections kept)
+    MAX_LOGIN_RETRIES = 1           # Times a request is retried with a fresh token after the camera rejects one
+    DEFAULT_LEASE_TIME = 3600       # Token lease (seconds) to assume if the camera doesn't say
+
+    def __init__(self, cam_id: int):
+        self.ip_subnet = os.environ['IP_SUBNET']
+        self.cam_id = cam_id
+        self._usr = os.environ[f'CAM_{cam_id}_USR']
+        self._pwd = os.environ[f'CAM_{cam_id}_PWD']
+        self.cam_name = os.environ[f'CAM_{cam_id}_NAME']
+        self.cam_ip = f'192.168.{self.ip_subnet}.{self.cam_id}'
+        self.channel = int(os.environ[f'CAM_{cam_id}_CHANNEL'])
+        self.slack_channel = os.environ[f'CAM_{cam_id}_SLACK']
+        self._base_url = f'http://{self.cam_ip}/cgi-bin/api.cgi?'
+        self.session = self._build_session()
+
+        # Logging in is deferred to first use (see ensure_token) so building a camera never blocks
+        self.token_cache = TokenCache(
+            name=f'{self.cam_id}_{self.cam_name}',
+            file_path=ROOT.joinpath(f'.sessions/{self.cam_id}_{self.cam_name}'),
+            redis_url=os.getenv('REDIS_URL')
+        )
+
+        self.rs = ''.join(random.choice(string.ascii_letters) for _ in range(24))
+
+    @classmethod
+    def max_snap_seconds(cls) -> float:
+        """Roughly the longest `snap_jpeg` can take with every request timing out: a login and a snapshot for
+        each token it tries, with each request's retries
+        """
+        n_requests = 2 * (cls.MAX_LOGIN_RETRIES + 1)
+        return n_requests * (cls.HTTP_RETRIES + 1) * sum(cls.HTTP_TIMEOUT)
+
+    def _build_session(self) -> requests.Session:
+        """Builds a keep-alive session so repeated API calls reuse their TCP connections to the camera"""
+        session = requests.Session()
+        retry = Retry(
+            total=self.HTTP_RETRIES,
+            backoff_factor=0.1,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=('GET', 'POST')
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.MAX_BURST, max_retries=retry)
+        session.mount('http://', adapter)
+        return session
+
+    def login(self) -> Tuple[str, int]:
+        """Logs in to the camera's API, returning the new token and its lease time in seconds
+
+        Use `token` rather than calling this directly, so the login is shared with other workers.
+        """
+        logger.info(f'Generating new token for camera {self.cam_name}.')
+        resp = self.session.post(f'{self._base_url}cmd=Login', timeout=self.HTTP_TIMEOUT, json=[{
+            'cmd': 'Login',
+            'param': {
+                'User': {
+                    'Version': '0',
+                    'userName': self._usr,
+                    'password': self._pwd
+                }
+            }
+        }])
+        token_dict = resp.json()[0]['value']['Token']
+        return token_dict['name'], int(token_dict.get('leaseTime', self.DEFAULT_LEASE_TIME))
+
+    @property
+    def token(self) -> str:
+        return self.token_cache.get_token(self.login)
+
+    def ensure_token(self):
+        """Makes sure we hold a valid token lease, logging in if needed"""
+        _ = self.token
+
+    def snap_jpeg(self) -> bytes:
+        """Fetches a snapshot as the camera encoded it, renewing the token once if the camera rejects it"""
+        token = self.token
+        for attempt in range(self.MAX_LOGIN_RETRIES + 1):
+            resp = self.session.get(f'{self._base_url}cmd=Snap&channel=0&rs={self.rs}&token={token}',
+                                    timeout=self.HTTP_TIMEOUT)
+            if resp.content.startswith(JPEG_SOI):
+                return resp.content
+            resp_dict = resp.json()[0]
+            if err_dict := resp_dict.get('error'):
+                err_text = 'Unexpected error: {detail}: {rspCode}'.format(**err_dict)
+            else:
+                err_dict = {}
+                err_text = 'Unknown?'
+            if err_dict.get('rspCode') != -6 or attempt == self.MAX_LOGIN_RETRIES:
+                raise ValueError(err_text)
+            # Need to login again (expired token?)
+            logger.warning('Potential expired token - attempting to renew.')
+            token = self.token_cache.invalidate(token, login_func=self.login)
+
+
+class QuickCameraAPI(CameraAPI):
+    """A camera's HTTP API for callers that can't be kept waiting (e.g., web requests)
+
+    Short timeouts and no retries, so an unreachable camera fails fast rather than tying up the caller.
+    """
+    HTTP_TIMEOUT = (1.05, 2)
+    HTTP_RETRIES = 0
@@ -0,0 +1,347 @@
+from enum import StrEnum
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+import cv2
+from loguru import logger
+import numpy as np
+from numpy.typing import NDArray
+
+from vidya.core.frame_ring import SharedFrameRing
+from vidya.core.stream_limit import StreamSlot
+
+if TYPE_CHECKING:
+    from vidya.core.background import BackgroundModel
+
+
+class FrameRingBuffer:
+    """Bounded pre-roll of recent, downscaled frames stored in a single preallocated uint8 array
+
+    Frames are sampled at `fps` and resized to `width` before storage. The slot count is derived from
+    `seconds * fps`, then capped so the whole buffer fits in `max_bytes`. Slots are allocated on the
+    first push (once the stream's frame shape is known) and reallocated only if that shape changes.
+    """
+
+    def __init__(self, seconds: float, fps: float, width: int, max_bytes: int = 64 * 1024 ** 2):
+        self.seconds = seconds
+        self.fps = fps
+        self.width = width
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._frames = None  # type: Optional[NDArray]
+        self._timestamps = None  # type: Optional[NDArray]
+        self._capacity = 0
+        self._write_idx = 0
+        self._count = 0
+        self._next_push_ts = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _allocate(self, shape: Tuple[int, ...]):
+        frame_bytes = int(np.prod(shape))
+        capacity = min(int(self.seconds * self.fps), self.max_bytes // frame_bytes)
+        if capacity < int(self.seconds * self.fps):
+            logger.warning(f'Pre-roll buffer capped at {capacity} frames to stay within {self.max_bytes} bytes.')
+        self._capacity = max(capacity, 1)
+        self._frames = np.empty((self._capacity, *shape), dtype=np.uint8)
+        self._timestamps = np.zeros(self._capacity, dtype=np.float64)
+        self._write_idx = 0
+        self._count = 0
+
+    def push(self, frame: NDArray, ts: float):
+        """Stores the frame if at least one sample interval has passed since the last stored frame"""
+        interval = 1 / self.fps
+        # Allow a little jitter in frame arrival so we don't skip frames that land just shy of the sample grid
+        if ts < self._next_push_ts - interval / 4:
+            return
+        self._next_push_ts += interval
+        if self._next_push_ts < ts:
+            # Fell behind the sample grid (e.g., first frame or after a reconnect) - restart it from here
+            self._next_push_ts = ts + interval
+        if frame.shape[1] > self.width:
+            height = int(frame.shape[0] * self.width / frame.shape[1])
+            frame = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        with self._lock:
+            if self._frames is None or self._frames.shape[1:] != frame.shape:
+                self._allocate(frame.shape)
+            self._frames[self._write_idx] = frame
+            self._timestamps[self._write_idx] = ts
+            self._write_idx = (self._write_idx + 1) % self._capacity
+            self._count = min(self._count + 1, self._capacity)
+
+    def drain(self, fps: Optional[float] = None) -> Tuple[NDArray, NDArray]:
+        """Returns a copy of the buffered frames and their timestamps (oldest first), then empties the buffer
+
+        Args:
+            fps: if given, the frames are resampled to this rate (repeating or skipping frames as needed),
+                so they play back in real time alongside frames from `sample_frames` at the same rate
+        """
+        with self._lock:
+            if self._frames is None or self._count == 0:
+                return np.empty((0, 0, 0, 3), dtype=np.uint8), np.empty(0, dtype=np.float64)
+            start = (self._write_idx - self._count) % self._capacity
+            order = (np.arange(self._count) + start) % self._capacity
+            timestamps = self._timestamps[order]
+            if fps is not None and fps != self.fps:
+                # For each tick of the new rate, the latest frame at (or just shy of) that time
+                ticks = np.arange(timestamps[0], timestamps[-1] + 0.25 / fps, 1 / fps)
+                picks = np.searchsorted(timestamps, ticks + 0.25 / fps, side='right') - 1
+                order, timestamps = order[picks], ticks
+            frames = self._frames[order]
+            self._count = 0
+        return frames, timestamps
+
+
+class CaptureSource(StrEnum):
+    RTSP = 'RTSP'   # Each worker process opens the camera's stream itself
+    RING = 'RING'   # Frames come from the capture service (see vidya.capture_service) via shared memory
+
+
+class CaptureWorker(threading.Thread):
+    """Keeps a camera's RTSP stream open, continuously decoding frames so tasks can pull them on demand
+
+    Opening a `cv2.VideoCapture` costs the full RTSP handshake plus a wait for the next keyframe,
+    so instead of doing that per task, a single worker per camera holds the stream and publishes
+    the most recently decoded frame. Readers block until a frame newer than the last one they saw arrives.
+    """
+    RECONNECT_DELAY = 2.0   # Seconds to wait before reopening a dropped stream
+    READ_TIMEOUT = 10.0     # Seconds a reader will wait on a new frame before giving up
+
+    def __init__(self, rtsp_url: str, name: str, idle_timeout: float = 0,
+                 pre_roll: Optional[FrameRingBuffer] = None, background: Optional['BackgroundModel'] = None,
+                 ring: Optional[SharedFrameRing] = None, slot: Optional[StreamSlot] = None):
+        """
+        Args:
+            rtsp_url: the stream to keep open
+            name: used for the thread name & logging
+            idle_timeout: seconds without any reader before the stream is released and the worker exits.
+                0 keeps the stream open indefinitely.
+            pre_roll: if provided, every decoded frame is offered to this buffer
+            background: if provided, decoded frames are offered to this model to keep it learning the scene
+            ring: if provided, every decoded frame is also written to this shared memory ring
+                for other processes to read. It's closed when the worker exits.
+            slot: the camera's stream slot (see `StreamLimiter`), if one was taken for this worker. It's
+                held (renewed) for as long as the worker runs and released when it exits. Should the
+                slot be lost, the worker stops rather than stream over the camera's limit.
+        """
+        super().__init__(name=f'capture-{name}', daemon=True)
+        self.rtsp_url = rtsp_url
+        self.cam_name = name
+        self.idle_timeout = idle_timeout
+        self.pre_roll = pre_roll
+        self.background = background
+        self.ring = ring
+        self.slot = slot
+
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._frame = None  # type: Optional[NDArray]
+        self._frame_seq = 0
+        self._frame_ts = 0.0
+        self._last_used = time.monotonic()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def is_stopping(self) -> bool:
+        """Whether the worker has stopped, or is about to, and won't publish any more frames"""
+        return self._stop_event.is_set()
+
+    @property
+    def is_idle(self) -> bool:
+        return self.idle_timeout > 0 and time.monotonic() - self._last_used > self.idle_timeout
+
+    def _stop_if_idle(self) -> bool:
+        """Stops the worker if no reader has used it for `idle_timeout`, returning whether it did"""
+        with self._cond:
+            if not self.is_idle:
+                return False
+            self._stop_event.set()
+            return True
+
+    def keep_alive(self) -> bool:
+        """Marks the worker as in use, so it doesn't idle out from under a new reader
+
+        Returns False if it's already stopping, in which case a new worker is needed.
+        """
+        with self._cond:
+            if self.is_stopping:
+                return False
+            self._last_used = time.monotonic()
+            return True
+
+    def _keep_slot(self) -> bool:
+        """Renews the stream slot when due, stopping the worker if it's been lost"""
+        if self.slot is None or self.slot.renew_if_due():
+            return True
+        logger.warning(f'Lost stream slot for camera {self.cam_name} - releasing stream.')
+        self._stop_event.set()
+        return False
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set() and self._keep_slot():
+                logger.debug(f'Opening stream for camera {self.cam_name}...')
+                cap = cv2.VideoCapture(self.rtsp_url)
+                if not cap.isOpened():
+                    logger.warning(f'Stream for camera {self.cam_name} was unable to be opened. '
+                                   f'Retrying in {self.RECONNECT_DELAY}s.')
+                    cap.release()
+                    self._stop_event.wait(self.RECONNECT_DELAY)
+                    continue
+                logger.debug(f'Stream for camera {self.cam_name} opened.')
+                try:
+                    while not self._stop_event.is_set() and self._keep_slot():
+                        if self._stop_if_idle():
+                            logger.debug(f'Stream for camera {self.cam_name} idle - releasing.')
+                            break
+                        ok, frame = cap.read()
+                        if not ok or frame is None:
+                            logger.warning(f'Lost stream for camera {self.cam_name} - reconnecting.')
+                            break
+                        self._publish(frame)
+                finally:
+                    cap.release()
+        finally:
+            if self.ring is not None:
+                self.ring.close()
+            if self.slot is not None:
+                self.slot.release()
+            self._finish()
+
+    def _finish(self):
+        with self._cond:
+            # Flagged before waking readers, so they see we're done rather than waiting out their timeout
+            self._stop_event.set()
+            self._cond.notify_all()
+
+    def _publish(self, frame: NDArray, ts: Optional[float] = None):
+        if ts is None:
+            ts = time.time()
+        if self.ring is not None:
+            self.ring.push(frame, ts)
+        with self._cond:
+            self._frame = frame
+            self._frame_seq += 1
+            self._frame_ts = ts
+            self._cond.notify_all()
+        if self.pre_roll is not None:
+            self.pre_roll.push(frame, ts)
+        if self.background is not None:
+            self._update_background(frame)
+
+    def _update_background(self, frame: NDArray):
+        # This worker holds the stream, so it's the one that teaches the model (and saves it)
+        self.background.learn(frame)
+
+    def _wait_for_frame(self, after_seq: int, timeout: float) -> Tuple[int, NDArray, float]:
+        with self._cond:
+            is_ready = self._cond.wait_for(
+                lambda: self._frame_seq > after_seq or self.is_stopping,
+                timeout=timeout
+            )
+            if not is_ready or self._frame_seq <= after_seq:
+                raise TimeoutError(f'No new frame from camera {self.cam_name} within {timeout}s.')
+            return self._frame_seq, self._frame, self._frame_ts
+
+    def latest(self, timeout: float = READ_TIMEOUT) -> NDArray:
+        """Returns the most recently decoded frame, waiting on the first one if the stream just opened"""
+        self._last_used = time.monotonic()
+        _, frame, _ = self._wait_for_frame(after_seq=0, timeout=timeout)
+        return frame
+
+    def read_frames(self, n_frames: int, timeout: float = READ_TIMEOUT) -> Iterator[NDArray]:
+        """Yields the next n_frames newly decoded frames, in order"""
+        with self._cond:
+            seq = self._frame_seq
+        for _ in range(n_frames):
+            self._last_used = time.monotonic()
+            seq, frame, _ = self._wait_for_frame(after_seq=seq, timeout=timeout)
+            yield frame
+
+    def sample_frames(self, fps: float, timeout: float = READ_TIMEOUT) -> Iterator[NDArray]:
+        """Endlessly yields newly decoded frames at `fps`, whatever rate the stream runs at
+
+        Frames are picked by timestamp - skipped when the stream runs faster than `fps`, repeated when it
+        runs slower - so n frames always span n / fps seconds and play back in real time at `fps`.
+        """
+        interval = 1 / fps
+        with self._cond:
+            seq = self._frame_seq
+        next_ts = None
+        while True:
+            self._last_used = time.monotonic()
+            seq, frame, ts = self._wait_for_frame(after_seq=seq, timeout=timeout)
+            if next_ts is None:
+                next_ts = ts
+            # Allow a little jitter in frame arrival, as FrameRingBuffer does
+            while ts >= next_ts - interval / 4:
+                yield frame
+                next_ts += interval
+
+
+class RingCaptureWorker(CaptureWorker):
+    """A capture worker that follows a camera's frames from the capture service's shared memory ring,
+    rather than opening the camera's stream itself
+
+    Only the capture service decodes the stream, however many worker processes read it. Each frame is
+    copied out of the ring once as it's published, as consumers like the pre-roll buffer and GIF
+    pipeline hold frames for longer than they'd last in the ring (see `SharedFrameRing`).
+    Until the ring exists, or whenever its writer goes away, the worker keeps trying to (re)attach.
+    """
+    def __init__(self, ring_name: str, name: str, idle_timeout: float = 0,
+                 pre_roll: Optional[FrameRingBuffer] = None, background: Optional['BackgroundModel'] = None):
+        super().__init__(rtsp_url='', name=name, idle_timeout=idle_timeout, pre_roll=pre_roll, background=background)
+        self.ring_name = ring_name
+
+    def _update_background(self, frame: NDArray):
+        # The capture service learns from the stream - just follow what it saves
+        self.background.refresh()
+
+    def run(self):
+        ring = None  # type: Optional[SharedFrameRing]
+        seq = 0
+        try:
+            while not self._stop_event.is_set():
+                if self._stop_if_idle():
+                    logger.debug(f'Frame ring for camera {self.cam_name} idle - detaching.')
+                    break
+                if ring is None:
+                    try:
+                        ring = SharedFrameRing.attach(self.ring_name)
+                        seq = 0
+                        logger.debug(f'Attached to frame ring {self.ring_name} for camera {self.cam_name}.')
+                    except (FileNotFoundError, ValueError):
+                        logger.warning(f'Frame ring {self.ring_name} for camera {self.cam_name} is not available. '
+                                       f'Retrying in {self.RECONNECT_DELAY}s.')
+                        self._stop_event.wait(self.RECONNECT_DELAY)
+                        continue
+                try:
+                    seq, frame, ts = ring.wait_for_frame(after_seq=seq, timeout=self.READ_TIMEOUT)
+                except (TimeoutError, EOFError) as exc:
+                    logger.warning(f'{exc} - reattaching.')
+                    ring.close()
+                    ring = None
+                    continue
+                frame = frame.copy()
+                if not ring.is_current(seq):
+                    # The writer lapped us mid-copy, so the copy may be torn
+                    continue
+                self._publish(frame, ts)
+        finally:
+            if ring is not None:
+                ring.close()
+            self._finish()
@@ -0,0 +1,118 @@
+from enum import StrEnum
+from typing import Optional
+import uuid
+
+from loguru import logger
+import redis
+
+
+class TriggerMode(StrEnum):
+    SNAP = 'snap'
+    GIF = 'gif'
+
+
+class TriggerCoalescer:
+    """Merges repeated motion triggers for the same camera and capture mode into the capture already queued
+
+    The first trigger claims a key in Redis, so the decision holds across every web worker, and the
+    capture task clears it when done. Any trigger for that camera and mode arriving while the key is
+    held is coalesced into the pending/in-flight capture rather than queueing another. For GIFs,
+    coalesced triggers can also ask for the capture to run longer, up to `max_extend_seconds` in total.
+
+    A claim lasts `window` seconds unless renewed - the capture task renews it when it starts, for as long
+    as it could be recording, and keeps renewing it as frames come in (see `renew`), so it can't lapse
+    mid-capture. Each claim holds a unique token
+    that the task passes back to `release`, so a task whose claim did lapse can't clear a newer one.
+
+    Redis being unreachable never blocks a trigger - it's just not coalesced.
+    """
+    KEY_PREFIX = 'vidya:trigger'
+    # Deletes the claim (& its extensions) only if it's still the caller's
+    _RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1], KEYS[2])
+        end
+        return 0
+    """
+    # Extends the claim (& its extensions) to ARGV[2] ms from now, only if it's still the caller's
+    _RENEW_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            redis.call('pexpire', KEYS[2], ARGV[2])
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    def __init__(self, redis_client: redis.Redis, window: float = 10, max_extend_seconds: int = 10):
+        self.redis_client = redis_client
+        self.window = window
+        self.max_extend_seconds = max_extend_seconds
+        self._release_script = redis_client.register_script(self._RELEASE_SCRIPT)
+        self._renew_script = redis_client.register_script(self._RENEW_SCRIPT)
+
+    def _key(self, cam_id: int, mode: str) -> str:
+        return f'{self.KEY_PREFIX}:{mode}:{cam_id}'
+
+    def claim(self, cam_id: int, mode: str) -> Optional[str]:
+        """Returns a claim token if this trigger should queue a capture (pass it on to the capture task),
+        or None if it was coalesced into an existing one"""
+        token = uuid.uuid4().hex
+        if self.window <= 0:
+            return token
+        try:
+            is_claimed = self.redis_client.set(self._key(cam_id, mode), token, nx=True, px=int(self.window * 1000))
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to coalesce trigger ({exc}) - queueing it anyway.')
+            return token
+        return token if is_claimed else None
+
+    def renew(self, cam_id: int, mode: str, token: Optional[str], seconds: float) -> bool:
+        """Keeps the claim held for another `seconds` (from now), returning False if it's no longer the caller's"""
+        if token is None or self.window <= 0:
+            return False
+        key = self._key(cam_id, mode)
+        try:
+            return bool(self._renew_script(keys=[key, f'{key}:extend'], args=[token, int(seconds * 1000)]))
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to renew trigger claim ({exc}).')
+            return False
+
+    def release(self, cam_id: int, mode: str, token: Optional[str]):
+        """Marks the camera's capture for this mode as done, so the next trigger starts a new one
+
+        Only the claim holding `token` is cleared - if it lapsed and a later trigger has claimed the
+        camera since, that claim is left alone.
+        """
+        if token is None or self.window <= 0:
+            return
+        key = self._key(cam_id, mode)
+        try:
+            self._release_script(keys=[key, f'{key}:extend'], args=[token])
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to release trigger claim ({exc}) - it will lapse on its own.')
+
+    def request_extension(self, cam_id: int, mode: str, seconds: int) -> int:
+        """Asks the in-flight capture to run `seconds` longer, returning the total extension now requested"""
+        claim_key = self._key(cam_id, mode)
+        key = f'{claim_key}:extend'
+        hold_ms = int((self.window + self.max_extend_seconds) * 1000)
+        try:
+            with self.redis_client.pipeline() as pipe:
+                pipe.incrby(key, seconds)
+                pipe.pexpire(key, hold_ms)
+                # Hold the claim at least as long as the extension could keep the capture going
+                pipe.pexpire(claim_key, hold_ms, gt=True)
+                total, _, _ = pipe.execute()
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to request capture extension ({exc}).')
+            return 0
+        return min(int(total), self.max_extend_seconds)
+
+    def pop_extension(self, cam_id: int, mode: str) -> int:
+        """Takes any extension (in seconds) requested since the last call, for the capture task to act on"""
+        try:
+            seconds = self.redis_client.getdel(f'{self._key(cam_id, mode)}:extend')
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to read capture extension ({exc}).')
+            return 0
+        return 0 if seconds is None else int(seconds)
@@ -0,0 +1,265 @@
+from functools import lru_cache
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+from typing import (  # noqa: F401
+    BinaryIO,
+    Dict,
+    FrozenSet,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from PIL import (
+    GifImagePlugin,
+    Image,
+)
+import imageio_ffmpeg
+from loguru import logger
+import numpy as np
+
+from vidya.core.formats import OutputFormat
+from vidya.core.motion_detect import MotionDetector
+
+
+class GIFStreamWriter:
+    """Encodes a GIF one frame at a time, writing each frame out as soon as it's handed over
+
+    PIL's `save_all` collects every frame (plus its own converted copies) before writing anything, so
+    memory grows with the clip's length. Here only the frame being encoded is held.
+
+    The first frame's colors become a palette shared by the whole clip (with entries reserved for the
+    motion overlay colors, so outlines stay true even if they're not in that frame), which saves
+    re-quantizing every frame from scratch. Transparent pixels (e.g., from the optimized motion frames)
+    are written as transparent and each frame is cropped to its opaque area, so only what changed is
+    encoded.
+    """
+    N_COLORS = 256
+    TRANSPARENT_INDEX = N_COLORS - 1
+
+    def __init__(self, fp: Union[str, Path, BinaryIO], fps: int = 10, loop: int = 0,
+                 reserved_colors: List[Tuple[int, int, int]] = None):
+        self._fp = open(fp, 'wb') if isinstance(fp, (str, Path)) else fp
+        self._is_own_fp = self._fp is not fp
+        self.duration = 1000 / fps
+        self.loop = loop
+        if reserved_colors is None:
+            reserved_colors = [MotionDetector.GREEN, MotionDetector.RED]
+        self.reserved_colors = reserved_colors
+        self._palette = None  # type: Optional[List[int]]
+        self._palette_img = None  # type: Optional[Image.Image]
+        self.n_frames = 0
+
+    def __enter__(self) -> 'GIFStreamWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _build_palette(self, rgb: Image.Image):
+        """Builds the clip's shared palette from the first frame"""
+        n_frame_colors = self.N_COLORS - len(self.reserved_colors) - 1
+        frame_palette = rgb.quantize(colors=n_frame_colors).getpalette()[:n_frame_colors * 3]
+        frame_palette += [0] * (n_frame_colors * 3 - len(frame_palette))
+        quant_palette = frame_palette + [c for color in self.reserved_colors for c in color]
+        # Quantizing against this leaves out the transparent index, so no real pixel lands on it
+        self._palette_img = Image.new('P', (1, 1))
+        self._palette_img.putpalette(quant_palette)
+        self._palette = quant_palette + [0, 0, 0]
+
+    def write(self, frame: Image.Image):
+        """Quantizes the frame and appends it to the output"""
+        arr = np.asarray(frame)
+        if frame.mode == 'RGBA':
+            opaque = arr[..., 3] > 0
+            rows, cols = np.flatnonzero(opaque.any(axis=1)), np.flatnonzero(opaque.any(axis=0))
+            if self.n_frames == 0:
+                # The first frame is the canvas, so keep it whole
+                top, bottom, left, right = 0, arr.shape[0], 0, arr.shape[1]
+            elif rows.size == 0:
+                # Nothing to draw - a single transparent pixel keeps the frame's timing
+                top, bottom, left, right = 0, 1, 0, 1
+            else:
+                top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            opaque = opaque[top:bottom, left:right]
+            rgb = Image.fromarray(arr[top:bottom, left:right, :3])
+        else:
+            top, left = 0, 0
+            opaque = None
+            rgb = frame.convert('RGB')
+
+        if self._palette_img is None:
+            self._build_palette(rgb)
+        quantized = rgb.quantize(palette=self._palette_img, dither=Image.Dither.NONE)
+        if opaque is not None and not opaque.all():
+            quantized.paste(self.TRANSPARENT_INDEX, mask=Image.fromarray(~opaque))
+        quantized.putpalette(self._palette)
+
+        if self.n_frames == 0:
+            header, _ = GifImagePlugin.getheader(quantized, info=dict(
+                loop=self.loop, duration=self.duration, transparency=self.TRANSPARENT_INDEX))
+            self._fp.write(b''.join(header))
+        frame_data = GifImagePlugin.getdata(quantized, offset=(int(left), int(top)), duration=self.duration,
+                                            transparency=self.TRANSPARENT_INDEX, disposal=1)
+        self._fp.write(b''.join(frame_data))
+        self.n_frames += 1
+
+    def close(self):
+        if self._fp is None:
+            return
+        if self.n_frames > 0:
+            # GIF trailer
+            self._fp.write(b';')
+        self._fp.flush()
+        if self._is_own_fp:
+            self._fp.close()
+        self._fp = None
+
+
+class FrameCompositor:
+    """Flattens motion frames with transparency onto a running canvas
+
+    GIFs keep the transparent parts of a frame showing the frame before, which the optimized motion
+    frames rely on. Video-style encoders treat each frame as the whole picture instead, so they're fed the
+    frames with that already applied.
+    """
+    def __init__(self):
+        self._canvas = None  # type: Optional[np.typing.NDArray]
+
+    def apply(self, frame: Image.Image) -> np.typing.NDArray:
+        """Returns the (H, W, 3) RGB picture after this frame. Reused between calls, so copy it to keep it."""
+        arr = np.asarray(frame)
+        if frame.mode != 'RGBA':
+            self._canvas = np.array(frame.convert('RGB'))
+        elif self._canvas is None:
+            self._canvas = arr[..., :3].copy()
+        else:
+            opaque = arr[..., 3] > 0
+            self._canvas[opaque] = arr[..., :3][opaque]
+        return self._canvas
+
+
+@lru_cache()
+def ffmpeg_encoders() -> FrozenSet[str]:
+    """The encoders built into imageio's FFmpeg"""
+    out = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', '-encoders'],
+                         capture_output=True, text=True, check=True).stdout
+    # Listed as e.g. " V....D libx264   libx264 H.264 / AVC ..."
+    return frozenset(x.split()[1] for x in out.splitlines() if len(x.split()) > 1 and x.split()[0][:1] == 'V')
+
+
+class FFmpegStreamWriter:
+    """Encodes a video one frame at a time, piping each frame to FFmpeg (via imageio) as it's handed over
+
+    FFmpeg can only write to a path, so when given a file object the video goes to a temporary
+    file first and is copied over on close. Subclasses pick the codec and how `quality` maps onto it.
+    """
+    SUFFIX = ''
+    # Frames are cropped to a multiple of this (e.g., most H.264 profiles need even dimensions)
+    MACRO_BLOCK_SIZE = 1
+
+    def __init__(self, fp: Union[str, Path, BinaryIO], fps: int = 10, quality: int = 35):
+        if isinstance(fp, (str, Path)):
+            self.path = Path(fp)
+            self._fp = None  # type: Optional[BinaryIO]
+        else:
+            fd, tmp_path = tempfile.mkstemp(suffix=self.SUFFIX)
+            os.close(fd)
+            self.path = Path(tmp_path)
+            self._fp = fp
+        self.fps = fps
+        self.quality = quality
+        self._compositor = FrameCompositor()
+        self._writer = None  # type: Optional[Generator[None, Optional[np.typing.NDArray], None]]
+        self._size = None  # type: Optional[Tuple[int, int]]
+        self.n_frames = 0
+
+    def __enter__(self) -> 'FFmpegStreamWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _writer_kwargs(self) -> Dict:
+        """Arguments for `imageio_ffmpeg.write_frames` choosing the codec and quality"""
+        raise NotImplementedError
+
+    def write(self, frame: Image.Image):
+        """Encodes the frame into the video"""
+        rgb = self._compositor.apply(frame)
+        if self._writer is None:
+            height, width = rgb.shape[:2]
+            self._size = (width - width % self.MACRO_BLOCK_SIZE, height - height % self.MACRO_BLOCK_SIZE)
+            self._writer = imageio_ffmpeg.write_frames(str(self.path), self._size, fps=self.fps,
+                                                       macro_block_size=self.MACRO_BLOCK_SIZE,
+                                                       **self._writer_kwargs())
+            # Starts FFmpeg
+            self._writer.send(None)
+        width, height = self._size
+        self._writer.send(np.ascontiguousarray(rgb[:height, :width]))
+        self.n_frames += 1
+
+    def close(self):
+        if self._writer is not None:
+            # Waits for FFmpeg to finish writing
+            self._writer.close()
+            self._writer = None
+        if self._fp is not None:
+            if self.n_frames > 0:
+                with self.path.open('rb') as f:
+                    shutil.copyfileobj(f, self._fp)
+            self.path.unlink(missing_ok=True)
+            self._fp = None
+
+
+class WebPStreamWriter(FFmpegStreamWriter):
+    """Encodes an animated WebP one frame at a time with libwebp
+
+    Each frame is encoded as it arrives, so nothing is held for the clip beyond the encoder's own
+    state. `quality` is libwebp's 0-100 quality.
+    """
+    SUFFIX = '.webp'
+
+    def __init__(self, fp: Union[str, Path, BinaryIO], fps: int = 10, quality: int = 35, loop: int = 0):
+        super().__init__(fp, fps=fps, quality=quality)
+        self.loop = loop
+
+    def _writer_kwargs(self) -> Dict:
+        return dict(codec='libwebp_anim', quality=None,
+                    output_params=['-quality', str(self.quality), '-loop', str(self.loop)])
+
+
+class MP4StreamWriter(FFmpegStreamWriter):
+    """Encodes an MP4 one frame at a time, with H.264 (libx264)
+
+    `quality` (0-100) is mapped onto libx264's CRF, from 51 (worst) at 0 down to 0 at 100. Should the
+    FFmpeg in use lack libx264, this falls back to MPEG-4 Part 2, which plays inline in fewer places.
+    """
+    SUFFIX = '.mp4'
+    MACRO_BLOCK_SIZE = 2
+    CODECS = ('libx264', 'mpeg4')
+
+    def _writer_kwargs(self) -> Dict:
+        encoders = ffmpeg_encoders()
+        codec = next((x for x in self.CODECS if x in encoders), None)
+        if codec is None:
+            raise OSError(f'None of the {self.CODECS} encoders are available to FFmpeg')
+        if codec != self.CODECS[0]:
+            logger.warning(f'No {self.CODECS[0]} encoder available - encoding {self.path.name} with {codec}')
+        # imageio maps its 0-10 quality onto libx264's CRF (or the codec's qscale)
+        return dict(codec=codec, quality=self.quality / 10, pix_fmt_out='yuv420p')
+
+
+def get_stream_writer(output_format: OutputFormat, fp: Union[str, Path, BinaryIO], fps: int = 10,
+                      quality: int = 35) -> Union[GIFStreamWriter, WebPStreamWriter, MP4StreamWriter]:
+    """Returns the streaming writer for the output format. GIFs have no quality setting."""
+    if output_format == OutputFormat.WEBP:
+        return WebPStreamWriter(fp, fps=fps, quality=quality)
+    elif output_format == OutputFormat.MP4:
+        return MP4StreamWriter(fp, fps=fps, quality=quality)
+    return GIFStreamWriter(fp, fps=fps)
@@ -0,0 +1,12 @@
+from enum import StrEnum
+
+
+class OutputFormat(StrEnum):
+    """Formats an animated capture can be encoded to
+
+    Kept apart from the encoders themselves so the web tier can validate requests without
+    importing them.
+    """
+    GIF = 'gif'         # Most compatible, largest & slowest to encode
+    WEBP = 'webp'       # Animated WebP
+    MP4 = 'mp4'         # H.264 where OpenCV's build supports it, else MPEG-4 Part 2
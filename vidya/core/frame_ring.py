@@ -0,0 +1,240 @@
+from multiprocessing import (
+    resource_tracker,
+    shared_memory,
+)
+import os
+import time
+from typing import (  # noqa: F401
+    List,
+    Optional,
+    Tuple,
+)
+
+from loguru import logger
+import numpy as np
+from numpy.typing import NDArray
+
+
+class SharedFrameRing:
+    """A camera's most recent frames in a fixed-layout shared memory block, written by one process and read by others
+
+    Layout:
+        header: magic, slot count, frame shape, a closed flag, the writer's pid and the write sequence
+            (frames written so far)
+        slot table: per slot, a sequence word and the frame's timestamp
+        frames: (n_slots, H, W, C) uint8, starting on a 64 byte boundary
+
+    Frame k (counting from 1) goes into slot k % n_slots. Each slot's sequence word works as a seqlock:
+    the writer sets it to 2k - 1 before copying the frame in and 2k once it's done, then advances the
+    write sequence. A slot holds frame k only while its word reads 2k, so readers can tell a frame that's
+    been overwritten (or is mid-write) from one that's good.
+
+    Readers get frames as views straight into the block - no copies - which stay good until the writer
+    has gone all the way around the ring (`n_slots` frames later). Anyone holding frames longer than that
+    should copy them, or check `is_current`.
+
+    The writer allocates the block on its first `push` (once the frame shape is known) and starts over
+    with a new block if the shape changes, flagging the old one closed so readers know to `attach` again.
+    A block left behind by a writer that's gone is replaced, but one whose writer is still running never is.
+    """
+    MAGIC = 0x76647962
+    HEADER_DTYPE = np.dtype([
+        ('magic', '<u4'),
+        ('n_slots', '<u4'),
+        ('height', '<u4'),
+        ('width', '<u4'),
+        ('channels', '<u4'),
+        ('is_closed', '<u4'),
+        ('writer_pid', '<u4'),
+        ('_reserved', '<u4'),  # Keeps write_seq 8 byte aligned
+        ('write_seq', '<u8'),
+    ])
+    SLOT_DTYPE = np.dtype([
+        ('seq', '<u8'),
+        ('ts', '<f8'),
+    ])
+    ALIGN = 64
+    POLL_INTERVAL = 0.005   # Seconds between checks while a reader waits on a new frame
+
+    def __init__(self, name: str, n_slots: int = 16):
+        self.name = name
+        self.n_slots = n_slots
+        self._is_writer = True
+        self._shm = None  # type: Optional[shared_memory.SharedMemory]
+        self._header = None  # type: Optional[NDArray]
+        self._slots = None  # type: Optional[NDArray]
+        self._frames = None  # type: Optional[NDArray]
+        # Blocks still referenced by frames handed out to readers, so they can't be unmapped yet
+        self._retired = []  # type: List[shared_memory.SharedMemory]
+
+    @classmethod
+    def attach(cls, name: str) -> 'SharedFrameRing':
+        """Opens an existing ring for reading. Raises FileNotFoundError if its writer hasn't created it yet."""
+        shm = shared_memory.SharedMemory(name=name)
+        # Attaching registers the block with this process's resource tracker, which would unlink it
+        #   (from under the writer) when this process exits. It's the writer's to clean up.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        header = np.ndarray((), dtype=cls.HEADER_DTYPE, buffer=shm.buf)
+        if header['magic'] != cls.MAGIC:
+            del header
+            shm.close()
+            raise ValueError(f'Shared memory block {name} is not a frame ring')
+        ring = cls(name=name, n_slots=int(header['n_slots']))
+        ring._is_writer = False
+        del header
+        ring._map(shm)
+        return ring
+
+    @classmethod
+    def _layout(cls, n_slots: int, shape: Tuple[int, ...]) -> Tuple[int, int]:
+        """Returns where the frames start and the block's total size"""
+        slots_end = cls.HEADER_DTYPE.itemsize + n_slots * cls.SLOT_DTYPE.itemsize
+        frames_offset = -(-slots_end // cls.ALIGN) * cls.ALIGN
+        return frames_offset, frames_offset + n_slots * int(np.prod(shape))
+
+    def _map(self, shm: shared_memory.SharedMemory):
+        self._shm = shm
+        self._header = np.ndarray((), dtype=self.HEADER_DTYPE, buffer=shm.buf)
+        shape = tuple(int(self._header[x]) for x in ('height', 'width', 'channels'))
+        frames_offset, _ = self._layout(self.n_slots, shape)
+        self._slots = np.ndarray((self.n_slots, ), dtype=self.SLOT_DTYPE, buffer=shm.buf,
+                                 offset=self.HEADER_DTYPE.itemsize)
+        self._frames = np.ndarray((self.n_slots, *shape), dtype=np.uint8, buffer=shm.buf, offset=frames_offset)
+
+    @staticmethod
+    def _is_running(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Someone else's process, but running
+            pass
+        return True
+
+    def check_unused(self):
+        """Raises FileExistsError if a running writer (another process, or another ring in this one) has
+        the block open. A block left behind by a writer that didn't get to clean up is removed.
+        """
+        try:
+            existing = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        in_use_by = None
+        if existing.size >= self.HEADER_DTYPE.itemsize:
+            header = np.ndarray((), dtype=self.HEADER_DTYPE, buffer=existing.buf)
+            pid = int(header['writer_pid'])
+            if header['magic'] == self.MAGIC and not header['is_closed'] and self._is_running(pid):
+                in_use_by = pid
+            del header
+        existing.close()
+        if in_use_by is not None:
+            if in_use_by != os.getpid():
+                # Not ours to unlink, so don't let this process's resource tracker do it on exit either
+                resource_tracker.unregister(existing._name, 'shared_memory')
+            raise FileExistsError(f'Frame ring {self.name} is in use by a running writer (pid {in_use_by})')
+        existing.unlink()
+
+    def _allocate(self, shape: Tuple[int, ...]):
+        self.close()
+        self.check_unused()
+        _, size = self._layout(self.n_slots, shape)
+        shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        header = np.ndarray((), dtype=self.HEADER_DTYPE, buffer=shm.buf)
+        header['n_slots'] = self.n_slots
+        header['height'], header['width'], header['channels'] = shape
+        header['is_closed'] = 0
+        header['writer_pid'] = os.getpid()
+        header['write_seq'] = 0
+        # Written last - readers won't take the block until it's there
+        header['magic'] = self.MAGIC
+        del header
+        self._map(shm)
+        logger.debug(f'Allocated frame ring {self.name}: {self.n_slots} slots of {shape} ({size} bytes)')
+
+    @property
+    def shape(self) -> Optional[Tuple[int, ...]]:
+        return None if self._frames is None else self._frames.shape[1:]
+
+    @property
+    def write_seq(self) -> int:
+        """Frames written so far (0 until the first push)"""
+        return 0 if self._header is None else int(self._header['write_seq'])
+
+    @property
+    def is_closed(self) -> bool:
+        return self._header is None or bool(self._header['is_closed'])
+
+    def push(self, frame: NDArray, ts: float):
+        """Copies the frame into the next slot (writer only)
+
+        Raises:
+            FileExistsError: if another running writer has the ring (see `check_unused`)
+        """
+        if self._frames is None or self._frames.shape[1:] != frame.shape:
+            self._allocate(frame.shape)
+        seq = self.write_seq + 1
+        idx = seq % self.n_slots
+        seqs = self._slots['seq']
+        seqs[idx] = 2 * seq - 1
+        self._frames[idx] = frame
+        self._slots['ts'][idx] = ts
+        seqs[idx] = 2 * seq
+        self._header['write_seq'] = seq
+
+    def is_current(self, seq: int) -> bool:
+        """Whether frame `seq` is still in its slot (not yet overwritten or being overwritten)"""
+        return self._slots is not None and int(self._slots['seq'][seq % self.n_slots]) == 2 * seq
+
+    def get(self, seq: int) -> Optional[Tuple[NDArray, float]]:
+        """Returns a view of frame `seq` and its timestamp, or None if it isn't in the ring"""
+        if not self.is_current(seq):
+            return None
+        idx = seq % self.n_slots
+        frame, ts = self._frames[idx], float(self._slots['ts'][idx])
+        # The writer may have started on the slot while we were reading the timestamp
+        return (frame, ts) if self.is_current(seq) else None
+
+    def wait_for_frame(self, after_seq: int, timeout: float) -> Tuple[int, NDArray, float]:
+        """Waits on a frame newer than `after_seq`, returning the newest one's sequence, view and timestamp
+
+        Raises:
+            TimeoutError: if no new frame arrives within `timeout` seconds
+            EOFError: if the writer has closed the ring (it's exiting or has moved to a new block)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.is_closed:
+                raise EOFError(f'Frame ring {self.name} was closed by its writer')
+            seq = self.write_seq
+            if seq > after_seq and (got := self.get(seq)) is not None:
+                return seq, *got
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'No new frame in ring {self.name} within {timeout}s.')
+            time.sleep(self.POLL_INTERVAL)
+
+    def close(self):
+        """Lets go of the block. The writer also flags it closed for readers and removes it."""
+        self._release_retired()
+        if self._shm is None:
+            return
+        if self._is_writer:
+            self._header['is_closed'] = 1
+        self._header = self._slots = self._frames = None
+        shm, self._shm = self._shm, None
+        try:
+            shm.close()
+        except BufferError:
+            # Frames from it are still out there - try again next time
+            self._retired.append(shm)
+        if self._is_writer:
+            shm.unlink()
+
+    def _release_retired(self):
+        still_held = []
+        for shm in self._retired:
+            try:
+                shm.close()
+            except BufferError:
+                still_held.append(shm)
+        self._retired = still_held
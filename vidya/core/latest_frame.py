@@ -0,0 +1,167 @@
+import hashlib
+import threading
+import time
+from typing import (  # noqa: F401
+    Callable,
+    Dict,
+    NamedTuple,
+    Optional,
+)
+
+from loguru import logger
+import redis
+from redis.exceptions import LockError
+
+
+class LatestFrame(NamedTuple):
+    """A camera's most recent snapshot, as the camera encoded it"""
+    jpeg: bytes
+    etag: str
+    fetched_at: float   # Epoch seconds
+
+    @classmethod
+    def new(cls, jpeg: bytes) -> 'LatestFrame':
+        return cls(jpeg=jpeg, etag=hashlib.blake2b(jpeg, digest_size=16).hexdigest(), fetched_at=time.time())
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class LatestFrameCache:
+    """Each camera's latest snapshot, shared by every web worker so polling clients don't each hit the camera
+
+    A frame is fresh for `ttl` seconds. Fresh frames are served from this process's memory, else from
+    Redis. Refreshes are single-flight: within a process, one thread per camera fetches while the rest
+    wait on it, and across processes, a Redis lock lets one process fetch while the others wait and
+    then read its result. However many clients poll, each camera gets at most one fetch per `ttl`.
+
+    Frames are kept in Redis for `max_stale` seconds in all, so if a refresh fails, the last frame
+    can still be served. The same goes for a refresh that's taking too long: anyone who's waited
+    `lock_timeout` on another's fetch gets the last frame (or a TimeoutError without one) rather than
+    fetching alongside it. Redis being unreachable just means each process fetches for itself.
+
+    The Redis lock's lease runs for `fetch_timeout` (the longest a fetch can take), so it can't lapse
+    and let another process fetch while one is still under way.
+    """
+    KEY_PREFIX = 'vidya:latest'
+
+    def __init__(self, redis_client: redis.Redis, ttl: float = 2.0, max_stale: float = 60.0,
+                 lock_timeout: float = 3.0, fetch_timeout: float = 15.0):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock_timeout = lock_timeout
+        self.fetch_timeout = fetch_timeout
+        self._frames = {}  # type: Dict[int, LatestFrame]
+        self._locks = {}  # type: Dict[int, threading.Lock]
+        self._locks_lock = threading.Lock()
+
+    def _key(self, cam_id: int) -> str:
+        return f'{self.KEY_PREFIX}:{cam_id}'
+
+    def _local_lock(self, cam_id: int) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(cam_id, threading.Lock())
+
+    def _is_fresh(self, frame: Optional[LatestFrame]) -> bool:
+        return frame is not None and frame.age() < self.ttl
+
+    def _read(self, cam_id: int) -> Optional[LatestFrame]:
+        stored = self.redis_client.hgetall(self._key(cam_id))
+        if len(stored) == 0:
+            return None
+        return LatestFrame(jpeg=stored[b'jpeg'], etag=stored[b'etag'].decode(),
+                           fetched_at=float(stored[b'fetched_at']))
+
+    def _write(self, cam_id: int, frame: LatestFrame):
+        key = self._key(cam_id)
+        with self.redis_client.pipeline() as pipe:
+            pipe.hset(key, mapping={'jpeg': frame.jpeg, 'etag': frame.etag, 'fetched_at': frame.fetched_at})
+            pipe.pexpire(key, int(self.max_stale * 1000))
+            pipe.execute()
+
+    def get(self, cam_id: int, fetch: Callable[[], bytes]) -> LatestFrame:
+        """Returns the camera's latest frame, calling `fetch` for new JPEG bytes if the cached one's gone stale
+
+        If the fetch fails, the last frame is returned while it's within `max_stale`, else the error's raised.
+
+        Raises:
+            TimeoutError: if another's refresh took longer than `lock_timeout` and there's no recent frame to serve
+        """
+        frame = self._frames.get(cam_id)
+        if self._is_fresh(frame):
+            return frame
+        lock = self._local_lock(cam_id)
+        if not lock.acquire(timeout=self.lock_timeout):
+            return self._serve_stale(cam_id, self._frames.get(cam_id))
+        try:
+            # Someone else in this process may have just refreshed it
+            frame = self._frames.get(cam_id)
+            if self._is_fresh(frame):
+                return frame
+            try:
+                frame = self._refresh_shared(cam_id, fetch, stale=frame)
+            except LockError:
+                # Never fetch alongside whoever holds the Redis lock
+                frame = self._serve_stale(cam_id, frame)
+            except redis.RedisError as exc:
+                logger.warning(f'Unable to share latest frame for camera {cam_id} ({exc}) - fetching directly.')
+                frame = self._fetch(cam_id, fetch, stale=frame)
+            self._frames[cam_id] = frame
+            return frame
+        finally:
+            lock.release()
+
+    def _refresh_shared(self, cam_id: int, fetch: Callable[[], bytes], stale: Optional[LatestFrame]) -> LatestFrame:
+        shared = self._read(cam_id)
+        if self._is_fresh(shared):
+            return shared
+        lock = self.redis_client.lock(f'{self._key(cam_id)}:lock', timeout=max(self.fetch_timeout, self.lock_timeout))
+        if not lock.acquire(blocking_timeout=self.lock_timeout):
+            # Whoever holds it is taking a while - serve what they've left rather than fetching alongside them
+            shared = self._read(cam_id) or shared
+            if self._is_fresh(shared):
+                return shared
+            return self._serve_stale(cam_id, shared, stale)
+        try:
+            # Whoever held the lock before us may have just refreshed it
+            shared = self._read(cam_id) or shared
+            if self._is_fresh(shared):
+                return shared
+            frame = self._fetch(cam_id, fetch, stale=shared or stale)
+            if frame is not shared and frame is not stale:
+                try:
+                    self._write(cam_id, frame)
+                except redis.RedisError as exc:
+                    logger.warning(f'Unable to share latest frame for camera {cam_id} ({exc}).')
+            return frame
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                # The fetch outlasted the lock's lease, so it's already gone
+                pass
+
+    def _serve_stale(self, cam_id: int, *frames: Optional[LatestFrame]) -> LatestFrame:
+        """Returns the newest of `frames` that's within `max_stale`, for when a refresh couldn't be waited on
+
+        Raises:
+            TimeoutError: if none of them are
+        """
+        usable = [x for x in frames if x is not None and x.age() <= self.max_stale]
+        if len(usable) == 0:
+            raise TimeoutError(f'Timed out waiting on a refresh of the latest frame for camera {cam_id}.')
+        frame = max(usable, key=lambda x: x.fetched_at)
+        logger.warning(f'Refresh of latest frame for camera {cam_id} is taking a while - '
+                       f'serving one from {frame.age():.0f}s ago.')
+        return frame
+
+    def _fetch(self, cam_id: int, fetch: Callable[[], bytes], stale: Optional[LatestFrame]) -> LatestFrame:
+        try:
+            return LatestFrame.new(fetch())
+        except Exception as exc:
+            if stale is None or stale.age() > self.max_stale:
+                raise
+            logger.warning(f'Unable to refresh latest frame for camera {cam_id} ({exc}) - '
+                           f'serving one from {stale.age():.0f}s ago.')
+            return stale
@@ -1,6 +1,9 @@
 from enum import StrEnum
-from typing import (
+from typing import (  # noqa: F401
+    TYPE_CHECKING,
+    Dict,
     List,
+    NamedTuple,
     Optional,
     Tuple,
 )
@@ -11,6 +14,12 @@ from loguru import logger
 import numpy as np
 from numpy.typing import NDArray
 
+from vidya.core.roi import RegionOfInterest
+
+if TYPE_CHECKING:
+    from vidya.core.background import BackgroundModel
+    from vidya.core.parallel_detect import DetectionPool
+
 
 class MotionDetectionType(StrEnum):
     DIFF = 'DIFF'       # Determine motion by comparing difference in previous frame
@@ -22,9 +31,23 @@ class GIFHandleMethod(StrEnum):
     OPTIMIZED = 'OPTIMIZED'     # Optimized: Use alpha channel to eliminate unchanged parts of frames (small files)
 
 
+class RegionExtractionType(StrEnum):
+    CONTOURS = 'CONTOURS'       # Trace each moving blob's outline (findContours)
+    COMPONENTS = 'COMPONENTS'   # Label moving blobs and take their stats in one pass (connectedComponentsWithStats)
+
+
+class MotionRegions(NamedTuple):
+    """Moving regions found in a foreground mask, one row per region"""
+    boxes: NDArray          # (N, 4) int32 of x, y, w, h
+    areas: NDArray          # (N, ) int32 of pixel counts
+    centroids: NDArray      # (N, 2) float64 of x, y
+
+
 class MotionDetector:
     DEFAULT_THRESH = 20                 # For motion detection. Was 20
     DEFAULT_KERNEL_SIZE = (5, 5)        # For blurring
+    DEFAULT_KERNEL = np.ones(DEFAULT_KERNEL_SIZE, dtype=np.uint8)   # For dilating
+    OPEN_KERNEL = np.ones((3, 3), dtype=np.uint8)                   # For clearing specks from subtractor masks
     DEFAULT_MIN_CONTOUR_AREA = 200
     DEFAULT_MAX_CONTOUR_AREA = 90_000
     GREEN = (0, 255, 0)
@@ -37,51 +60,188 @@ class MotionDetector:
             self,
             detection_type: MotionDetectionType = MotionDetectionType.DIFF,
             is_gif: bool = False,
-            gif_handle_method: GIFHandleMethod = GIFHandleMethod.NORMAL
+            gif_handle_method: GIFHandleMethod = GIFHandleMethod.NORMAL,
+            region_type: RegionExtractionType = RegionExtractionType.CONTOURS,
+            background: Optional['BackgroundModel'] = None,
+            roi: Optional[RegionOfInterest] = None,
+            detect_width: Optional[int] = None
     ):
+        """
+        Args:
+            background: the camera's warm background model, required for BGSUB detection
+            roi: if given, only motion within this region counts (and diff detection only
+                looks at the part of the frame it covers)
+            detect_width: if given, frames wider than this are scaled down to it for detection, and the
+                regions found are scaled back up to draw on the full frame
+        """
+        if detection_type == MotionDetectionType.BGSUB and background is None:
+            raise ValueError('BGSUB detection needs a background model')
         self.detection_type = detection_type
         self.is_gif = is_gif
         self.gif_handle_method = gif_handle_method
+        self.region_type = region_type
+        self.background = background
+        self.roi = roi
+        self.detect_width = detect_width
 
         if self.gif_handle_method == GIFHandleMethod.NORMAL:
             self.color_style = cv2.COLOR_BGR2RGB
         else:
             self.color_style = cv2.COLOR_BGR2RGBA
 
+        self._prev_img_blur_arr = None  # type: Optional[NDArray]
+        self._prev_img_mask = None  # type: Optional[NDArray]
+        self._n_processed = 0
+        # Scratch space for batch detection, reused between calls with the same clip shape
+        self._batch_bufs = {}  # type: Dict[str, NDArray]
+        # Contour masks for the optimized compositor. Two are kept so the mask handed back
+        #   for the previous frame is never the one being drawn on for the current frame.
+        self._cnt_mask_bufs = []  # type: List[NDArray]
+
+    def reset(self):
+        """Clears the state carried between frames so the detector can start on a new clip"""
+        self._prev_img_blur_arr = None
+        self._prev_img_mask = None
+        self._n_processed = 0
+
+    def process_frame(self, frame: NDArray) -> Tuple[NDArray, int]:
+        """Processes the next frame of a clip, returning the frame with motion drawn on it and its contour count
+
+        State from the previous frame (its blurred copy and, for optimized GIFs, its contour mask)
+        is kept on the detector, so frames must be fed in order. Call `reset` before starting a new clip.
+        """
+        # Convert frame from camera's color to RGB or RGBA, depending on GIF handling style
+        rgb_frame_arr = cv2.cvtColor(frame, self.color_style)
+        detect_frame = self.downscale(frame)
+        detect_arr = rgb_frame_arr if detect_frame is frame else cv2.cvtColor(detect_frame, self.color_style)
+
+        # Detect motion
+        fg_mask = None
+        if self.detection_type == MotionDetectionType.BGSUB:
+            fg_mask = self.background.apply(detect_frame)
+            if fg_mask is not None:
+                # Not diffing this frame, so a diff against the last one kept would be stale
+                self._prev_img_blur_arr = None
+                if self.roi is not None:
+                    fg_mask = self.roi.for_shape(fg_mask.shape).restrict(fg_mask)
+        if fg_mask is None:
+            # Diff (or the background model doesn't fit this frame)
+            fg_mask, self._prev_img_blur_arr = self.motion_detect_with_diff_roi(
+                img_arr=detect_arr,
+                prev_img_blur_arr=self._prev_img_blur_arr
+            )
+        return self._render_frame(rgb_frame_arr, fg_mask=fg_mask)
+
+    def downscale(self, img_arr: NDArray) -> NDArray:
+        """Returns the frame at detection resolution (the frame itself if it's no wider than `detect_width`)
+
+        The frame is halved pyramid-style for as long as it stays at least `detect_width` wide - linear
+        interpolation at exactly half size averages each 2x2 block, so this matches INTER_AREA to within
+        rounding at a fraction of the cost - and whatever's left is done in a single INTER_AREA resize.
+        """
+        h, w = img_arr.shape[:2]
+        if self.detect_width is None or w <= self.detect_width:
+            return img_arr
+        while w // 2 >= self.detect_width:
+            h, w = h // 2, w // 2
+            img_arr = cv2.resize(img_arr, (w, h), interpolation=cv2.INTER_LINEAR)
+        if w != self.detect_width:
+            img_arr = cv2.resize(img_arr, (self.detect_width, round(h * self.detect_width / w)),
+                                 interpolation=cv2.INTER_AREA)
+        return img_arr
+
+    @staticmethod
+    def mask_scale(fg_mask: NDArray, shape: Tuple[int, ...]) -> Tuple[float, float]:
+        """x & y factors that take a point on the (possibly downscaled) mask onto a frame of this shape"""
+        return shape[1] / fg_mask.shape[1], shape[0] / fg_mask.shape[0]
+
+    @staticmethod
+    def upscale_mask(fg_mask: NDArray, shape: Tuple[int, ...]) -> NDArray:
+        """Blows a detection mask up to the size of the frame it's applied to, keeping it binary"""
+        h, w = shape[:2]
+        if fg_mask.shape == (h, w):
+            return fg_mask
+        return cv2.resize(fg_mask, (w, h), interpolation=cv2.INTER_NEAREST)
+
+    def _render_frame(self, rgb_frame_arr: NDArray, fg_mask: NDArray) -> Tuple[NDArray, int]:
+        """Applies contouring for an already-detected frame, advancing the clip state
+
+        The mask can be at detection resolution - regions are found on it, then scaled up to the frame.
+        """
+        i = self._n_processed
+        logger.debug(f'Working on frame {i + 1}...')
+        if self.gif_handle_method == GIFHandleMethod.NORMAL:
+            rgb_frame_arr, n_regions = self.render_motion(rgb_frame_arr, fg_mask=fg_mask, in_place=True)
+        elif self.region_type == RegionExtractionType.COMPONENTS:
+            regions = self.extract_regions(fg_mask=fg_mask, scale=self.mask_scale(fg_mask, rgb_frame_arr.shape))
+            rgb_frame_arr, self._prev_img_mask = self.contouring_optimized_arr(
+                i=i,
+                img_arr=rgb_frame_arr,
+                fg_mask=self.upscale_mask(fg_mask, rgb_frame_arr.shape),
+                past_mask=self._prev_img_mask,
+                contours=[],
+                boxes=regions.boxes,
+                in_place=True
+            )
+            n_regions = len(regions.areas)
+        else:
+            contours = self.extract_contours(fg_mask=fg_mask, scale=self.mask_scale(fg_mask, rgb_frame_arr.shape))
+            rgb_frame_arr, self._prev_img_mask = self.contouring_optimized_arr(
+                i=i,
+                img_arr=rgb_frame_arr,
+                fg_mask=self.upscale_mask(fg_mask, rgb_frame_arr.shape),
+                past_mask=self._prev_img_mask,
+                contours=contours,
+                in_place=True
+            )
+            n_regions = len(contours)
+        self._n_processed += 1
+        return rgb_frame_arr, n_regions
+
+    def render_motion(self, img_arr: NDArray, fg_mask: NDArray, in_place: bool = False) -> Tuple[NDArray, int]:
+        """Extracts moving regions from the mask using this detector's region type and draws them on the frame
+
+        The mask can be smaller than the frame (e.g., detected on a `downscale`d copy of it).
+
+        Returns:
+            the drawn-on frame and the number of regions found
+        """
+        scale = self.mask_scale(fg_mask, img_arr.shape)
+        if self.region_type == RegionExtractionType.COMPONENTS:
+            regions = self.extract_regions(fg_mask=fg_mask, scale=scale)
+            return self.render_regions(img_arr, regions=regions, in_place=in_place), len(regions.areas)
+        contours = self.extract_contours(fg_mask=fg_mask, scale=scale)
+        return self.contouring_normal(img_arr, contours=contours, in_place=in_place), len(contours)
+
     def batch_process_motion_detect_with_diff(
             self,
-            frames: List[NDArray]
+            frames: List[NDArray],
+            pool: Optional['DetectionPool'] = None
     ) -> Tuple[List[NDArray], float]:
-        """Process the original frames into ones with motion on them depending on the parameters set"""
-        prev_img_blur_arr = None
-        prev_img_mask = None
+        """Process the original frames into ones with motion on them depending on the parameters set
+
+        Args:
+            pool: if given, detection is spread over its processes
+        """
+        self.reset()
         processed_frames = []
         cntrs_per_frame = []
 
-        for i, frame in enumerate(frames):
-            logger.debug(f'Working on frame {i + 1}...')
-            # Convert frame from camera's color to RGB or RGBA, depending on GIF handling style
-            rgb_frame_arr = cv2.cvtColor(frame, self.color_style)
-
-            # Detect motion
-            fg_mask, prev_img_blur_arr = self.motion_detect_with_diff(
-                img_arr=rgb_frame_arr,
-                prev_img_blur_arr=prev_img_blur_arr
-            )
-            # Apply contouring
-            contours = self.extract_contours(fg_mask=fg_mask)
-            if self.gif_handle_method == GIFHandleMethod.NORMAL:
-                rgb_frame_arr = self.contouring_normal(img_arr=rgb_frame_arr, contours=contours)
+        if len(frames) > 0 and all(x.shape == frames[0].shape for x in frames):
+            # Detect across the whole clip at once, then contour frame by frame
+            if pool is not None and pool.can_run(self):
+                fg_masks = pool.detect(self, frames)
             else:
-                rgb_frame_arr, prev_img_mask = self.contouring_optimized(
-                    i=i,
-                    img_arr=rgb_frame_arr,
-                    fg_mask=fg_mask,
-                    past_mask=prev_img_mask,
-                    contours=contours
-                )
-            processed_frames.append(rgb_frame_arr)
-            cntrs_per_frame.append(len(contours))
+                fg_masks, _ = self.batch_motion_detect_with_diff(np.stack([self.downscale(x) for x in frames]))
+            for frame, fg_mask in zip(frames, fg_masks):
+                rgb_frame_arr, n_cntrs = self._render_frame(cv2.cvtColor(frame, self.color_style), fg_mask=fg_mask)
+                processed_frames.append(rgb_frame_arr)
+                cntrs_per_frame.append(n_cntrs)
+        else:
+            for frame in frames:
+                rgb_frame_arr, n_cntrs = self.process_frame(frame)
+                processed_frames.append(rgb_frame_arr)
+                cntrs_per_frame.append(n_cntrs)
 
         try:
             avg_cnts_per_frame = sum(cntrs_per_frame) / len(cntrs_per_frame)
@@ -90,15 +250,85 @@ class MotionDetector:
 
         return processed_frames, avg_cnts_per_frame
 
-    @staticmethod
+    def _get_batch_buf(self, name: str, shape: Tuple[int, ...]) -> NDArray:
+        buf = self._batch_bufs.get(name)
+        if buf is None or buf.shape != shape:
+            buf = self._batch_bufs[name] = np.zeros(shape, dtype=np.uint8)
+        return buf
+
+    def batch_motion_detect_with_diff(self, frames: NDArray) -> Tuple[NDArray, NDArray]:
+        """Detects motion across a stack of camera (BGR) frames in bulk
+
+        Equivalent to running `motion_detect_with_diff` frame by frame (after the RGB(A) conversion done
+        in `process_frame`), but the per-pixel steps (greying, diffing, thresholding) run as single calls
+        over the whole stack, while blurring and dilating (which look at neighboring pixels, so can't
+        span frame edges) write frame by frame into buffers that are preallocated and reused between calls.
+
+        Like `process_frame`, this picks up from (and updates) the previous blurred frame kept on the detector,
+        so consecutive chunks of a clip can be fed in turn. Frames are taken at the size given, so
+        `downscale` them first to detect at a lower resolution.
+
+        Args:
+            frames: (N, H, W, C) uint8 array of frames in the camera's color order
+
+        Returns:
+            (N, H, W) stack of foreground masks and (N, ) array of per-frame motion scores
+            (the fraction of the frame flagged as moving)
+        """
+        n, h, w = frames.shape[:3]
+        if n == 0:
+            return np.empty((0, h, w), dtype=np.uint8), np.empty(0, dtype=np.float64)
+        roi_mask = None
+        if self.roi is not None:
+            # Only the region's bounding box needs to go through detection
+            roi_mask = self.roi.for_shape((h, w))
+            frames = np.ascontiguousarray(roi_mask.crop(frames, is_stack=True))
+            full_h, full_w = h, w
+            h, w = frames.shape[1:3]
+        # Frames here are BGR, whereas the per-frame path greys RGB(A) with BGR weights,
+        #   so RGB2GRAY is used to land on identical values.
+        grey = cv2.cvtColor(frames.reshape(n * h, w, -1), cv2.COLOR_RGB2GRAY).reshape(n, h, w)
+
+        # Slot 0 holds the previous frame's blur so every frame has something to diff against
+        blur_buf = self._get_batch_buf('blur', (n + 1, h, w))
+        for i in range(n):
+            cv2.GaussianBlur(src=grey[i], ksize=self.DEFAULT_KERNEL_SIZE, sigmaX=0, dst=blur_buf[i + 1])
+        blur_buf[0] = blur_buf[1] if self._prev_img_blur_arr is None else self._prev_img_blur_arr
+
+        diff_buf = self._get_batch_buf('diff', (n, h, w))
+        cv2.absdiff(src1=blur_buf[1:].reshape(n * h, w), src2=blur_buf[:-1].reshape(n * h, w),
+                    dst=diff_buf.reshape(n * h, w))
+        # Dilute img to make differences more visible
+        dilate_buf = self._get_batch_buf('dilate', (n, h, w))
+        for i in range(n):
+            cv2.dilate(diff_buf[i], self.DEFAULT_KERNEL, dst=dilate_buf[i])
+
+        fg_masks = cv2.threshold(
+            src=dilate_buf.reshape(n * h, w), thresh=self.DEFAULT_THRESH, maxval=255, type=cv2.THRESH_BINARY
+        )[1].reshape(n, h, w)
+        self._prev_img_blur_arr = blur_buf[-1].copy()
+        if roi_mask is not None:
+            h, w = full_h, full_w
+            fg_masks = np.stack([roi_mask.expand(x) for x in fg_masks])
+        scores = np.fromiter((cv2.countNonZero(x) for x in fg_masks), dtype=np.float64, count=n) / (h * w)
+
+        return fg_masks, scores
+
+    @classmethod
     def motion_detect_with_bgsub(
+            cls,
             img_arr: NDArray,
-            bg_sub: cv2.BackgroundSubtractorMOG2
+            bg_sub: cv2.BackgroundSubtractorMOG2,
+            learning_rate: float = -1
     ) -> Tuple[NDArray, cv2.BackgroundSubtractorMOG2]:
         if bg_sub is None:
             logger.debug('Starting up new background subtractor...')
             bg_sub = cv2.createBackgroundSubtractorMOG2()
-        fg_mask = bg_sub.apply(img_arr)
+        fg_mask = bg_sub.apply(img_arr, learningRate=learning_rate)
+        # Drop shadows (marked as 127) & specks of flicker, then grow what's left like the diff method does
+        fg_mask = cv2.threshold(src=fg_mask, thresh=200, maxval=255, type=cv2.THRESH_BINARY)[1]
+        fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, cls.OPEN_KERNEL)
+        fg_mask = cv2.dilate(fg_mask, cls.DEFAULT_KERNEL)
 
         return fg_mask, bg_sub
 
@@ -123,39 +353,136 @@ class MotionDetector:
 
         diff_frame = cv2.absdiff(src1=img_blur_arr, src2=prev_img_blur_arr)
         # Dilute img to make differences more visible
-        kernel = np.ones(self.DEFAULT_KERNEL_SIZE)
-        diff_frame = cv2.dilate(diff_frame, kernel, 1)
+        diff_frame = cv2.dilate(diff_frame, self.DEFAULT_KERNEL)
 
         fg_mask = cv2.threshold(src=diff_frame, thresh=self.DEFAULT_THRESH, maxval=255, type=cv2.THRESH_BINARY)[1]
         # Return the foreground masked frame and the greyed/blurred current frame
         #   to serve as the previous frame next iteration.
         return fg_mask, img_blur_arr
 
-    def extract_contours(self, fg_mask: NDArray) -> List[NDArray]:
+    def motion_detect_with_diff_roi(
+            self,
+            img_arr: NDArray,
+            prev_img_blur_arr: NDArray = None
+    ) -> Tuple[NDArray, NDArray]:
+        """`motion_detect_with_diff`, run on just the detector's region of interest (if it has one)
+
+        The returned foreground mask is full frame size, with everything outside the region cleared,
+        while the blurred frame (to pass back in next time) is only the region's crop.
+        """
+        if self.roi is None:
+            return self.motion_detect_with_diff(img_arr=img_arr, prev_img_blur_arr=prev_img_blur_arr)
+        roi_mask = self.roi.for_shape(img_arr.shape)
+        crop_fg_mask, img_blur_arr = self.motion_detect_with_diff(
+            img_arr=roi_mask.crop(img_arr),
+            prev_img_blur_arr=prev_img_blur_arr
+        )
+        return roi_mask.expand(crop_fg_mask), img_blur_arr
+
+    def extract_contours(self, fg_mask: NDArray, scale: Tuple[float, float] = (1, 1)) -> List[NDArray]:
+        """Traces the outlines of moving blobs within the area thresholds
+
+        Args:
+            scale: x & y factors to scale the contours up by (see `mask_scale`). Area thresholds apply
+                to the scaled-up contours, so they mean the same whatever resolution detection ran at.
+        """
         contours, hierarchy = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        area_scale = scale[0] * scale[1]
         # Filter contours by area thresholds
         target_cntrs = []
         for cnt in contours:
-            contour_area = cv2.contourArea(cnt)
+            contour_area = cv2.contourArea(cnt) * area_scale
             if self.DEFAULT_MAX_CONTOUR_AREA > contour_area > self.DEFAULT_MIN_CONTOUR_AREA:
                 target_cntrs.append(cnt)
         if n_cntrs := len(target_cntrs) > 0:
             logger.debug(f'{n_cntrs} to be applied to frame.')
+        if scale != (1, 1):
+            target_cntrs = [np.round(cnt * scale).astype(np.int32) for cnt in target_cntrs]
         return target_cntrs
 
-    @staticmethod
-    def contouring_normal(img_arr: NDArray, contours: List[NDArray]) -> NDArray:
+    def extract_regions(self, fg_mask: NDArray, scale: Tuple[float, float] = (1, 1)) -> MotionRegions:
+        """Finds moving regions via connected-component stats, as a faster alternative to `extract_contours`
+
+        Boxes, areas and centroids for every blob come out of a single call, and the area filter is
+        applied as an array mask, so unlike `extract_contours` there's no per-blob Python work. That matters
+        most on busy frames with many blobs; for a handful of blobs, tracing contours is about as fast.
+        Note that areas here are pixel counts, whereas `extract_contours` filters on the area enclosed by
+        the traced outline, so the two can differ slightly at the limits.
+
+        Args:
+            scale: x & y factors to scale the regions up by (see `mask_scale`), as with `extract_contours`
+        """
+        _, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            fg_mask, 8, cv2.CV_32S, cv2.CCL_SPAGHETTI
+        )
+        # Row 0 is the background
+        stats, centroids = stats[1:], centroids[1:]
+        areas = stats[:, cv2.CC_STAT_AREA] * (scale[0] * scale[1])
+        is_target = (areas > self.DEFAULT_MIN_CONTOUR_AREA) & (areas < self.DEFAULT_MAX_CONTOUR_AREA)
+        regions = MotionRegions(
+            boxes=np.round(stats[is_target, :4] * (scale * 2)).astype(np.int32),
+            areas=np.round(areas[is_target]).astype(np.int32),
+            centroids=centroids[is_target] * scale
+        )
+        if n_regions := len(regions.areas):
+            logger.debug(f'{n_regions} regions to be applied to frame.')
+        return regions
+
+    @classmethod
+    def render_regions(
+            cls,
+            img_arr: NDArray,
+            regions: MotionRegions,
+            in_place: bool = False,
+            box_color: Tuple[int, ...] = RED,
+            thickness: int = 1
+    ) -> NDArray:
+        """Draws every region's bounding box onto the frame in a single `polylines` call"""
+        img_arr_out = img_arr if in_place else img_arr.copy()
+        if len(regions.boxes) > 0:
+            cv2.polylines(img_arr_out, cls.boxes_to_polys(regions.boxes), isClosed=True, color=box_color,
+                          thickness=thickness)
+        return img_arr_out
+
+    @classmethod
+    def contouring_normal(cls, img_arr: NDArray, contours: List[NDArray], in_place: bool = False) -> NDArray:
         """The 'normal' contouring method - just drawing on the frame"""
-        for i, cnt in enumerate(contours):
-            # logger.debug(f'Contour ({i + 1}) area: {cv2.contourArea(cnt)}')
-            x, y, w, h = cv2.boundingRect(cnt)
-            thickness = 1
-            color = (255, 0, 0)
-            img_arr = cv2.drawContours(img_arr.copy(), cnt, -1, (0, 255, 0), 1)
-            img_arr = cv2.rectangle(img_arr, (x, y), (x + w, y + h), color, thickness)
+        return cls.render_contours(img_arr, contours=contours, in_place=in_place)
 
-            # cntrs_out.append(((x, y), (x + w, y + h)))
-        return img_arr
+    @classmethod
+    def render_contours(
+            cls,
+            img_arr: NDArray,
+            contours: List[NDArray],
+            in_place: bool = False,
+            contour_color: Tuple[int, ...] = GREEN,
+            box_color: Tuple[int, ...] = RED,
+            thickness: int = 1
+    ) -> NDArray:
+        """Draws every contour, then every contour's bounding box, onto the frame
+
+        All contours go down in one `drawContours` call and all boxes in one `polylines` call, on a single
+        working copy of the frame (or the frame itself with `in_place`), so the cost barely moves
+        with the number of contours.
+        """
+        img_arr_out = img_arr if in_place else img_arr.copy()
+        if len(contours) == 0:
+            return img_arr_out
+        cv2.drawContours(img_arr_out, contours, -1, contour_color, thickness)
+        boxes = np.array([cv2.boundingRect(cnt) for cnt in contours], dtype=np.int32)
+        cv2.polylines(img_arr_out, cls.boxes_to_polys(boxes), isClosed=True, color=box_color, thickness=thickness)
+        return img_arr_out
+
+    @staticmethod
+    def boxes_to_polys(boxes: NDArray) -> NDArray:
+        """Converts an (N, 4) array of x, y, w, h boxes into (N, 4, 2) corner points for `cv2.polylines`"""
+        x, y, w, h = boxes.T
+        return np.stack([
+            np.stack([x, y], axis=1),
+            np.stack([x + w, y], axis=1),
+            np.stack([x + w, y + h], axis=1),
+            np.stack([x, y + h], axis=1),
+        ], axis=1).astype(np.int32)
 
     @staticmethod
     def contouring_optimized(
@@ -231,3 +558,73 @@ class MotionDetector:
                                        upperb=np.array([255, 255, 255, 255]))
 
         return img_arr_out, img_cnt_mask
+
+    def _next_cnt_mask_buf(self, shape: Tuple[int, int]) -> NDArray:
+        if len(self._cnt_mask_bufs) != 2 or self._cnt_mask_bufs[0].shape != shape:
+            self._cnt_mask_bufs = [np.zeros(shape, dtype=np.uint8) for _ in range(2)]
+        self._cnt_mask_bufs.reverse()
+        buf = self._cnt_mask_bufs[0]
+        buf.fill(0)
+        return buf
+
+    def contouring_optimized_arr(
+            self,
+            i: int,
+            img_arr: NDArray,
+            fg_mask: NDArray,
+            past_mask: Optional[NDArray],
+            contours: List[NDArray],
+            in_place: bool = False,
+            boxes: Optional[NDArray] = None
+    ) -> Tuple[NDArray, Optional[NDArray]]:
+        """Array-only equivalent of `contouring_optimized`, producing bit-identical output
+
+        The masks involved are always binary (0 or 255, from `threshold` / the contour mask), so PIL's alpha
+        pasting reduces to selecting pixels, which is done here with boolean indexing on the frame itself.
+        Contours and their bounding boxes are drawn straight onto the frame (pasting a fully opaque
+        contour layer is the same as drawing on top), with a single-channel copy of the strokes drawn
+        alongside to serve as the next frame's past mask.
+
+        Args:
+            in_place: write into img_arr rather than a copy of it. Only safe when the caller
+                has no further use for the original frame.
+            boxes: (N, 4) x, y, w, h boxes (e.g., from `extract_regions`) to draw in addition to the contours
+        """
+        img_arr_out = img_arr if in_place else img_arr.copy()
+        alpha = img_arr_out[..., 3]
+        past_mask_sel = past_mask > 0 if past_mask is not None else None
+
+        if i == 0:
+            # Don't do anything to the background
+            pass
+        elif not fg_mask.any():
+            # If no foreground activity, blank out the image - apart from where the past mask shows through.
+            if past_mask_sel is None:
+                img_arr_out[:] = (255, 255, 255, 0)
+            else:
+                img_arr_out[~past_mask_sel] = (255, 255, 255, 0)
+        else:
+            # Apply activity mask to image
+            alpha[:] = fg_mask
+
+        if past_mask_sel is not None:
+            # The past mask's area of the original frame goes back in fully opaque
+            alpha[past_mask_sel] = 255
+
+        has_boxes = boxes is not None and len(boxes) > 0
+        if len(contours) == 0 and not has_boxes:
+            return img_arr_out, None
+
+        # Make a mask of the contour strokes to pass in to the next iteration
+        img_cnt_mask = self._next_cnt_mask_buf(fg_mask.shape)
+        for cnt in contours:
+            x, y, w, h = cv2.boundingRect(cnt)
+            # Draw order matters where one contour's box crosses another's outline, so keep it per contour
+            for target, green, red in ((img_arr_out, self.GREEN_TRANSP, self.RED_TRANSP), (img_cnt_mask, 255, 255)):
+                cv2.drawContours(target, cnt, -1, green, 1)
+                cv2.rectangle(target, (x, y), (x + w, y + h), red, 1)
+        if has_boxes:
+            polys = self.boxes_to_polys(boxes)
+            cv2.polylines(img_arr_out, polys, isClosed=True, color=self.RED_TRANSP, thickness=1)
+            cv2.polylines(img_cnt_mask, polys, isClosed=True, color=255, thickness=1)
+        return img_arr_out, img_cnt_mask
@@ -1,7 +1,21 @@
-from pathlib import Path
+from typing import List
 
 from slack_sdk import WebClient
 
+from vidya.core.artifacts import Artifact
 
-def upload_to_slack(filepath: Path, slack_client: WebClient, channel: str, text: str = ''):
-    return slack_client.files_upload_v2(channel=channel, file=filepath, initial_comment=text)
+
+def upload_to_slack(artifacts: List[Artifact], slack_client: WebClient, channel: str, text: str = ''):
+    """Uploads one or more in-memory artifacts as a single message"""
+    if len(artifacts) == 1:
+        return slack_client.files_upload_v2(
+            channel=channel,
+            content=artifacts[0].content,
+            filename=artifacts[0].filename,
+            initial_comment=text
+        )
+    return slack_client.files_upload_v2(
+        channel=channel,
+        file_uploads=[{'content': x.content, 'filename': x.filename, 'title': x.filename} for x in artifacts],
+        initial_comment=text
+    )
@@ -0,0 +1,193 @@
+from concurrent.futures import (  # noqa: F401
+    Future,
+    ProcessPoolExecutor,
+)
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import threading
+from typing import (  # noqa: F401
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import cv2
+from loguru import logger
+import numpy as np
+from numpy.typing import NDArray
+
+from vidya.core.motion_detect import (
+    MotionDetectionType,
+    MotionDetector,
+)
+from vidya.core.roi import RegionOfInterest
+
+
+class _SharedArray(NamedTuple):
+    """How a worker finds an array in shared memory"""
+    name: str
+    shape: Tuple[int, ...]
+
+    def attach(self) -> Tuple[shared_memory.SharedMemory, NDArray]:
+        shm = shared_memory.SharedMemory(name=self.name)
+        return shm, np.ndarray(self.shape, dtype=np.uint8, buffer=shm.buf)
+
+
+def _init_worker():
+    # Each worker handles one chunk at a time, so OpenCV's own threads would only compete with the other workers
+    cv2.setNumThreads(1)
+
+
+def _detect_chunk(
+        frames_ref: _SharedArray,
+        masks_ref: _SharedArray,
+        start: int,
+        stop: int,
+        prev_blur: Optional[NDArray],
+        detect_width: Optional[int],
+        roi: Optional[RegionOfInterest]
+) -> NDArray:
+    """Detects motion on frames[start:stop], writing their masks into the shared mask stack
+
+    The first chunk picks up from `prev_blur` (the clip's last blurred frame so far). Later chunks
+    can't wait on the chunk before them, so they start one frame early and diff against that.
+
+    Returns:
+        the chunk's last blurred frame
+    """
+    frames_shm, frames = frames_ref.attach()
+    masks_shm, masks = masks_ref.attach()
+    try:
+        md = MotionDetector(detection_type=MotionDetectionType.DIFF, roi=roi, detect_width=detect_width)
+        lead_in = 0 if start == 0 else 1
+        md._prev_img_blur_arr = prev_blur
+        chunk_masks, _ = md.batch_motion_detect_with_diff(
+            np.stack([md.downscale(x) for x in frames[start - lead_in:stop]]))
+        masks[start:stop] = chunk_masks[lead_in:]
+        return md._prev_img_blur_arr
+    finally:
+        # Views into the blocks have to go before the blocks can be closed
+        del frames, masks
+        frames_shm.close()
+        masks_shm.close()
+
+
+class DetectionPool:
+    """Runs diff detection for a clip's frames across a pool of processes, so one long clip can use every core
+
+    Frames are copied once into a shared memory block, which the workers read directly (rather
+    than having every frame pickled across), and workers write their masks into a second block.
+    Each worker takes a chunk of `chunk_size` frames. Diffing needs the previous frame's blur, so each
+    chunk but the first also blurs the frame before it rather than waiting on the chunk that has it.
+
+    Batches no bigger than a chunk aren't worth the round trip and are detected in-process. Only DIFF
+    detection is farmed out - BGSUB works off the camera's single, stateful background model.
+
+    Processes can't be started from a daemonic process, and Celery's prefork workers are daemonic,
+    so the pool only runs for workers started with `--pool threads` or `--pool solo`. Elsewhere,
+    detection stays in-process.
+    """
+    def __init__(self, max_workers: int, chunk_size: int = 4):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+        self._lock = threading.Lock()
+        self._detect_shapes = {}  # type: Dict[Tuple[Tuple[int, ...], Optional[int]], Tuple[int, int]]
+
+    @classmethod
+    def from_env(cls) -> Optional['DetectionPool']:
+        """Reads DETECT_PROCESSES (0, the default, leaves detection in-process) & DETECT_CHUNK_SIZE"""
+        max_workers = int(os.getenv('DETECT_PROCESSES', '0'))
+        if max_workers <= 0:
+            return None
+        return cls(max_workers=max_workers, chunk_size=int(os.getenv('DETECT_CHUNK_SIZE', '4')))
+
+    @property
+    def max_batch(self) -> int:
+        """The most frames worth handing over at once - a chunk for every worker"""
+        return self.chunk_size * self.max_workers
+
+    @staticmethod
+    def _in_daemon() -> bool:
+        if multiprocessing.current_process().daemon:
+            return True
+        try:
+            from billiard.process import current_process as billiard_current_process
+        except ImportError:
+            return False
+        return bool(billiard_current_process().daemon)
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        with self._lock:
+            if self._executor is None:
+                if self._in_daemon():
+                    logger.warning('Running in a daemonic process - motion detection will stay in-process.')
+                    self.max_workers = 0
+                    return None
+                # Forking a process that's running capture threads risks copying held locks,
+                #   so workers come from a clean server process instead.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    def can_run(self, detector: MotionDetector) -> bool:
+        return self.max_workers > 0 and detector.detection_type == MotionDetectionType.DIFF
+
+    def _detect_shape(self, detector: MotionDetector, frame: NDArray) -> Tuple[int, int]:
+        key = (frame.shape, detector.detect_width)
+        shape = self._detect_shapes.get(key)
+        if shape is None:
+            shape = self._detect_shapes[key] = detector.downscale(frame).shape[:2]
+        return shape
+
+    def detect(self, detector: MotionDetector, frames: List[NDArray]) -> NDArray:
+        """Detects motion on the next frames of the detector's clip, returning their (N, H, W) foreground masks
+
+        Masks come back at the detector's detection resolution, ready for `MotionDetector._render_frame`.
+        Like `MotionDetector.batch_motion_detect_with_diff`, this picks up from (and updates)
+        the previous blurred frame kept on the detector.
+        """
+        executor = None
+        if len(frames) > self.chunk_size and all(x.shape == frames[0].shape for x in frames):
+            executor = self._get_executor()
+        if executor is None:
+            return detector.batch_motion_detect_with_diff(np.stack([detector.downscale(x) for x in frames]))[0]
+
+        n = len(frames)
+        masks_shape = (n, *self._detect_shape(detector, frames[0]))
+        frames_shm = shared_memory.SharedMemory(create=True, size=n * frames[0].nbytes)
+        masks_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(masks_shape)))
+        try:
+            frames_arr = np.ndarray((n, *frames[0].shape), dtype=np.uint8, buffer=frames_shm.buf)
+            for i, frame in enumerate(frames):
+                frames_arr[i] = frame
+            del frames_arr
+            frames_ref = _SharedArray(name=frames_shm.name, shape=(n, *frames[0].shape))
+            masks_ref = _SharedArray(name=masks_shm.name, shape=masks_shape)
+
+            futures = []  # type: List[Future]
+            for start in range(0, n, self.chunk_size):
+                futures.append(executor.submit(
+                    _detect_chunk, frames_ref, masks_ref, start, min(start + self.chunk_size, n),
+                    detector._prev_img_blur_arr if start == 0 else None, detector.detect_width, detector.roi
+                ))
+            last_blur = [x.result() for x in futures][-1]
+            detector._prev_img_blur_arr = last_blur
+            return np.ndarray(masks_shape, dtype=np.uint8, buffer=masks_shm.buf).copy()
+        finally:
+            frames_shm.close()
+            frames_shm.unlink()
+            masks_shm.close()
+            masks_shm.unlink()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,232 @@
+import queue
+import threading
+from typing import (  # noqa: F401
+    TYPE_CHECKING,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+
+from PIL import Image
+import cv2
+from loguru import logger
+from numpy.typing import NDArray
+
+from vidya.core.motion_detect import MotionDetector
+
+if TYPE_CHECKING:
+    from vidya.core.parallel_detect import DetectionPool
+
+
+class _StageFailure:
+    """Carries an exception raised in a stage thread across a queue to the consumer"""
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class FramePipeline:
+    """Streams frames through capture -> motion detection -> consumer, with each stage running concurrently
+
+    The capture stage (iterating `frames`) and the detection stage each run in their own thread,
+    handing frames on through bounded queues, so the consumer (typically the GIF encoder) works on
+    frame N while frame N + 1 is being detected and frame N + 2 is being read. Only `max_queued`
+    frames are held between any two stages, rather than the whole clip.
+
+    With a `pool` (see `DetectionPool`), the detection stage takes every frame that's queued up
+    at once and spreads their detection across the pool's processes, then contours them in order.
+    The queue into detection is sized to a full batch for the pool, so a backlog (e.g., a pre-roll
+    splice or a slow consumer) gets cleared on every core.
+
+    Iterate over the pipeline to receive processed frames as `PIL.Image`s. Once exhausted,
+    `avg_cntrs_per_frame` holds the clip's motion score.
+    """
+    _DONE = object()
+    PUT_TIMEOUT = 0.5   # Seconds between checks for cancellation when a queue is full
+
+    def __init__(self, frames: Iterable[NDArray], detector: MotionDetector, max_queued: int = 4,
+                 pool: Optional['DetectionPool'] = None):
+        self.frames = frames
+        self.detector = detector
+        self.max_queued = max_queued
+        self.pool = pool if pool is not None and pool.can_run(detector) else None
+
+        self._cancel = threading.Event()
+        self.cntrs_per_frame = []  # type: List[int]
+
+    @property
+    def avg_cntrs_per_frame(self) -> float:
+        try:
+            return sum(self.cntrs_per_frame) / len(self.cntrs_per_frame)
+        except ZeroDivisionError:
+            return 0
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """Puts to a bounded queue, giving up if the pipeline has been cancelled downstream"""
+        while not self._cancel.is_set():
+            try:
+                q.put(item, timeout=self.PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _capture_stage(self, out_q: queue.Queue):
+        try:
+            for frame in self.frames:
+                if not self._put(out_q, frame):
+                    return
+        except BaseException as exc:
+            self._put(out_q, _StageFailure(exc))
+            return
+        self._put(out_q, self._DONE)
+
+    def _detect_stage(self, in_q: queue.Queue, out_q: queue.Queue):
+        self.detector.reset()
+        while True:
+            item = in_q.get()
+            if item is self._DONE or isinstance(item, _StageFailure):
+                self._put(out_q, item)
+                return
+            try:
+                frame_arr, n_cntrs = self.detector.process_frame(item)
+                item = (Image.fromarray(frame_arr), n_cntrs)
+            except BaseException as exc:
+                self._put(out_q, _StageFailure(exc))
+                self._cancel.set()
+                return
+            if not self._put(out_q, item):
+                return
+
+    def _batch_detect_stage(self, in_q: queue.Queue, out_q: queue.Queue):
+        self.detector.reset()
+        while True:
+            # Wait on the next frame, then take whatever else has queued up behind it
+            batch = [in_q.get()]
+            while len(batch) < self.pool.max_batch and not self._is_end(batch[-1]):
+                try:
+                    batch.append(in_q.get_nowait())
+                except queue.Empty:
+                    break
+            end = batch.pop() if self._is_end(batch[-1]) else None
+            try:
+                fg_masks = self.pool.detect(self.detector, batch) if len(batch) > 0 else []
+                for frame, fg_mask in zip(batch, fg_masks):
+                    frame_arr, n_cntrs = self.detector._render_frame(
+                        cv2.cvtColor(frame, self.detector.color_style), fg_mask=fg_mask)
+                    if not self._put(out_q, (Image.fromarray(frame_arr), n_cntrs)):
+                        return
+            except BaseException as exc:
+                self._put(out_q, _StageFailure(exc))
+                self._cancel.set()
+                return
+            if end is not None:
+                self._put(out_q, end)
+                return
+
+    def _is_end(self, item) -> bool:
+        return item is self._DONE or isinstance(item, _StageFailure)
+
+    def __iter__(self) -> Iterator[Image.Image]:
+        max_raw = self.max_queued if self.pool is None else max(self.max_queued, self.pool.max_batch)
+        raw_q = queue.Queue(maxsize=max_raw)
+        done_q = queue.Queue(maxsize=self.max_queued)
+        threads = [
+            threading.Thread(target=self._capture_stage, args=(raw_q, ), name='pipeline-capture', daemon=True),
+            threading.Thread(target=self._detect_stage if self.pool is None else self._batch_detect_stage,
+                             args=(raw_q, done_q), name='pipeline-detect', daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        logger.debug('Pipeline started')
+        try:
+            while True:
+                item = done_q.get()
+                if item is self._DONE:
+                    break
+                if isinstance(item, _StageFailure):
+                    raise item.exc
+                img, n_cntrs = item
+                self.cntrs_per_frame.append(n_cntrs)
+                yield img
+        finally:
+            # Whether we finished, failed or the consumer stopped early, let the stages wind down
+            self._cancel.set()
+            self._drain(raw_q)
+            for thread in threads:
+                thread.join(timeout=self.PUT_TIMEOUT * 2)
+            logger.debug(f'Pipeline finished after {len(self.cntrs_per_frame)} frames')
+
+    @staticmethod
+    def _drain(q: queue.Queue):
+        """Empties a queue so a stage blocked on `get` can see the end of the stream"""
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            q.put_nowait(FramePipeline._DONE)
+        except queue.Full:
+            pass
+
+
+class MotionGate:
+    """Holds back a pipeline's frames until the clip is sure to be kept, so quiet clips are never encoded
+
+    A clip is kept when it averages at least `min_avg_cntrs` contours per frame. Frames are buffered
+    until the contours seen so far meet that over the `n_expected` frames of the clip, then the buffer
+    and every frame after it pass straight through. If the buffer fills first without a single contour,
+    the clip's dropped there and then. If it fills with some motion in it, frames start passing through
+    anyway (to keep memory bounded) and the verdict waits for the end of the clip.
+
+    With `quiet_frames` set, a clip that hasn't been let through yet is cut short once that many frames
+    in a row show no motion. Once iteration stops, `skip_reason` says why the clip should be dropped
+    (None if it shouldn't).
+    """
+    MAX_BUFFERED = 30
+
+    def __init__(self, pipeline: FramePipeline, n_expected: int, min_avg_cntrs: float = 0.1, quiet_frames: int = 0,
+                 max_buffered: int = MAX_BUFFERED):
+        self.pipeline = pipeline
+        self.n_expected = n_expected
+        self.min_avg_cntrs = min_avg_cntrs
+        self.quiet_frames = quiet_frames
+        self.max_buffered = max_buffered
+        self.skip_reason = None  # type: Optional[str]
+
+    def __iter__(self) -> Iterator[Image.Image]:
+        buffered = []  # type: List[Image.Image]
+        is_open = False
+        n_quiet = 0
+        for img in self.pipeline:
+            if is_open:
+                yield img
+                continue
+            buffered.append(img)
+            n_cntrs = self.pipeline.cntrs_per_frame[-1]
+            n_quiet = 0 if n_cntrs > 0 else n_quiet + 1
+            if sum(self.pipeline.cntrs_per_frame) >= self.min_avg_cntrs * self.n_expected:
+                logger.debug(f'Motion threshold met after {len(buffered)} frames')
+                is_open = True
+            elif 0 < self.quiet_frames <= n_quiet:
+                self.skip_reason = f'No motion for {n_quiet} frames in a row'
+                return
+            elif len(buffered) >= self.max_buffered and sum(self.pipeline.cntrs_per_frame) == 0:
+                self.skip_reason = f'No motion in the first {len(buffered)} frames'
+                return
+            elif len(buffered) >= self.max_buffered:
+                logger.debug(f'Buffered {len(buffered)} frames without a verdict - passing frames on regardless')
+                is_open = True
+            if is_open:
+                yield from buffered
+                buffered.clear()
+
+        avg_cntrs = self.pipeline.avg_cntrs_per_frame
+        if avg_cntrs < self.min_avg_cntrs:
+            self.skip_reason = (f'Average contours per frame ({avg_cntrs:.2f}) was below '
+                                f'threshold ({self.min_avg_cntrs})')
+        else:
+            # The clip ended short of n_expected frames without the gate opening, but it's being kept
+            yield from buffered
@@ -0,0 +1,14 @@
+from functools import lru_cache
+import os
+from typing import Optional
+
+import redis
+
+
+@lru_cache(maxsize=None)
+def get_redis(url: Optional[str] = None) -> redis.Redis:
+    """Returns a process-wide Redis client for the given url (defaults to REDIS_URL, the Celery broker)
+
+    Clients are built lazily and don't connect until first used, so this is safe to call at startup.
+    """
+    return redis.Redis.from_url(url or os.environ['REDIS_URL'])
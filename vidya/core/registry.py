@@ -0,0 +1,86 @@
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import threading
+from typing import (  # noqa: F401
+    TYPE_CHECKING,
+    Dict,
+    Iterator,
+    List,
+)
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from vidya.core.camera import IPCamera
+
+
+class CameraRegistry(Mapping):
+    """Maps camera ids to cameras, only building each camera the first time it's looked up
+
+    Listing or checking ids never touches the cameras, and the camera class itself (along with OpenCV,
+    PIL & co.) isn't imported until a camera is actually needed. That lets the web tier, which only
+    enqueues tasks, start without importing any of that or contacting a camera.
+    """
+    DEFAULT_CAMERA_CLASS = 'vidya.core.camera.IPCamera'
+
+    def __init__(self, cam_ids: List[int], camera_class: str = DEFAULT_CAMERA_CLASS):
+        self.cam_ids = list(cam_ids)
+        self.camera_class = camera_class
+        self._cams = {}  # type: Dict[int, IPCamera]
+        self._lock = threading.Lock()
+
+    def _build(self, cam_id: int) -> 'IPCamera':
+        module_name, class_name = self.camera_class.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module_name), class_name)
+        return cls(cam_id)
+
+    def __getitem__(self, cam_id: int) -> 'IPCamera':
+        if cam_id not in self.cam_ids:
+            raise KeyError(cam_id)
+        cam = self._cams.get(cam_id)
+        if cam is None:
+            with self._lock:
+                cam = self._cams.get(cam_id)
+                if cam is None:
+                    cam = self._cams[cam_id] = self._build(cam_id)
+        return cam
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.cam_ids)
+
+    def __len__(self) -> int:
+        return len(self.cam_ids)
+
+    def __contains__(self, cam_id) -> bool:
+        return cam_id in self.cam_ids
+
+    def loaded(self) -> List['IPCamera']:
+        """Cameras that have been built so far"""
+        return list(self._cams.values())
+
+    def warm_up(self):
+        """Builds every camera and logs each in, all at once, so no capture pays for it later
+
+        A camera that fails to log in is logged and skipped - it'll try again on first use.
+        """
+        def _warm(cam_id: int):
+            try:
+                self[cam_id].ensure_token()
+            except Exception:
+                logger.exception(f'Unable to warm up camera {cam_id} - will retry on first use.')
+
+        if len(self.cam_ids) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=len(self.cam_ids)) as executor:
+            list(executor.map(_warm, self.cam_ids))
+
+    def start_warm_up(self) -> threading.Thread:
+        """Runs `warm_up` in a background (daemon) thread, returning straight away
+
+        For callers that can't wait out an unreachable camera's login attempts. A capture that needs
+        a camera before it's warmed up logs it in itself.
+        """
+        thread = threading.Thread(target=self.warm_up, name='warm-up-cameras', daemon=True)
+        thread.start()
+        return thread
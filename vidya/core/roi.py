@@ -0,0 +1,90 @@
+import json
+import os
+from typing import (  # noqa: F401
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+Polygon = List[Tuple[float, float]]
+
+
+class ROIMask(NamedTuple):
+    """A region of interest worked out for one frame size"""
+    mask: NDArray   # (H, W) - 255 where motion counts, 0 where it doesn't
+    top: int        # Bounds of the mask's included area - detection only needs to look within these
+    bottom: int
+    left: int
+    right: int
+
+    def crop(self, arr: NDArray, is_stack: bool = False) -> NDArray:
+        """The part of a frame (or (N, H, W, ...) stack of frames) that detection needs to look at"""
+        if is_stack:
+            return arr[:, self.top:self.bottom, self.left:self.right]
+        return arr[self.top:self.bottom, self.left:self.right]
+
+    def expand(self, crop_fg_mask: NDArray) -> NDArray:
+        """Places a foreground mask detected on the crop back into a full frame mask, with excluded areas cleared"""
+        fg_mask = np.zeros_like(self.mask)
+        fg_mask[self.top:self.bottom, self.left:self.right] = cv2.bitwise_and(
+            crop_fg_mask, self.mask[self.top:self.bottom, self.left:self.right])
+        return fg_mask
+
+    def restrict(self, fg_mask: NDArray) -> NDArray:
+        """Clears excluded areas from a full frame foreground mask"""
+        return cv2.bitwise_and(fg_mask, self.mask)
+
+
+class RegionOfInterest:
+    """Where in a camera's view motion counts
+
+    Given as polygons of (x, y) points, normalized to 0-1 so they hold at any frame size. Motion counts
+    inside any of the `include` polygons (the whole frame if there are none) but never inside an
+    `exclude` polygon (trees, roads, timestamp overlays...).
+
+    Each frame size's mask is only worked out once, along with the bounding box of what's included,
+    so detection can run on just that crop.
+    """
+    def __init__(self, include: List[Polygon] = None, exclude: List[Polygon] = None):
+        self.include = include or []
+        self.exclude = exclude or []
+        self._masks = {}  # type: Dict[Tuple[int, int], ROIMask]
+
+    @classmethod
+    def from_env(cls, cam_id: int) -> Optional['RegionOfInterest']:
+        """Reads CAM_<id>_ROI & CAM_<id>_ROI_EXCLUDE - JSON lists of polygons, e.g., [[[0, 0.5], [1, 0.5], [1, 1]]]
+
+        Returns None if neither is set.
+        """
+        include, exclude = [json.loads(os.getenv(f'CAM_{cam_id}_ROI{x}', '[]')) for x in ('', '_EXCLUDE')]
+        if len(include) == 0 and len(exclude) == 0:
+            return None
+        return cls(include=include, exclude=exclude)
+
+    @staticmethod
+    def _to_pixels(polygons: List[Polygon], h: int, w: int) -> List[NDArray]:
+        return [np.round(np.array(poly, dtype=np.float64) * (w - 1, h - 1)).astype(np.int32) for poly in polygons]
+
+    def for_shape(self, shape: Tuple[int, ...]) -> ROIMask:
+        """Returns the mask for frames of this (H, W, ...) shape"""
+        h, w = shape[:2]
+        roi_mask = self._masks.get((h, w))
+        if roi_mask is None:
+            if len(self.include) == 0:
+                mask = np.full((h, w), 255, dtype=np.uint8)
+            else:
+                mask = np.zeros((h, w), dtype=np.uint8)
+                cv2.fillPoly(mask, self._to_pixels(self.include, h, w), 255)
+            if len(self.exclude) > 0:
+                cv2.fillPoly(mask, self._to_pixels(self.exclude, h, w), 0)
+            x, y, crop_w, crop_h = cv2.boundingRect(mask)
+            if crop_w == 0 or crop_h == 0:
+                raise ValueError('Region of interest excludes the whole frame')
+            roi_mask = self._masks[(h, w)] = ROIMask(mask=mask, top=y, bottom=y + crop_h, left=x, right=x + crop_w)
+        return roi_mask
@@ -0,0 +1,123 @@
+import os
+import time
+from typing import Optional
+
+from loguru import logger
+import redis
+from redis.exceptions import LockError
+from redis.lock import Lock
+
+
+class StreamLimitReached(RuntimeError):
+    """A camera already has as many streams open as it's allowed"""
+
+
+class StreamSlot:
+    """One of a camera's stream slots, held until released
+
+    The slot's lock expires after the limiter's lease, so whoever holds it for longer than that (e.g., a
+    capture worker keeping its stream open) has to `renew` it every so often. Without a lock (Redis was
+    unreachable when it was taken) the slot doesn't limit anything, and renewing it always succeeds.
+    """
+    def __init__(self, cam_id: int, lock: Optional[Lock], lease_seconds: int):
+        self.cam_id = cam_id
+        self._lock = lock
+        self.renew_interval = lease_seconds / 3
+        self._last_renewed = time.monotonic()
+
+    def renew(self) -> bool:
+        """Restarts the slot's lease, returning False if it had already run out and the slot was lost"""
+        if self._lock is None:
+            return True
+        try:
+            self._lock.reacquire()
+        except LockError:
+            return False
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to renew stream slot for camera {self.cam_id} ({exc}) - keeping it anyway.')
+        self._last_renewed = time.monotonic()
+        return True
+
+    def renew_if_due(self) -> bool:
+        """Renews the slot if a third of its lease has passed since it was last renewed (see `renew`)"""
+        if time.monotonic() - self._last_renewed < self.renew_interval:
+            return True
+        return self.renew()
+
+    def release(self):
+        if self._lock is None:
+            return
+        try:
+            self._lock.release()
+        except redis.RedisError:
+            # Lease ran out first - the slot has already freed up
+            pass
+        self._lock = None
+
+
+class StreamLimiter:
+    """Caps how many streams each camera has open at once, across every worker
+
+    Each camera gets `max_streams` slots, each a Redis lock that expires after `lease_seconds` so a
+    worker that dies while streaming can't hold its slot forever. Redis being unreachable never blocks a
+    stream - it's just not limited.
+    """
+    KEY_PREFIX = 'vidya:stream'
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, redis_client: redis.Redis, max_streams: int = 1, lease_seconds: int = 120):
+        self.redis_client = redis_client
+        self.max_streams = max_streams
+        self.lease_seconds = lease_seconds
+
+    @classmethod
+    def from_env(cls, redis_client: redis.Redis) -> 'StreamLimiter':
+        return cls(
+            redis_client,
+            max_streams=int(os.getenv('MAX_STREAMS_PER_CAM', '1')),
+            lease_seconds=int(os.getenv('STREAM_LEASE_SECONDS', '120'))
+        )
+
+    def _try_acquire(self, cam_id: int) -> Optional[Lock]:
+        for slot in range(self.max_streams):
+            # Not thread-local, as a slot's often taken in one thread and held by another (e.g., a capture worker)
+            lock = self.redis_client.lock(f'{self.KEY_PREFIX}:{cam_id}:{slot}', timeout=self.lease_seconds,
+                                          thread_local=False)
+            if lock.acquire(blocking=False):
+                return lock
+        return None
+
+    def acquire(self, cam_id: int, wait: float = 0) -> Optional[StreamSlot]:
+        """Takes one of the camera's stream slots, to hold until it's released
+
+        Waits up to `wait` seconds for a slot to free up, returning None if none did (the camera's
+        already at its limit), in which case the caller shouldn't open a stream.
+        """
+        if self.max_streams <= 0:
+            return StreamSlot(cam_id, lock=None, lease_seconds=self.lease_seconds)
+        deadline = time.monotonic() + wait
+        try:
+            while (lock := self._try_acquire(cam_id)) is None:
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.POLL_INTERVAL)
+        except redis.RedisError as exc:
+            logger.warning(f'Unable to check stream limit for camera {cam_id} ({exc}) - proceeding anyway.')
+            lock = None
+        return StreamSlot(cam_id, lock=lock, lease_seconds=self.lease_seconds)
+
+
+class SubstreamLimiter(StreamLimiter):
+    """Caps how many of each camera's substreams (see `vidya.motion_daemon`) are open at once
+
+    Substreams are separate streams on the camera, so they're counted apart from its main streams.
+    """
+    KEY_PREFIX = 'vidya:substream'
+
+    @classmethod
+    def from_env(cls, redis_client: redis.Redis) -> 'SubstreamLimiter':
+        return cls(
+            redis_client,
+            max_streams=int(os.getenv('MAX_SUBSTREAMS_PER_CAM', '1')),
+            lease_seconds=int(os.getenv('STREAM_LEASE_SECONDS', '120'))
+        )
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+import fcntl
+import json
+from pathlib import Path
+import threading
+import time
+from typing import (
+    Callable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from loguru import logger
+import redis
+
+from vidya.core.redis_store import get_redis
+
+
+class TokenLease(NamedTuple):
+    token: str
+    expires_at: Optional[float]     # Epoch seconds. None when unknown (e.g., token files from older versions)
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float('inf')
+        return self.expires_at - time.time()
+
+
+class TokenCache:
+    """A camera's API token lease, shared by every worker process
+
+    Leases live in Redis (the same one Celery uses) with a file under `.sessions/` as the fallback
+    whenever Redis can't be reached. Each process also keeps the last lease it read, so the hot path is
+    usually just a clock check.
+
+    Renewals are single-flight: one process logs in while holding a lock (a Redis lock, or `flock`
+    on the fallback file) and the rest pick up its result, so an expiring token doesn't send every
+    worker to the camera's Login API at once. Leases close to their end are renewed in the background
+    while the current token is still handed out, so captures don't wait on the login.
+    """
+    REFRESH_MARGIN = 120    # Seconds before lease end to start renewing
+    LOCK_TIMEOUT = 15       # Seconds to hold / wait on the renewal lock
+    KEY_PREFIX = 'vidya:token'
+
+    def __init__(self, name: str, file_path: Path, redis_url: Optional[str] = None):
+        self.name = name
+        self.file_path = file_path
+        self.redis_url = redis_url
+        self._key = f'{self.KEY_PREFIX}:{name}'
+        self._lease = None  # type: Optional[TokenLease]
+        self._thread_lock = threading.Lock()
+        self._is_refreshing = threading.Lock()
+
+    @property
+    def _redis(self) -> Optional[redis.Redis]:
+        if self.redis_url is None:
+            return None
+        return get_redis(self.redis_url)
+
+    # --- Storage ---
+
+    def _load(self) -> Optional[TokenLease]:
+        if (r := self._redis) is not None:
+            try:
+                raw = r.get(self._key)
+                return None if raw is None else TokenLease(**json.loads(raw))
+            except redis.RedisError as exc:
+                logger.warning(f'Unable to read token for {self.name} from Redis ({exc}) - using file.')
+        if not self.file_path.exists():
+            return None
+        text = self.file_path.read_text().strip()
+        if text.startswith('{'):
+            return TokenLease(**json.loads(text))
+        # Plain token from before leases were tracked
+        return TokenLease(token=text, expires_at=None) if text != '' else None
+
+    def _store(self, lease: TokenLease):
+        payload = json.dumps(lease._asdict())
+        if (r := self._redis) is not None:
+            try:
+                ttl = None if lease.expires_at is None else max(int(lease.remaining()), 1)
+                r.set(self._key, payload, ex=ttl)
+            except redis.RedisError as exc:
+                logger.warning(f'Unable to write token for {self.name} to Redis ({exc}).')
+        # Always keep the file current so a Redis outage doesn't force a fresh login
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file_path.write_text(payload)
+
+    @contextmanager
+    def _single_flight(self) -> Iterator[None]:
+        """Holds the cross-process renewal lock (Redis if available, else a file lock)"""
+        with self._thread_lock:
+            if (r := self._redis) is not None:
+                lock = r.lock(f'{self._key}:lock', timeout=self.LOCK_TIMEOUT, blocking_timeout=self.LOCK_TIMEOUT)
+                try:
+                    is_locked = lock.acquire()
+                except redis.RedisError:
+                    is_locked = None
+                if is_locked is not None:
+                    try:
+                        yield
+                    finally:
+                        if is_locked:
+                            try:
+                                lock.release()
+                            except redis.RedisError:
+                                # Expired while we held it - nothing to release
+                                pass
+                    return
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.file_path.with_suffix('.lock').open('w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # --- Leasing ---
+
+    def _renew(self, login_func: Callable[[], Tuple[str, int]], stale_token: Optional[str] = None) -> TokenLease:
+        with self._single_flight():
+            # Someone else may have renewed while we waited on the lock
+            lease = self._load()
+            if lease is not None and lease.token != stale_token and lease.remaining() > self.REFRESH_MARGIN:
+                self._lease = lease
+                return lease
+            logger.info(f'Renewing token lease for {self.name}.')
+            token, lease_seconds = login_func()
+            lease = TokenLease(token=token, expires_at=time.time() + lease_seconds)
+            self._store(lease)
+            self._lease = lease
+            return lease
+
+    def _renew_in_background(self, login_func: Callable[[], Tuple[str, int]]):
+        if not self._is_refreshing.acquire(blocking=False):
+            # Already on it
+            return
+
+        def _run():
+            try:
+                self._renew(login_func)
+            except Exception:
+                logger.exception(f'Background token renewal failed for {self.name}.')
+            finally:
+                self._is_refreshing.release()
+
+        threading.Thread(target=_run, name=f'token-renew-{self.name}', daemon=True).start()
+
+    def get_token(self, login_func: Callable[[], Tuple[str, int]]) -> str:
+        """Returns a valid token, only blocking on login_func when there's no usable lease at all
+
+        Args:
+            login_func: performs the login, returning the new token and its lease length in seconds
+        """
+        lease = self._lease
+        if lease is None or lease.remaining() <= self.REFRESH_MARGIN:
+            # Maybe another process has renewed it already
+            lease = self._load() or lease
+            self._lease = lease
+        if lease is None or lease.remaining() <= 0:
+            lease = self._renew(login_func, stale_token=None if lease is None else lease.token)
+        elif lease.remaining() <= self.REFRESH_MARGIN:
+            self._renew_in_background(login_func)
+        return lease.token
+
+    def invalidate(self, token: str, login_func: Callable[[], Tuple[str, int]]) -> str:
+        """Handles a token the camera rejected, returning a replacement
+
+        Only the first process to report a given token logs in again; the rest receive its replacement.
+        """
+        self._lease = None
+        return self._renew(login_func, stale_token=token).token
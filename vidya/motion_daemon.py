@@ -0,0 +1,355 @@
+"""Watches every camera's substream for motion and triggers snapshots / GIFs itself, rather than waiting on the NVR
+
+Each camera gets a watcher thread that keeps its low-resolution substream open (CAM_<id>_SUBSTREAM),
+decodes it, runs diff detection on a few frames a second, and queues the same tasks `/cam/<id>/snap` and
+`/cam/<id>/gif` do when motion starts. Cameras without a substream are watched through the capture service's
+frame ring (with CAPTURE_SOURCE=RING), else on the main stream whenever one of its stream slots is free.
+Triggers go through the trigger coalescer, so they merge with any the NVR sends for the same motion.
+
+    python -m vidya.motion_daemon
+"""
+from datetime import datetime
+import os
+import signal
+import threading
+import time
+from typing import (  # noqa: F401
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from celery import Celery  # noqa: F401
+import cv2
+from loguru import logger
+import numpy as np
+from numpy.typing import NDArray
+
+from vidya.app import create_app
+from vidya.core.camera import IPCamera
+from vidya.core.capture import CaptureSource
+from vidya.core.coalesce import (
+    TriggerCoalescer,
+    TriggerMode,
+)
+from vidya.core.formats import OutputFormat
+from vidya.core.frame_ring import SharedFrameRing
+from vidya.core.motion_detect import (
+    MotionDetectionType,
+    MotionDetector,
+)
+from vidya.core.redis_store import get_redis
+from vidya.core.registry import CameraRegistry  # noqa: F401
+from vidya.core.stream_limit import (
+    StreamLimiter,
+    StreamSlot,
+    SubstreamLimiter,
+)
+from vidya.routes.camera import (
+    TASK_NAME_GIF,
+    TASK_NAME_SNAPSHOT,
+)
+
+
+class CaptureTrigger:
+    """Queues captures for a camera the way the trigger endpoints do"""
+    def __init__(self, celery_app: Celery, coalescer: TriggerCoalescer, modes: List[TriggerMode],
+                 take_seconds: int = 5):
+        self.celery_app = celery_app
+        self.coalescer = coalescer
+        self.modes = modes
+        self.take_seconds = take_seconds
+        self.output_format = OutputFormat(os.getenv('OUTPUT_FORMAT', OutputFormat.GIF).lower())
+
+    def fire(self, cam_id: int, is_continuing: bool = False):
+        """Queues each mode's capture, unless one's already pending
+
+        Args:
+            is_continuing: the motion that set off the last trigger is still going, so a GIF that's
+                still recording is asked to keep going instead
+        """
+        detection_time = datetime.now().strftime('%F %T')
+        for mode in self.modes:
+            claim_token = self.coalescer.claim(cam_id, mode)
+            if claim_token is None:
+                if mode == TriggerMode.GIF and is_continuing:
+                    self.coalescer.request_extension(cam_id, mode, self.take_seconds)
+                continue
+            payload = dict(cam_id=cam_id, detection_type='motion', detection_time=detection_time,
+                           claim_token=claim_token)
+            if mode == TriggerMode.SNAP:
+                self.celery_app.send_task(TASK_NAME_SNAPSHOT, kwargs=dict(payload, is_optimize=True))
+            else:
+                self.celery_app.send_task(TASK_NAME_GIF, kwargs=dict(
+                    payload, take_seconds=self.take_seconds, output_format=self.output_format))
+            logger.info(f'Motion on camera {cam_id} - queued {mode}.')
+
+
+class RingStream:
+    """Follows a camera's frames in the capture service's frame ring, through the same `grab` / `retrieve`
+    calls as `cv2.VideoCapture`
+
+    Frames are only copied out of the ring when retrieved, so skipped ones cost nothing.
+    """
+    def __init__(self, ring: SharedFrameRing, timeout: float = 5.0):
+        self.ring = ring
+        self.timeout = timeout
+        self._seq = 0
+        self._frame = None  # type: Optional[NDArray]
+
+    def grab(self) -> bool:
+        try:
+            self._seq, self._frame, _ = self.ring.wait_for_frame(after_seq=self._seq, timeout=self.timeout)
+        except (TimeoutError, EOFError) as exc:
+            logger.warning(str(exc))
+            return False
+        return True
+
+    def retrieve(self) -> Tuple[bool, Optional[NDArray]]:
+        frame = self._frame.copy()
+        if not self.ring.is_current(self._seq):
+            # The writer lapped us mid-copy, so the copy may be torn
+            return False, None
+        return True, frame
+
+    def release(self):
+        # The view has to go before the ring's block can be closed
+        self._frame = None
+        self.ring.close()
+
+
+class CameraWatcher(threading.Thread):
+    """Keeps watch on one camera's substream, firing a trigger when motion starts
+
+    Every frame is grabbed so the stream never lags behind, and with OpenCV's FFmpeg backend grabbing
+    decodes the frame, so the substream's frame rate and resolution set a floor on the thread's CPU use.
+    Only sampled frames are retrieved and checked - at most `sample_fps` a second. A sample counts as
+    moving when at least `on_score` of the frame changed. Motion starts after `on_samples` moving samples in a row
+    and only ends after `off_samples` in a row below `off_score`, so it doesn't flap at the edges.
+    While it lasts, the trigger fires again every `cooldown` seconds.
+
+    The sample rate adapts to keep detection's CPU use within `cpu_budget` of a core: sampling slows down
+    while it's over budget and speeds back up to `sample_fps` once well under. Decoding isn't counted, as
+    sampling less often doesn't reduce it - if decoding alone takes more than the budget, that's logged
+    (every `DECODE_CHECK_INTERVAL` seconds) so the substream can be turned down at the camera. Both are
+    measured in this thread's CPU time, so decoder threads FFmpeg starts itself go uncounted.
+
+    The substream holds one of the camera's substream slots (`substream_limiter`) while it's open. Without
+    a substream, the watcher reads the capture service's frame ring when the camera's captured through one
+    (`CaptureSource.RING`). Otherwise it only opens the main stream while one of the camera's stream
+    slots is free, and waits for one while they're all taken.
+    """
+    RECONNECT_DELAY = 5.0   # Seconds to wait before reopening a dropped stream
+    DECODE_CHECK_INTERVAL = 60.0    # Seconds between checks of the substream's decoding cost
+    MAX_INTERVAL = 5.0      # Slowest the sample rate will drop to (seconds between samples)
+    RATE_STEP = 1.5         # Factor the sample interval changes by when adjusting to the budget
+
+    def __init__(self, cam: IPCamera, trigger: CaptureTrigger, sample_fps: float = 2.0, cpu_budget: float = 0.05,
+                 detect_width: int = 320, on_score: float = 0.005, off_score: float = 0.002, on_samples: int = 2,
+                 off_samples: int = 4, cooldown: float = 10.0, substream_limiter: Optional[StreamLimiter] = None):
+        super().__init__(name=f'watch-{cam.cam_name}', daemon=True)
+        self.cam = cam
+        self.trigger = trigger
+        self.min_interval = 1 / sample_fps
+        self.cpu_budget = cpu_budget
+        self.on_score = on_score
+        self.off_score = off_score
+        self.on_samples = on_samples
+        self.off_samples = off_samples
+        self.cooldown = cooldown
+        self.detector = MotionDetector(detection_type=MotionDetectionType.DIFF, roi=cam.roi, detect_width=detect_width)
+        self.substream_limiter = substream_limiter
+        self.has_substream = cam.substream_name != cam.stream_name
+        if not self.has_substream:
+            if cam.capture_source == CaptureSource.RING:
+                logger.info(f'CAM_{cam.cam_id}_SUBSTREAM is not set - watching camera {cam.cam_name} through '
+                            f'its frame ring.')
+            else:
+                logger.warning(f'CAM_{cam.cam_id}_SUBSTREAM is not set - watching camera {cam.cam_name} on its '
+                               f'main stream (whenever one of its stream slots is free), which decodes every '
+                               f'full-resolution frame.')
+
+        self._stop_event = threading.Event()
+        self.interval = self.min_interval
+        self.is_moving = False
+        self._n_streak = 0
+        self._last_fired = 0.0
+        self._is_waiting_on_slot = False
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _take_slot(self) -> Optional[StreamSlot]:
+        """Takes a slot for the stream the watcher opens, returning None if they're all held elsewhere"""
+        limiter = self.substream_limiter if self.has_substream else self.cam.stream_limiter
+        if limiter is None:
+            return StreamSlot(self.cam.cam_id, lock=None, lease_seconds=0)
+        slot = limiter.acquire(self.cam.cam_id)
+        if slot is None:
+            if not self._is_waiting_on_slot:
+                kind = 'substream' if self.has_substream else 'stream'
+                logger.warning(f'Camera {self.cam.cam_name} is at its {kind} limit - waiting for a slot to free '
+                               f'up before watching it.')
+            self._is_waiting_on_slot = True
+        else:
+            self._is_waiting_on_slot = False
+        return slot
+
+    def _open(self) -> Tuple[Optional[Union[cv2.VideoCapture, RingStream]], Optional[StreamSlot]]:
+        """Opens the stream to watch, with the slot held for it (if any). Returns (None, None) if it couldn't be."""
+        if not self.has_substream and self.cam.capture_source == CaptureSource.RING:
+            try:
+                return RingStream(SharedFrameRing.attach(self.cam.frame_ring_name)), None
+            except (FileNotFoundError, ValueError):
+                logger.warning(f'Frame ring {self.cam.frame_ring_name} for camera {self.cam.cam_name} is not '
+                               f'available. Retrying in {self.RECONNECT_DELAY}s.')
+                return None, None
+
+        slot = self._take_slot()
+        if slot is None:
+            return None, None
+        cap = cv2.VideoCapture(self.cam.substream_url)
+        if not cap.isOpened():
+            kind = 'Substream' if self.has_substream else 'Stream'
+            logger.warning(f'{kind} for camera {self.cam.cam_name} was unable to be opened. '
+                           f'Retrying in {self.RECONNECT_DELAY}s.')
+            cap.release()
+            slot.release()
+            return None, None
+        return cap, slot
+
+    def run(self):
+        while not self._stop_event.is_set():
+            cap, slot = self._open()
+            if cap is None:
+                self._stop_event.wait(self.RECONNECT_DELAY)
+                continue
+            logger.info(f'Watching camera {self.cam.cam_name} for motion.')
+            try:
+                self._watch(cap, slot=slot)
+            finally:
+                cap.release()
+                if slot is not None:
+                    slot.release()
+            # Start the clip over once we reconnect
+            self.detector.reset()
+            self.is_moving = False
+            self._n_streak = 0
+
+    def _watch(self, cap: Union[cv2.VideoCapture, RingStream], slot: Optional[StreamSlot] = None):
+        next_sample = last_sample = time.monotonic()
+        # Decoding's cost is what's left of the thread's CPU time once detection's is taken out
+        window_start, window_cpu, detect_cpu = time.monotonic(), time.thread_time(), 0.0
+        while not self._stop_event.is_set():
+            if not cap.grab():
+                logger.warning(f'Lost stream for camera {self.cam.cam_name} - reconnecting.')
+                return
+            if slot is not None and not slot.renew_if_due():
+                logger.warning(f'Stream slot for camera {self.cam.cam_name} ran out - reconnecting.')
+                return
+            now = time.monotonic()
+            if now - window_start >= self.DECODE_CHECK_INTERVAL:
+                cpu = time.thread_time()
+                self._check_decode_cost((cpu - window_cpu - detect_cpu) / (now - window_start))
+                window_start, window_cpu, detect_cpu = now, cpu, 0.0
+            if now < next_sample:
+                continue
+
+            cpu_start = time.thread_time()
+            ok, frame = cap.retrieve()
+            if ok and frame is not None:
+                self._check(frame)
+            cost = time.thread_time() - cpu_start
+            detect_cpu += cost
+
+            # Keep detection to the CPU budget, spread over the time since the last sample
+            usage = cost / max(now - last_sample, self.interval)
+            last_sample = now
+            if usage > self.cpu_budget and self.interval < self.MAX_INTERVAL:
+                self.interval = min(self.interval * self.RATE_STEP, self.MAX_INTERVAL)
+                logger.debug(f'Camera {self.cam.cam_name} over CPU budget ({usage:.1%}) - '
+                             f'sampling every {self.interval:.2f}s')
+            elif usage < self.cpu_budget / 2 and self.interval > self.min_interval:
+                self.interval = max(self.interval / self.RATE_STEP, self.min_interval)
+            next_sample = now + self.interval
+
+    def _check_decode_cost(self, usage: float):
+        if usage > self.cpu_budget:
+            logger.warning(f'Decoding the substream for camera {self.cam.cam_name} alone takes {usage:.1%} of a '
+                           f'core, over its CPU budget of {self.cpu_budget:.1%}. Sampling less often can\'t help - '
+                           f'lower the substream\'s frame rate or resolution.')
+
+    def _check(self, frame: NDArray):
+        _, scores = self.detector.batch_motion_detect_with_diff(self.detector.downscale(frame)[np.newaxis])
+        score = scores[0]
+
+        # Count samples in a row that point towards a change of state
+        if self.is_moving:
+            self._n_streak = self._n_streak + 1 if score < self.off_score else 0
+            if self._n_streak >= self.off_samples:
+                logger.debug(f'Motion ended on camera {self.cam.cam_name}')
+                self.is_moving = False
+                self._n_streak = 0
+        else:
+            self._n_streak = self._n_streak + 1 if score >= self.on_score else 0
+            if self._n_streak >= self.on_samples:
+                logger.debug(f'Motion started on camera {self.cam.cam_name} (score: {score:.3f})')
+                self.is_moving = True
+                self._n_streak = 0
+                self._fire(is_continuing=False)
+                return
+        if self.is_moving and time.monotonic() - self._last_fired >= self.cooldown:
+            self._fire(is_continuing=True)
+
+    def _fire(self, is_continuing: bool):
+        self._last_fired = time.monotonic()
+        try:
+            self.trigger.fire(self.cam.cam_id, is_continuing=is_continuing)
+        except Exception:
+            logger.exception(f'Unable to queue capture for camera {self.cam.cam_name}.')
+
+
+def main():
+    app = create_app()
+    cams = app.extensions['cams']  # type: CameraRegistry
+    trigger = CaptureTrigger(
+        celery_app=app.extensions['celery'],
+        coalescer=app.extensions['coalescer'],
+        modes=[TriggerMode(x.strip()) for x in os.getenv('DAEMON_TRIGGERS', 'snap,gif').split(',')],
+        take_seconds=int(os.getenv('DAEMON_TAKE_SECONDS', '5'))
+    )
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop_event.set())
+
+    substream_limiter = SubstreamLimiter.from_env(get_redis())
+    watchers = []  # type: List[CameraWatcher]
+    for cam in cams.values():
+        watcher = CameraWatcher(
+            cam=cam,
+            trigger=trigger,
+            sample_fps=float(os.getenv('DAEMON_SAMPLE_FPS', '2')),
+            cpu_budget=float(os.getenv('DAEMON_CPU_BUDGET', '0.05')),
+            detect_width=int(os.getenv('DAEMON_DETECT_WIDTH', '320')),
+            on_score=float(os.getenv('DAEMON_ON_SCORE', '0.005')),
+            off_score=float(os.getenv('DAEMON_OFF_SCORE', '0.002')),
+            on_samples=int(os.getenv('DAEMON_ON_SAMPLES', '2')),
+            off_samples=int(os.getenv('DAEMON_OFF_SAMPLES', '4')),
+            cooldown=float(os.getenv('DAEMON_COOLDOWN', '10')),
+            substream_limiter=substream_limiter
+        )
+        watcher.start()
+        watchers.append(watcher)
+
+    stop_event.wait()
+    logger.info('Stopping motion watch...')
+    for watcher in watchers:
+        watcher.stop()
+    for watcher in watchers:
+        watcher.join(timeout=CameraWatcher.RECONNECT_DELAY)
+
+
+if __name__ == '__main__':
+    main()
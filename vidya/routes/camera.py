@@ -1,21 +1,34 @@
 from flask import (
     Blueprint,
+    current_app,
     make_response,
+    request,
 )
 from loguru import logger
 
 from vidya import ROOT
+from vidya.core.coalesce import TriggerMode
 from vidya.routes.helpers import (
+    get_cam_api,
     get_celery,
+    get_coalescer,
+    get_latest_frames,
     process_args,
+    process_cam_ids,
+    process_extend,
+    process_output_format,
 )
 
 bp_cam = Blueprint('snap', __name__, url_prefix='/cam/<int:cam_id>/')
+bp_cams = Blueprint('snaps', __name__, url_prefix='/cams/')
 
 BASE_PATH = ROOT.joinpath('snaps')
 
 TASK_NAME_SNAPSHOT = 'vidya.celery_tasks.take_snapshot'
 TASK_NAME_GIF = 'vidya.celery_tasks.take_gif'
+TASK_NAME_GROUP_SNAPSHOT = 'vidya.celery_tasks.take_group_snapshot'
+TASK_NAME_GROUP_GIF = 'vidya.celery_tasks.take_group_gif'
+TASK_NAME_UPLOAD = 'vidya.celery_tasks.upload_artifacts'
 
 
 @bp_cam.route('/snap', methods=['GET'])
@@ -30,21 +43,37 @@ def snapshot(cam_id: int):
         is_optimize=True
     )
 
+    claim_token = get_coalescer().claim(cam_id, TriggerMode.SNAP)
+    if claim_token is None:
+        logger.info(f'Snapshot already pending for camera {cam_id} - coalescing trigger.')
+        return make_response({
+            'success': True,
+            'coalesced': True,
+            'payload': payload
+        }, 200)
+
     celery_app = get_celery()
     logger.info('Sending task to queue...')
     celery_app.send_task(
         TASK_NAME_SNAPSHOT,
-        kwargs=payload
+        kwargs=dict(payload, claim_token=claim_token)
     )
 
     return make_response({
         'success': True,
+        'coalesced': False,
         'payload': payload
     }, 200)
 
 
 @bp_cam.route('/gif', methods=['GET'])
 def take_gif(cam_id):
+    output_format = process_output_format()
+    if output_format is None:
+        return make_response({
+            'success': False,
+            'message': 'Unsupported output format requested.'
+        }, 400)
     detection_type, detection_time, take_seconds, quality, fps = process_args()
 
     payload = dict(
@@ -53,13 +82,130 @@ def take_gif(cam_id):
         detection_time=detection_time,
         take_seconds=take_seconds,
         quality=quality,
-        fps=fps
+        fps=fps,
+        output_format=output_format
     )
 
+    coalescer = get_coalescer()
+    claim_token = coalescer.claim(cam_id, TriggerMode.GIF)
+    if claim_token is None:
+        extended_seconds = 0
+        if process_extend():
+            # Ask the gif in flight to keep recording for as long as this trigger wanted
+            extended_seconds = coalescer.request_extension(cam_id, TriggerMode.GIF, take_seconds)
+        logger.info(f'GIF already pending for camera {cam_id} - coalescing trigger '
+                    f'(extended by {extended_seconds}s).')
+        return make_response({
+            'success': True,
+            'coalesced': True,
+            'extended_seconds': extended_seconds,
+            'payload': payload
+        }, 200)
+
     celery_app = get_celery()
     logger.info('Sending task to queue...')
     celery_app.send_task(
         TASK_NAME_GIF,
+        kwargs=dict(payload, claim_token=claim_token)
+    )
+
+    return make_response({
+        'success': True,
+        'coalesced': False,
+        'payload': payload
+    }, 200)
+
+
+@bp_cam.route('/latest.jpg', methods=['GET'])
+def latest_frame(cam_id: int):
+    """Serves the camera's latest snapshot, cached briefly so any number of dashboards can poll it
+
+    Responses carry an ETag, so clients sending it back in If-None-Match get a 304 until the image changes.
+    """
+    if cam_id not in current_app.extensions['cam_apis']:
+        return make_response({
+            'success': False,
+            'message': 'Unknown camera id requested.'
+        }, 404)
+    cache = get_latest_frames()
+    try:
+        frame = cache.get(cam_id, fetch=get_cam_api(cam_id).snap_jpeg)
+    except Exception as exc:
+        logger.error(f'Unable to fetch latest frame for camera {cam_id}: {exc}')
+        return make_response({
+            'success': False,
+            'message': 'Unable to fetch a frame from the camera.'
+        }, 503)
+
+    resp = make_response(frame.jpeg)
+    resp.mimetype = 'image/jpeg'
+    resp.set_etag(frame.etag)
+    resp.last_modified = frame.fetched_at
+    resp.cache_control.max_age = max(int(cache.ttl - frame.age()), 0)
+    return resp.make_conditional(request)
+
+
+@bp_cams.route('/snap', methods=['GET'])
+def group_snapshot():
+    cam_ids = process_cam_ids()
+    if cam_ids is None:
+        return make_response({
+            'success': False,
+            'message': 'Unknown camera id(s) requested.'
+        }, 400)
+    detection_type, detection_time, _, quality, _ = process_args()
+
+    payload = dict(
+        cam_ids=cam_ids,
+        detection_type=detection_type,
+        detection_time=detection_time,
+        quality=quality,
+        is_optimize=True
+    )
+
+    celery_app = get_celery()
+    logger.info('Sending group task to queue...')
+    celery_app.send_task(
+        TASK_NAME_GROUP_SNAPSHOT,
+        kwargs=payload
+    )
+
+    return make_response({
+        'success': True,
+        'payload': payload
+    }, 200)
+
+
+@bp_cams.route('/gif', methods=['GET'])
+def group_gif():
+    cam_ids = process_cam_ids()
+    if cam_ids is None:
+        return make_response({
+            'success': False,
+            'message': 'Unknown camera id(s) requested.'
+        }, 400)
+    output_format = process_output_format()
+    if output_format is None:
+        return make_response({
+            'success': False,
+            'message': 'Unsupported output format requested.'
+        }, 400)
+    detection_type, detection_time, take_seconds, quality, fps = process_args()
+
+    payload = dict(
+        cam_ids=cam_ids,
+        detection_type=detection_type,
+        detection_time=detection_time,
+        take_seconds=take_seconds,
+        quality=quality,
+        fps=fps,
+        output_format=output_format
+    )
+
+    celery_app = get_celery()
+    logger.info('Sending group task to queue...')
+    celery_app.send_task(
+        TASK_NAME_GROUP_GIF,
         kwargs=payload
     )
 
@@ -1,7 +1,10 @@
 from datetime import datetime
+import os
 import time
 from typing import (
+    TYPE_CHECKING,
     List,
+    Optional,
     Tuple,
 )
 
@@ -15,10 +18,17 @@ from flask import (
 from loguru import logger
 from slack_sdk.web import WebClient
 
-from vidya.core.camera import IPCamera
+from vidya.core.artifacts import ArtifactStore
+from vidya.core.camera_api import CameraAPI
+from vidya.core.coalesce import TriggerCoalescer
+from vidya.core.formats import OutputFormat
+from vidya.core.latest_frame import LatestFrameCache
 
+if TYPE_CHECKING:
+    from vidya.core.camera import IPCamera
 
-def build_motion_message(detection_type: str, cam: IPCamera, detection_time: str,
+
+def build_motion_message(detection_type: str, cam: 'IPCamera', detection_time: str,
                          cnts: int = None, avg_cnts_per_frame: float = None) -> str:
     msg = f'*`{detection_type.title()}`* detected in `{cam.cam_name}` at `{detection_time}`.'
     if cnts is not None:
@@ -28,7 +38,11 @@ def build_motion_message(detection_type: str, cam: IPCamera, detection_time: str
     return msg
 
 
-def get_cam(cam_id: int) -> IPCamera:
+def get_artifact_store() -> ArtifactStore:
+    return current_app.extensions['artifacts']
+
+
+def get_cam(cam_id: int) -> 'IPCamera':
     return current_app.extensions['cams'][cam_id]  # type: IPCamera
 
 
@@ -40,6 +54,18 @@ def get_celery() -> Celery:
     return current_app.extensions['celery']
 
 
+def get_coalescer() -> TriggerCoalescer:
+    return current_app.extensions['coalescer']
+
+
+def get_cam_api(cam_id: int) -> CameraAPI:
+    return current_app.extensions['cam_apis'][cam_id]
+
+
+def get_latest_frames() -> LatestFrameCache:
+    return current_app.extensions['latest_frames']
+
+
 def process_args() -> Tuple[str, str, int, int, int]:
     detection_type = request.args.get('detection_type', 'motion')
     detection_time = request.args.get('detection_time')
@@ -67,6 +93,44 @@ def process_args() -> Tuple[str, str, int, int, int]:
     return detection_type, detection_time, take_seconds, quality, fps
 
 
+def process_output_format() -> Optional[OutputFormat]:
+    """Reads the `format` arg for animated captures (defaults to OUTPUT_FORMAT, else gif)
+
+    Returns None if the format isn't supported.
+    """
+    output_format = request.args.get('format')
+    if output_format is None or output_format == '':
+        output_format = os.getenv('OUTPUT_FORMAT', OutputFormat.GIF)
+    try:
+        return OutputFormat(output_format.lower())
+    except ValueError:
+        return None
+
+
+def process_extend() -> bool:
+    """Whether a coalesced GIF trigger should extend the capture already running (`extend` arg)"""
+    return request.args.get('extend', 'false').lower() in ('1', 'true', 'yes')
+
+
+def process_cam_ids() -> Optional[List[int]]:
+    """Reads the `cams` arg (comma-separated ids, or 'all' - the default) into a list of camera ids
+
+    Returns None if any of the requested ids aren't configured.
+    """
+    known_ids = list(current_app.extensions['cams'].keys())
+    cams = request.args.get('cams', 'all')
+    if cams is None or cams == '' or cams.lower() == 'all':
+        return known_ids
+    try:
+        cam_ids = [int(x) for x in cams.split(',') if x.strip() != '']
+    except ValueError:
+        return None
+    if len(cam_ids) == 0 or any(x not in known_ids for x in cam_ids):
+        return None
+    # Preserve order, drop dupes
+    return list(dict.fromkeys(cam_ids))
+
+
 def log_before():
     g.start_time = time.perf_counter()
 